@@ -1,5 +1,7 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional
 from jose import JWTError, jwt
 import bcrypt
 from fastapi import Depends, HTTPException, status
@@ -9,19 +11,113 @@ from sqlalchemy import select
 from app.config import settings
 from app.database import get_db
 from app.models import User, UserRole
+from app.cache import MISSING, TTLCache
+from app.shared_cache import invalidation_bus
+from app.exceptions import ServiceUnavailableError
 
 security = HTTPBearer()
 
+class PrincipalCache:
+    """已认证用户缓存：(用户ID, 令牌签发时间) -> 用户字段快照，避免每个管理请求都查询用户表"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl)
+        # 用户被修改后版本号加一，旧版本的缓存条目不再命中，随LRU和TTL自然淘汰
+        self._versions: Dict[int, int] = {}
+    
+    def _key(self, user_id: int, iat: int) -> tuple:
+        return (user_id, iat, self._versions.get(user_id, 0))
+    
+    def get(self, user_id: int, iat: int) -> Optional[User]:
+        """命中时返回不绑定会话的User副本"""
+        values = self._cache.get(self._key(user_id, iat))
+        if values is MISSING:
+            return None
+        return User(**values)
+    
+    def set(self, user_id: int, iat: int, user: User):
+        values = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+        self._cache.set(self._key(user_id, iat), values)
+    
+    def invalidate(self, user_id: int):
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+    
+    def on_invalidate(self, payload: str):
+        """处理其他worker广播的用户变更消息，格式: 用户ID"""
+        self.invalidate(int(payload))
+    
+    def clear(self):
+        """清除全部缓存（错过失效广播后调用）"""
+        self._cache.clear()
+    
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+principal_cache = PrincipalCache(
+    maxsize=settings.PRINCIPAL_CACHE_MAX_SIZE,
+    ttl=settings.PRINCIPAL_CACHE_TTL
+)
+
+async def invalidate_user(user_id: int):
+    """用户状态或密码变更后清除所有worker中的认证缓存"""
+    await invalidation_bus.publish("user", str(user_id))
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 def get_password_hash(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS)).decode('utf-8')
+
+class PasswordHasher:
+    """在专用线程池中执行bcrypt（bcrypt计算时释放GIL），不阻塞事件循环；排队过多时返回503"""
+    
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self.rejected = 0
+    
+    async def _run(self, func, *args):
+        if self._pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise ServiceUnavailableError("服务器繁忙，请稍后再试")
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+    
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+        }
+
+password_hasher = PasswordHasher(
+    workers=settings.BCRYPT_WORKERS,
+    max_queue=settings.BCRYPT_MAX_QUEUE
+)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
 
 async def get_current_user(
@@ -40,13 +136,20 @@ async def get_current_user(
         if user_id_str is None:
             raise credentials_exception
         user_id = int(user_id_str)
-    except JWTError:
+        iat = int(payload.get("iat", 0))
+    except (JWTError, ValueError):
         raise credentials_exception
     
+    # 先查认证缓存（缓存中只有启用状态的用户）
+    user = principal_cache.get(user_id, iat)
+    if user is not None:
+        return user
+    
     result = await db.execute(select(User).where(User.id == user_id))
     user = result.scalar_one_or_none()
     if user is None or not user.is_active:
         raise credentials_exception
+    principal_cache.set(user_id, iat, user)
     return user
 
 async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
@@ -0,0 +1,211 @@
+"""
+进程内缓存模块
+包含：带TTL和LRU淘汰的通用缓存、合并并发加载的缓存、按app_key缓存的应用信息、卡密列表总数、仪表盘响应
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.models import Application
+
+# 缓存未命中标记（区别于缓存的None值）
+MISSING = object()
+
+
+class TTLCache:
+    """带过期时间的LRU缓存（单进程，非线程安全，供事件循环内使用）"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Any:
+        """获取缓存值，不存在或已过期返回MISSING"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        """删除缓存条目"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """清空缓存"""
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """缓存命中统计"""
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SingleFlightCache:
+    """
+    TTL缓存 + 请求合并：同一个键未命中时只有第一个请求执行加载，
+    加载期间到达的请求等待同一个结果，不再重复查询
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl)
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        # clear()时递增；加载开始后代数变化说明结果可能早于失效，不再写入缓存
+        self._generation = 0
+        # 统计计数
+        self.loads = 0
+        self.coalesced = 0
+        self.discarded = 0
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """获取缓存值，未命中时调用loader加载（loader需自行获取数据库会话）"""
+        value = self._cache.get(key)
+        if value is not MISSING:
+            return value
+        task = self._inflight.get(key)
+        if task is None:
+            # 加载放在独立任务中，发起请求的客户端断开也不会取消其他请求等待的加载
+            task = asyncio.create_task(self._load(key, loader, self._generation))
+            self._inflight[key] = task
+            self.loads += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], generation: int) -> Any:
+        try:
+            value = await loader()
+            if generation == self._generation:
+                self._cache.set(key, value)
+            else:
+                self.discarded += 1
+            return value
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+
+    def clear(self):
+        """清空缓存；正在进行的加载仍返回给已在等待的请求，但不写入缓存，之后的请求重新加载"""
+        self._generation += 1
+        self._inflight.clear()
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        """命中统计：misses包含合并等待的请求，其中loads次实际执行了加载"""
+        return {
+            **self._cache.stats(),
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "discarded": self.discarded,
+            "inflight": len(self._inflight),
+        }
+
+
+@dataclass(frozen=True)
+class AppInfo:
+    """心跳路径需要的应用信息"""
+    id: int
+    is_active: bool
+    max_devices: int
+    heartbeat_interval: int
+    app_secret: str = field(repr=False)
+
+
+class AppRegistry:
+    """按app_key缓存应用信息，不存在的app_key也会缓存，避免无效请求打到数据库"""
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float):
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize, ttl)
+
+    async def get(self, db: AsyncSession, app_key: str) -> Optional[AppInfo]:
+        """获取应用信息，不存在返回None"""
+        info = self._cache.get(app_key)
+        if info is not MISSING:
+            return info
+
+        result = await db.execute(
+            select(
+                Application.id,
+                Application.is_active,
+                Application.max_devices,
+                Application.heartbeat_interval,
+                Application.app_secret
+            ).where(Application.app_key == app_key)
+        )
+        row = result.one_or_none()
+        if row is None:
+            self._cache.set(app_key, None, ttl=self.negative_ttl)
+            return None
+
+        info = AppInfo(
+            id=row.id,
+            is_active=row.is_active,
+            max_devices=row.max_devices,
+            heartbeat_interval=row.heartbeat_interval,
+            app_secret=row.app_secret
+        )
+        self._cache.set(app_key, info)
+        return info
+
+    def invalidate(self, app_key: str):
+        """应用被修改或删除后清除缓存"""
+        self._cache.pop(app_key)
+
+    def clear(self):
+        """清除全部缓存（错过失效广播后调用）"""
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+app_registry = AppRegistry(
+    maxsize=settings.APP_CACHE_MAX_SIZE,
+    ttl=settings.APP_CACHE_TTL,
+    negative_ttl=settings.APP_CACHE_NEGATIVE_TTL
+)
+
+# 卡密列表总数：按过滤条件缓存，生成或删除卡密后清空，其余变化（如激活）在TTL内可能不准确
+card_counts = TTLCache(
+    maxsize=settings.CARD_COUNT_CACHE_MAX_SIZE,
+    ttl=settings.CARD_COUNT_CACHE_TTL
+)
+
+# 仪表盘响应：按(接口, 范围, 参数)缓存，TTL很短，多个管理端同时轮询时只查询一次
+dashboard_cache = SingleFlightCache(
+    maxsize=settings.DASHBOARD_CACHE_MAX_SIZE,
+    ttl=settings.DASHBOARD_CACHE_TTL
+)
@@ -0,0 +1,280 @@
+"""
+卡密批量生成模块
+卡密由secrets.token_bytes整批取随机字节，按字节映射到32个字符（256可被32整除，分布均匀），
+每批在内存中去重后用多行INSERT写入（PostgreSQL用unnest展开数组参数，整批一条语句），
+ON CONFLICT DO NOTHING跳过与已有卡密重复的键，RETURNING取回写入的id，缺少的数量重新生成补足。
+数量较少时在一个事务内生成，提交后再返回给客户端（客户端拿到的都是已生效的卡密）；数量较多时作为后台任务逐批提交，
+进度记录在card_batches表，任意worker都可以查询进度和已生成的卡密
+"""
+
+import asyncio
+import secrets
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List
+from sqlalchemy import ARRAY, String, cast, func, literal, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.database import async_session
+from app.exceptions import ServiceUnavailableError
+from app.models import Card, CardBatch, CardType
+from app.schemas import CardBatchResponse
+from app.shared_cache import invalidation_bus
+from app.stats_counters import stats_counters
+
+CARD_ALPHABET = b"ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+# 随机字节 -> 卡密字符
+_TRANSLATE = bytes(CARD_ALPHABET[i % len(CARD_ALPHABET)] for i in range(256))
+_KEY_LENGTH = 16
+
+CARD_DURATION = {
+    CardType.DAY: 1,
+    CardType.WEEK: 7,
+    CardType.MONTH: 30,
+    CardType.YEAR: 365,
+    CardType.PERMANENT: 36500,  # 100年
+}
+
+# 返回给客户端的卡密字段（与CardResponse一致）
+RESULT_COLUMNS = (
+    Card.id, Card.card_key, Card.card_type, Card.duration_days, Card.application_id,
+    Card.is_used, Card.used_by, Card.used_at, Card.expires_at, Card.created_at
+)
+
+# 未完成的批次超过该时间（秒）没有进度更新，视为所在worker已退出
+STALE_AFTER = 300
+
+
+def generate_card_keys(count: int) -> List[str]:
+    """批量生成卡密，格式: XXXX-XXXX-XXXX-XXXX"""
+    raw = secrets.token_bytes(_KEY_LENGTH * count).translate(_TRANSLATE).decode("ascii")
+    return [
+        f"{raw[i:i + 4]}-{raw[i + 4:i + 8]}-{raw[i + 8:i + 12]}-{raw[i + 12:i + 16]}"
+        for i in range(0, len(raw), _KEY_LENGTH)
+    ]
+
+
+class CardIssuer:
+    """卡密批量生成与后台生成任务"""
+
+    def __init__(self, batch_size: int, max_jobs: int):
+        self.batch_size = batch_size
+        self.max_jobs = max_jobs
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # 统计计数
+        self.issued = 0
+        self.duplicates = 0
+        self.conflicts = 0
+        self.jobs_started = 0
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+
+    async def _insert(self, db: AsyncSession, batch: CardBatch, keys: List[str], created_at: datetime) -> list:
+        """写入一批卡密，跳过已存在的键，返回实际写入的(id, card_key)"""
+        duration_days = CARD_DURATION.get(batch.card_type, 30)
+        if db.bind.dialect.name == "postgresql":
+            # 整批卡密作为一个数组参数，由unnest展开成行
+            columns = select(
+                func.unnest(literal(keys, ARRAY(String(32)))),
+                cast(literal(batch.card_type.name), Card.card_type.type),
+                literal(duration_days),
+                literal(batch.application_id),
+                literal(batch.creator_id),
+                literal(False),
+                literal(created_at),
+                literal(batch.id, String(32))
+            )
+            stmt = pg_insert(Card).from_select(
+                ["card_key", "card_type", "duration_days", "application_id",
+                 "creator_id", "is_used", "created_at", "batch_id"],
+                columns
+            ).on_conflict_do_nothing(index_elements=["card_key"]).returning(Card.id, Card.card_key)
+            return (await db.execute(stmt)).all()
+
+        # 其他数据库按executemany传参，SQLAlchemy会拼成多行VALUES分页执行（不必为每批重新编译语句）
+        stmt = sqlite_insert(Card.__table__).on_conflict_do_nothing(index_elements=["card_key"])
+        rows = [
+            {
+                "card_key": key,
+                "card_type": batch.card_type,
+                "duration_days": duration_days,
+                "application_id": batch.application_id,
+                "creator_id": batch.creator_id,
+                "is_used": False,
+                "created_at": created_at,
+                "batch_id": batch.id,
+            }
+            for key in keys
+        ]
+        return (await db.execute(stmt.returning(Card.id, Card.card_key), rows)).all()
+
+    async def _fill(self, db: AsyncSession, batch: CardBatch, count: int) -> AsyncIterator[List[dict]]:
+        """逐批生成并写入count张卡密，每写入一批返回该批卡密（不提交）"""
+        duration_days = CARD_DURATION.get(batch.card_type, 30)
+        remaining = count
+        while remaining > 0:
+            wanted = min(self.batch_size, remaining)
+            keys = list(dict.fromkeys(generate_card_keys(wanted)))
+            self.duplicates += wanted - len(keys)
+            created_at = datetime.utcnow()
+            rows = await self._insert(db, batch, keys, created_at)
+            if not rows:
+                raise RuntimeError("卡密写入失败")
+            self.conflicts += len(keys) - len(rows)
+            remaining -= len(rows)
+            yield [
+                {
+                    "id": card_id,
+                    "card_key": card_key,
+                    "card_type": batch.card_type,
+                    "duration_days": duration_days,
+                    "application_id": batch.application_id,
+                    "is_used": False,
+                    "used_by": None,
+                    "used_at": None,
+                    "expires_at": None,
+                    "created_at": created_at,
+                }
+                for card_id, card_key in rows
+            ]
+
+    @staticmethod
+    def _new_batch(application_id: int, creator_id: int, card_type: CardType, count: int, status: str) -> CardBatch:
+        now = datetime.utcnow()
+        return CardBatch(
+            id=secrets.token_hex(16),
+            application_id=application_id,
+            creator_id=creator_id,
+            card_type=card_type,
+            count=count,
+            issued=0,
+            status=status,
+            created_at=now,
+            updated_at=now
+        )
+
+    async def issue(
+        self,
+        application_id: int,
+        creator_id: int,
+        card_type: CardType,
+        count: int
+    ) -> List[List[dict]]:
+        """
+        在一个事务内生成count张卡密，全部写入并提交后按批返回；
+        中途出错则整批回滚。提交前不向客户端发送卡密，响应发送期间也不占用事务
+        """
+        batches = []
+        async with async_session() as db:
+            batch = self._new_batch(application_id, creator_id, card_type, count, "running")
+            db.add(batch)
+            await db.flush()
+            async for rows in self._fill(db, batch, count):
+                batches.append(rows)
+            batch.issued = count
+            batch.status = "completed"
+            batch.finished_at = batch.updated_at = datetime.utcnow()
+            await db.commit()
+            self.issued += count
+        stats_counters.add(creator_id, total_cards=count)
+        await invalidation_bus.publish("cards", batch.id)
+        return batches
+
+    async def start_job(
+        self,
+        application_id: int,
+        creator_id: int,
+        card_type: CardType,
+        count: int
+    ) -> CardBatch:
+        """创建后台生成任务，本worker运行的任务已满时抛出ServiceUnavailableError"""
+        if len(self._tasks) >= self.max_jobs:
+            raise ServiceUnavailableError("卡密生成任务过多，请稍后再试")
+        batch = self._new_batch(application_id, creator_id, card_type, count, "pending")
+        async with async_session() as db:
+            db.add(batch)
+            await db.commit()
+        task = asyncio.create_task(self._run(batch.id))
+        self._tasks[batch.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch.id, None))
+        self.jobs_started += 1
+        print(f"[卡密生成] 批次{batch.id}开始，共{count}张")
+        return batch
+
+    async def _run(self, batch_id: str):
+        """后台生成：每写入一批提交一次并更新进度"""
+        try:
+            async with async_session() as db:
+                batch = await db.get(CardBatch, batch_id)
+                batch.status = "running"
+                await db.commit()
+                async for rows in self._fill(db, batch, batch.count - batch.issued):
+                    batch.issued += len(rows)
+                    batch.updated_at = datetime.utcnow()
+                    await db.commit()
+                    self.issued += len(rows)
+                    stats_counters.add(batch.creator_id, total_cards=len(rows))
+                batch.status = "completed"
+                batch.finished_at = batch.updated_at = datetime.utcnow()
+                await db.commit()
+            self.jobs_completed += 1
+            await invalidation_bus.publish("cards", batch_id)
+            print(f"[卡密生成] 批次{batch_id}完成")
+        except asyncio.CancelledError:
+            await self._fail(batch_id, "服务停止，任务中断")
+            raise
+        except Exception as e:
+            print(f"[卡密生成] 批次{batch_id}失败: {e}")
+            await self._fail(batch_id, str(e))
+
+    async def _fail(self, batch_id: str, error: str):
+        self.jobs_failed += 1
+        now = datetime.utcnow()
+        try:
+            async with async_session() as db:
+                await db.execute(
+                    update(CardBatch)
+                    .where(CardBatch.id == batch_id)
+                    .values(status="failed", error=error[:255], updated_at=now, finished_at=now)
+                )
+                await db.commit()
+        except Exception as e:
+            print(f"[卡密生成] 记录批次{batch_id}失败状态出错: {e}")
+
+    @staticmethod
+    def describe(batch: CardBatch) -> CardBatchResponse:
+        """批次状态；长时间没有进度的未完成批次报告为失败"""
+        response = CardBatchResponse.model_validate(batch)
+        if batch.status in ("pending", "running") and \
+                batch.updated_at < datetime.utcnow() - timedelta(seconds=STALE_AFTER):
+            response.status = "failed"
+            response.error = "任务中断"
+        return response
+
+    async def stop(self):
+        """取消仍在运行的后台任务（已提交的卡密保留，批次标记为失败）"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "running_jobs": len(self._tasks),
+            "max_jobs": self.max_jobs,
+            "batch_size": self.batch_size,
+            "issued": self.issued,
+            "duplicates": self.duplicates,
+            "conflicts": self.conflicts,
+            "jobs_started": self.jobs_started,
+            "jobs_completed": self.jobs_completed,
+            "jobs_failed": self.jobs_failed,
+        }
+
+
+card_issuer = CardIssuer(
+    batch_size=settings.CARD_INSERT_BATCH_SIZE,
+    max_jobs=settings.CARD_ISSUE_MAX_JOBS
+)
@@ -0,0 +1,177 @@
+"""
+卡密搜索模块
+搜索关键词与激活卡密时一样去掉空格和横线并转为大写，在去掉横线的卡密上做子串匹配，
+由三元组索引找出候选卡密，不再对整张表执行LIKE '%keyword%'：
+  - PostgreSQL: replace(card_key, '-', '')上的pg_trgm GIN表达式索引
+  - SQLite: FTS5 trigram分词的card_key_search表，由触发器与cards表同步
+少于3个字符的片段无法使用三元组索引，仍按顺序扫描（片段越短匹配越密集，取满一页很快）；
+数据库不支持时（无法安装pg_trgm、SQLite未编译FTS5）同样退回扫描
+PostgreSQL上的索引在后台用CREATE INDEX CONCURRENTLY创建，不阻塞启动和cards表写入，由取得租约的一个worker执行
+"""
+
+import asyncio
+import re
+from typing import Optional
+from sqlalchemy import and_, false, func, literal_column, select, table, text, true
+from sqlalchemy.exc import DBAPIError
+from app.database import engine
+from app.leases import Lease
+from app.models import Card
+
+# 三元组索引可用的最短片段
+MIN_INDEXED_LENGTH = 3
+
+_FRAGMENT = re.compile(r"[A-Z0-9]*")
+
+# 去掉横线的卡密；参数直接写在SQL中，与表达式索引的定义一致时才能使用索引
+_COMPACT_KEY = func.replace(Card.card_key, literal_column("'-'"), literal_column("''"))
+
+_SQLITE_SETUP = (
+    "CREATE VIRTUAL TABLE card_key_search USING fts5(card_key, tokenize='trigram')",
+    """CREATE TRIGGER card_key_search_insert AFTER INSERT ON cards BEGIN
+        INSERT INTO card_key_search(rowid, card_key) VALUES (new.id, replace(new.card_key, '-', ''));
+    END""",
+    """CREATE TRIGGER card_key_search_delete AFTER DELETE ON cards BEGIN
+        DELETE FROM card_key_search WHERE rowid = old.id;
+    END""",
+    "INSERT INTO card_key_search(rowid, card_key) SELECT id, replace(card_key, '-', '') FROM cards",
+)
+
+_PG_INDEX = "ix_cards_key_trgm"
+_PG_CREATE_INDEX = (
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_PG_INDEX} "
+    "ON cards USING gin (replace(card_key, '-', '') gin_trgm_ops)"
+)
+# 索引是否存在且可用：None为不存在，False为创建中或上次并发创建失败留下的无效索引
+_PG_INDEX_VALID = f"""SELECT i.indisvalid FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = '{_PG_INDEX}'"""
+
+# 创建索引的租约期限（秒），创建期间每隔三分之一期限续期
+INDEX_LEASE_TTL = 300
+# 未取得租约的worker检查索引是否已建好的间隔（秒）
+INDEX_POLL_INTERVAL = 30
+
+
+def compact_card_key(value: str) -> str:
+    """去掉空格和横线并转为大写（与激活卡密时的处理一致）"""
+    return value.upper().replace(" ", "").replace("-", "")
+
+
+class CardSearch:
+    """卡密片段搜索"""
+
+    def __init__(self):
+        self.backend = "scan"
+        self.lease = Lease("card_search_index", INDEX_LEASE_TTL)
+        self._task: Optional[asyncio.Task] = None
+        # 统计计数
+        self.indexed = 0
+        self.scanned = 0
+
+    async def _pg_index_valid(self) -> Optional[bool]:
+        async with engine.connect() as conn:
+            return await conn.scalar(text(_PG_INDEX_VALID))
+
+    async def _renew_lease(self):
+        while True:
+            await asyncio.sleep(INDEX_LEASE_TTL / 3)
+            await self.lease.acquire()
+
+    async def _create_pg_index(self, valid: Optional[bool]):
+        """在autocommit连接上并发创建索引（CONCURRENTLY不能在事务中执行）"""
+        renew = asyncio.create_task(self._renew_lease())
+        try:
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                if valid is False:
+                    # 持有租约时不会有其他worker正在创建，无效索引是上次失败留下的，删除后重建
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {_PG_INDEX}"))
+                print("[卡密搜索] 开始创建pg_trgm索引")
+                await conn.execute(text(_PG_CREATE_INDEX))
+                print("[卡密搜索] 已创建pg_trgm索引")
+        finally:
+            renew.cancel()
+
+    async def _ensure_pg_index(self):
+        """索引建好前关键词搜索扫描全表；取得租约的worker创建索引，其他worker定期检查"""
+        while True:
+            try:
+                valid = await self._pg_index_valid()
+                if valid:
+                    self.backend = "trgm"
+                    return
+                if await self.lease.acquire():
+                    await self._create_pg_index(valid)
+                    continue
+            except DBAPIError as e:
+                print(f"[卡密搜索] 创建pg_trgm索引失败: {e.orig}")
+            await asyncio.sleep(INDEX_POLL_INTERVAL)
+
+    async def prepare(self):
+        """启动时创建搜索索引（已存在则跳过），失败时退回扫描"""
+        async with engine.begin() as conn:
+            dialect = conn.dialect.name
+            if dialect == "postgresql":
+                try:
+                    async with conn.begin_nested():
+                        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                except DBAPIError as e:
+                    # 多个worker同时安装时可能冲突，以扩展是否已存在为准
+                    if not await conn.scalar(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")):
+                        print(f"[卡密搜索] 无法安装pg_trgm，关键词搜索将扫描全表: {e.orig}")
+                        return
+                self._task = asyncio.create_task(self._ensure_pg_index())
+            elif dialect == "sqlite":
+                exists = await conn.scalar(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'card_key_search'")
+                )
+                try:
+                    if not exists:
+                        async with conn.begin_nested():
+                            for statement in _SQLITE_SETUP:
+                                await conn.execute(text(statement))
+                        print("[卡密搜索] 已创建卡密搜索索引")
+                    self.backend = "fts"
+                except DBAPIError as e:
+                    print(f"[卡密搜索] 无法创建FTS5索引，关键词搜索将扫描全表: {e.orig}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def keyword_filter(self, keyword: str):
+        """关键词对应的过滤条件"""
+        fragment = compact_card_key(keyword)
+        if not fragment:
+            return true()
+        if not _FRAGMENT.fullmatch(fragment):
+            # 卡密只包含大写字母和数字
+            return false()
+        condition = _COMPACT_KEY.like(f"%{fragment}%")
+        if len(fragment) < MIN_INDEXED_LENGTH or self.backend == "scan":
+            self.scanned += 1
+            return condition
+        self.indexed += 1
+        if self.backend == "fts":
+            matches = select(literal_column("rowid")).select_from(table("card_key_search")).where(
+                literal_column("card_key").like(f"%{fragment}%")
+            )
+            return and_(Card.id.in_(matches), condition)
+        return condition
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "indexed": self.indexed,
+            "scanned": self.scanned,
+            "lease": self.lease.stats(),
+        }
+
+
+card_search = CardSearch()
@@ -12,27 +12,106 @@ class Settings(BaseSettings):
     SECRET_KEY: str = os.getenv("SECRET_KEY", secrets.token_urlsafe(32))
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 7  # 7天
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "12"))  # bcrypt计算成本（新密码生效）
+    BCRYPT_WORKERS: int = int(os.getenv("BCRYPT_WORKERS", "2"))  # 每个worker执行bcrypt的线程数
+    BCRYPT_MAX_QUEUE: int = int(os.getenv("BCRYPT_MAX_QUEUE", "16"))  # 排队等待的密码计算上限，超出返回503
+    PRINCIPAL_CACHE_MAX_SIZE: int = int(os.getenv("PRINCIPAL_CACHE_MAX_SIZE", "1000"))  # 已认证用户缓存条数上限
+    PRINCIPAL_CACHE_TTL: float = float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))  # 缓存有效期（秒），未配置Redis时也是其他worker的最长生效延迟
     
     # 速率限制
     RATE_LIMIT_PER_MINUTE: int = int(os.getenv("RATE_LIMIT_PER_MINUTE", "200"))
     RATE_LIMIT_PER_SECOND: int = int(os.getenv("RATE_LIMIT_PER_SECOND", "10"))
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "auto")  # auto: 有REDIS_URL用redis否则memory, redis, shm: 单机共享内存, memory: 进程内
+    RATE_LIMIT_SHM_PATH: str = os.getenv("RATE_LIMIT_SHM_PATH", "/dev/shm/heartbeat_ratelimit")  # shm后端的共享内存文件
+    RATE_LIMIT_SHM_SLOTS: int = int(os.getenv("RATE_LIMIT_SHM_SLOTS", "65536"))  # shm后端的槽位数（每个限流键占一个）
+    RATE_LIMIT_LOCAL_MAX_KEYS: int = int(os.getenv("RATE_LIMIT_LOCAL_MAX_KEYS", "100000"))  # 进程内预检查的键数上限
     
     # 安全：允许的域名和主机
     ALLOWED_ORIGINS: str = os.getenv("ALLOWED_ORIGINS", "*")
     ALLOWED_HOSTS: str = os.getenv("ALLOWED_HOSTS", "*")
+    # 可信反向代理（IP或网段，逗号分隔）：只有来自这些地址的连接才采用X-Forwarded-For/X-Real-IP
+    TRUSTED_PROXIES: str = os.getenv("TRUSTED_PROXIES", "127.0.0.1,::1,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16")
     
     # 数据库配置
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./heartbeat.db")
     REDIS_URL: str = os.getenv("REDIS_URL", "")  # 可选Redis缓存
+    REDIS_PREFIX: str = os.getenv("REDIS_PREFIX", "heartbeat:")  # Redis键前缀
     
     # 心跳配置
     HEARTBEAT_INTERVAL: int = 60  # 心跳间隔（秒）
     HEARTBEAT_TIMEOUT: int = 180  # 心跳超时（秒）
+    HEARTBEAT_BATCH_MAX_SIZE: int = int(os.getenv("HEARTBEAT_BATCH_MAX_SIZE", "1000"))  # 批量心跳单次最大条数
     MAX_DEVICES: int = 1  # 默认最大设备数
-    
+    DEVICE_TOKEN_FORMAT: str = os.getenv("DEVICE_TOKEN_FORMAT", "opaque")  # opaque: 随机令牌, signed: 签名令牌
+    DEVICE_TOKEN_KEY_SOURCE: str = os.getenv("DEVICE_TOKEN_KEY_SOURCE", "app")  # app: 使用app_secret签名, global: 使用SECRET_KEY签名
+
+    # 心跳节奏（服务端下发下次心跳间隔）
+    HEARTBEAT_INTERVAL_MAX: int = int(os.getenv("HEARTBEAT_INTERVAL_MAX", "600"))  # 负载拉长后的最大间隔（秒）
+    HEARTBEAT_INTERVAL_MAX_STRETCH: float = float(os.getenv("HEARTBEAT_INTERVAL_MAX_STRETCH", "5"))  # 负载过高时最多拉长的倍数
+    HEARTBEAT_INTERVAL_JITTER: float = float(os.getenv("HEARTBEAT_INTERVAL_JITTER", "0.1"))  # 随机抖动占间隔的比例
+    HEARTBEAT_LOOP_LAG_THRESHOLD: float = float(os.getenv("HEARTBEAT_LOOP_LAG_THRESHOLD", "0.05"))  # 事件循环延迟超过该值（秒）开始拉长
+    HEARTBEAT_POOL_USAGE_THRESHOLD: float = float(os.getenv("HEARTBEAT_POOL_USAGE_THRESHOLD", "0.8"))  # 连接池占用超过该比例开始拉长
+    HEARTBEAT_LOAD_PROBE_INTERVAL: float = float(os.getenv("HEARTBEAT_LOAD_PROBE_INTERVAL", "0.5"))  # 负载采样间隔（秒）
+
+    # 心跳日志写缓冲
+    LOG_BUFFER_MAX_SIZE: int = int(os.getenv("LOG_BUFFER_MAX_SIZE", "100000"))  # 队列上限，超出丢弃
+    LOG_BUFFER_BATCH_SIZE: int = int(os.getenv("LOG_BUFFER_BATCH_SIZE", "1000"))  # 每批写入条数
+    LOG_BUFFER_FLUSH_INTERVAL: float = float(os.getenv("LOG_BUFFER_FLUSH_INTERVAL", "2"))  # 刷新间隔（秒）
+    HEARTBEAT_LOG_SAMPLE_RATE: float = float(os.getenv("HEARTBEAT_LOG_SAMPLE_RATE", "0.01"))  # 成功心跳保留明细的比例，失败心跳全部保留
+
+    # 心跳日志保留与清理
+    HEARTBEAT_LOG_RETENTION_DAYS: int = int(os.getenv("HEARTBEAT_LOG_RETENTION_DAYS", "30"))  # 明细保留天数，0为不清理
+    HEARTBEAT_ROLLUP_RETENTION_DAYS: int = int(os.getenv("HEARTBEAT_ROLLUP_RETENTION_DAYS", "365"))  # 分钟汇总保留天数，0为不清理
+    HEARTBEAT_LOG_PRUNE_BATCH_SIZE: int = int(os.getenv("HEARTBEAT_LOG_PRUNE_BATCH_SIZE", "5000"))  # 每批删除条数
+    HEARTBEAT_LOG_PRUNE_INTERVAL: float = float(os.getenv("HEARTBEAT_LOG_PRUNE_INTERVAL", "3600"))  # 清理间隔（秒）
+    HEARTBEAT_LOG_PARTITIONING: bool = os.getenv("HEARTBEAT_LOG_PARTITIONING", "false").lower() == "true"  # PostgreSQL按天分区（仅新建表时生效）
+    HEARTBEAT_LOG_PARTITIONS_AHEAD: int = int(os.getenv("HEARTBEAT_LOG_PARTITIONS_AHEAD", "3"))  # 提前创建的分区天数
+
+    # 设备心跳时间合并写入
+    DEVICE_UPDATE_FLUSH_INTERVAL: float = float(os.getenv("DEVICE_UPDATE_FLUSH_INTERVAL", "5"))  # 批量更新间隔（秒）
+    DEVICE_UPDATE_MAX_STALENESS: float = float(os.getenv("DEVICE_UPDATE_MAX_STALENESS", "15"))  # 数据库中心跳时间的最大延迟（秒）
+    DEVICE_UPDATE_MAX_PENDING: int = int(os.getenv("DEVICE_UPDATE_MAX_PENDING", "50000"))  # 待写入设备数上限，达到即提前刷新
+
+    # 卡密批量生成
+    CARD_MAX_COUNT: int = int(os.getenv("CARD_MAX_COUNT", "1000000"))  # 单次生成数量上限
+    CARD_SYNC_MAX_COUNT: int = int(os.getenv("CARD_SYNC_MAX_COUNT", "10000"))  # 直接返回结果的数量上限，超出转为后台任务
+    CARD_INSERT_BATCH_SIZE: int = int(os.getenv("CARD_INSERT_BATCH_SIZE", "2000"))  # 每条INSERT写入的卡密数
+    CARD_ISSUE_MAX_JOBS: int = int(os.getenv("CARD_ISSUE_MAX_JOBS", "2"))  # 每个worker同时运行的后台生成任务数，超出返回503
+    CARD_COUNT_CACHE_MAX_SIZE: int = int(os.getenv("CARD_COUNT_CACHE_MAX_SIZE", "10000"))  # 卡密列表总数缓存的过滤组合数上限
+    CARD_COUNT_CACHE_TTL: float = float(os.getenv("CARD_COUNT_CACHE_TTL", "30"))  # 卡密列表总数缓存时间（秒）
+    EXPORT_CHUNK_SIZE: int = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))  # 流式导出每批读取的行数
+
+    # 仪表盘统计计数
+    STATS_FLUSH_INTERVAL: float = float(os.getenv("STATS_FLUSH_INTERVAL", "2"))  # 计数变化合并写入间隔（秒）
+    STATS_EXPIRY_INTERVAL: float = float(os.getenv("STATS_EXPIRY_INTERVAL", "60"))  # 扣减到期设备的间隔（秒）
+    STATS_RECONCILE_INTERVAL: float = float(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))  # 按实际数据校正计数的间隔（秒）
+
+    # 应用信息缓存
+    APP_CACHE_MAX_SIZE: int = int(os.getenv("APP_CACHE_MAX_SIZE", "10000"))
+    APP_CACHE_TTL: float = float(os.getenv("APP_CACHE_TTL", "300"))  # 缓存有效期（秒）
+    APP_CACHE_NEGATIVE_TTL: float = float(os.getenv("APP_CACHE_NEGATIVE_TTL", "60"))  # 不存在的app_key缓存时间（秒）
+
+    # 仪表盘响应缓存
+    DASHBOARD_CACHE_MAX_SIZE: int = int(os.getenv("DASHBOARD_CACHE_MAX_SIZE", "1000"))  # 缓存条数上限
+    DASHBOARD_CACHE_TTL: float = float(os.getenv("DASHBOARD_CACHE_TTL", "5"))  # 缓存时间（秒）
+
+    # 设备在线状态（仪表盘在线设备列表）
+    PRESENCE_BACKEND: str = os.getenv("PRESENCE_BACKEND", "auto")  # auto: 有REDIS_URL用redis，否则单worker用memory、多worker用sql, redis: 未连接Redis时同auto, memory: 进程内（单worker）, sql: 查询devices表
+    PRESENCE_FLUSH_INTERVAL: float = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "2"))  # 写入Redis、淘汰超时设备的间隔（秒）
+
+    # 设备授权缓存（配置REDIS_URL时各worker共享，多worker且未配置时不缓存）
+    AUTH_CACHE_MAX_SIZE: int = int(os.getenv("AUTH_CACHE_MAX_SIZE", "100000"))  # 本地缓存条数上限
+    AUTH_CACHE_TTL: float = float(os.getenv("AUTH_CACHE_TTL", "300"))  # 缓存有效期（秒）
+    REVOCATION_RELOAD_INTERVAL: float = float(os.getenv("REVOCATION_RELOAD_INTERVAL", "5"))  # 多worker且未配置REDIS_URL时，从数据库重新加载已禁用设备的间隔（秒）
+
     # 安全：失败尝试限制
     MAX_FAILED_ATTEMPTS: int = int(os.getenv("MAX_FAILED_ATTEMPTS", "10"))
-    BLOCK_DURATION: int = int(os.getenv("BLOCK_DURATION", "3600"))  # 封禁时长（秒）
+    BLOCK_DURATION: int = int(os.getenv("BLOCK_DURATION", "3600"))  # 封禁时长（秒），也是失败计数窗口
+    NONCE_EXPIRY: int = int(os.getenv("NONCE_EXPIRY", "300"))  # Nonce有效期（秒）
+    NONCE_BUCKETS: int = int(os.getenv("NONCE_BUCKETS", "30"))  # 有效期内的时间分桶数
+    NONCE_CACHE_MAX_SIZE: int = int(os.getenv("NONCE_CACHE_MAX_SIZE", "1000000"))  # 本地Nonce条数上限
+    NONCE_MAX_LENGTH: int = int(os.getenv("NONCE_MAX_LENGTH", "128"))  # Nonce最大长度
+    IP_REPUTATION_MAX_ENTRIES: int = int(os.getenv("IP_REPUTATION_MAX_ENTRIES", "100000"))  # 失败计数表和封禁表各自的条目上限
     
     # 管理员配置
     ADMIN_USERNAME: str = os.getenv("ADMIN_USERNAME", "admin")
@@ -43,10 +122,16 @@ class Settings(BaseSettings):
     # 服务器配置
     HOST: str = "0.0.0.0"
     PORT: int = int(os.getenv("PORT", "8000"))
+    WORKERS: int = int(os.getenv("WEB_CONCURRENCY", "1"))  # worker进程数（与uvicorn/gunicorn读取同一环境变量），多worker时不使用只有本进程数据的后端
     
     # 日志配置
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
     
+    # 运行指标（/metrics）
+    METRICS_DIR: str = os.getenv("METRICS_DIR", "")  # 多worker指标快照目录，为空时只输出当前进程
+    METRICS_FLUSH_INTERVAL: float = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))  # 快照写入间隔（秒）
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")  # 设置后访问/metrics需携带Authorization: Bearer <token>
+    
     class Config:
         env_file = ".env"
 
@@ -1,11 +1,15 @@
+from sqlalchemy import inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.config import settings
 
 # 连接池配置：支持高并发
+# aiosqlite文件数据库在SQLAlchemy 2.0.38之前默认使用NullPool，不接受连接池参数，这里显式指定连接池
 engine = create_async_engine(
     settings.DATABASE_URL,
     echo=settings.DEBUG,
+    poolclass=AsyncAdaptedQueuePool,
     pool_size=20,           # 连接池大小
     max_overflow=30,        # 最大溢出连接数
     pool_pre_ping=True,     # 连接前检查有效性
@@ -21,6 +25,50 @@ async def get_db():
         finally:
             await session.close()
 
+# 已不再使用的索引，启动时删除（只增加写入开销）
+_RETIRED_INDEXES = (
+    "ix_cards_type_created",
+    "ix_cards_creator_type_created",
+    "ix_cards_creator_app_created",
+)
+
+def _create_missing_indexes(conn):
+    """create_all不会给已存在的表补建索引，这里逐个检查创建"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+def _drop_retired_indexes(conn):
+    for name in _RETIRED_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+def _add_missing_columns(conn):
+    """create_all不会给已存在的表补加列，这里为新增的列执行ALTER TABLE（新增列须可空或带server_default）"""
+    inspector = inspect(conn)
+    quote = conn.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column.type.compile(conn.dialect)}"
+            if column.server_default is not None:
+                default = column.server_default.arg
+                ddl += f" DEFAULT {getattr(default, 'text', default)}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            conn.execute(text(ddl))
+            # 已有行的取值由info["backfill"]中的SQL表达式计算
+            backfill = column.info.get("backfill")
+            if backfill:
+                conn.execute(text(f"UPDATE {quote(table.name)} SET {quote(column.name)} = {backfill}"))
+            print(f"[数据库] 已为{table.name}补加列{column.name}")
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
+        await conn.run_sync(_drop_retired_indexes)
@@ -0,0 +1,173 @@
+"""
+设备签名令牌模块
+签名令牌（v1.）内含设备记录ID、应用ID、设备标识哈希和到期时间，并用HMAC签名，
+心跳时仅靠CPU即可校验真伪与有效期；旧的随机令牌仍走数据库校验
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import struct
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.database import async_session
+from app.models import Device
+
+TOKEN_PREFIX = "v1."
+EPOCH = datetime(1970, 1, 1)
+SIGNATURE_SIZE = 16
+
+# 设备记录ID、应用ID、到期时间（秒）、设备标识哈希
+_PAYLOAD = struct.Struct(">QIQ8s")
+
+
+@dataclass(frozen=True)
+class DeviceLease:
+    """签名令牌中携带的授权信息"""
+    device_pk: int
+    application_id: int
+    expires_at: datetime
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _device_hash(device_id: str) -> bytes:
+    return hashlib.sha256(device_id.encode("utf-8")).digest()[:8]
+
+
+def signing_key(app_secret: str) -> bytes:
+    """签名密钥：默认使用应用的app_secret，可配置为全局SECRET_KEY"""
+    if settings.DEVICE_TOKEN_KEY_SOURCE == "global":
+        return settings.SECRET_KEY.encode("utf-8")
+    return app_secret.encode("utf-8")
+
+
+def _sign(payload: bytes, key: bytes) -> bytes:
+    return hmac.new(key, payload, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+
+def is_signed_token(token: str) -> bool:
+    """是否为签名令牌"""
+    return token.startswith(TOKEN_PREFIX)
+
+
+def issue_token(device_pk: int, application_id: int, device_id: str, expires_at: datetime, key: bytes) -> str:
+    """签发设备令牌"""
+    expires_ts = int((expires_at - EPOCH).total_seconds())
+    payload = _PAYLOAD.pack(device_pk, application_id, expires_ts, _device_hash(device_id))
+    return f"{TOKEN_PREFIX}{_b64encode(payload)}.{_b64encode(_sign(payload, key))}"
+
+
+def verify_token(token: str, application_id: int, device_id: str, key: bytes) -> Optional[DeviceLease]:
+    """校验签名令牌，伪造或与应用/设备不匹配时返回None（不检查是否过期）"""
+    try:
+        payload_b64, signature_b64 = token[len(TOKEN_PREFIX):].split(".", 1)
+        payload = _b64decode(payload_b64)
+        signature = _b64decode(signature_b64)
+        device_pk, app_id, expires_ts, device_hash = _PAYLOAD.unpack(payload)
+    except (ValueError, struct.error):
+        return None
+
+    if not hmac.compare_digest(signature, _sign(payload, key)):
+        return None
+    if app_id != application_id or not hmac.compare_digest(device_hash, _device_hash(device_id)):
+        return None
+
+    return DeviceLease(
+        device_pk=device_pk,
+        application_id=app_id,
+        expires_at=EPOCH + timedelta(seconds=expires_ts)
+    )
+
+
+class RevocationList:
+    """已禁用设备的吊销表，令牌到期后条目自动失效
+    吊销消息只能通过Redis广播到其他worker；多worker且未配置Redis时，按固定间隔从数据库重新加载
+    """
+
+    def __init__(self):
+        self._revoked: Dict[int, datetime] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.reloads = 0
+
+    def revoke(self, device_pk: int, expires_at: datetime):
+        self.purge()
+        self._revoked[device_pk] = expires_at
+
+    def restore(self, device_pk: int):
+        self._revoked.pop(device_pk, None)
+
+    def on_revoke(self, payload: str):
+        """处理其他worker广播的吊销消息，格式: 设备ID|到期时间戳"""
+        device_pk, expires_ts = payload.split("|")
+        self.revoke(int(device_pk), EPOCH + timedelta(seconds=int(expires_ts)))
+
+    def on_restore(self, payload: str):
+        """处理其他worker广播的恢复消息，格式: 设备ID"""
+        self.restore(int(payload))
+
+    def is_revoked(self, device_pk: int) -> bool:
+        return device_pk in self._revoked
+
+    def purge(self, now: Optional[datetime] = None):
+        """清除已过期的条目（过期令牌本身已无法通过校验）"""
+        now = now or datetime.utcnow()
+        expired = [pk for pk, expires_at in self._revoked.items() if expires_at < now]
+        for pk in expired:
+            del self._revoked[pk]
+
+    async def load(self, db: AsyncSession):
+        """启动时从数据库加载未过期的已禁用设备"""
+        now = datetime.utcnow()
+        result = await db.execute(
+            select(Device.id, Device.expires_at).where(
+                Device.is_active == False,
+                Device.expires_at > now
+            )
+        )
+        self._revoked = {row.id: row.expires_at for row in result}
+
+    async def reload(self):
+        async with async_session() as db:
+            await self.load(db)
+        self.reloads += 1
+
+    async def _poll(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                print(f"[吊销表] 重新加载失败: {e}")
+
+    def start(self, interval: float):
+        """定期重新加载吊销表，interval为0时不启动"""
+        if self._task is not None or interval <= 0:
+            return
+        self._task = asyncio.create_task(self._poll(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+
+revoked_devices = RevocationList()
@@ -0,0 +1,128 @@
+"""
+设备在线状态合并写入模块
+心跳只在内存中记录每台设备最新的心跳时间和IP，由后台任务定期一次性批量UPDATE，
+避免每次心跳都对devices表做一次行级更新
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from sqlalchemy import update, values, column, Integer, DateTime, String
+from app.config import settings
+from app.database import async_session
+from app.models import Device
+
+
+class DeviceUpdateCoalescer:
+    """按Device.id合并last_heartbeat/ip_address更新"""
+
+    def __init__(self, flush_interval: float, max_staleness: float, max_pending: int):
+        # 实际刷新间隔不超过允许的最大延迟
+        self.flush_interval = min(flush_interval, max_staleness)
+        self.max_staleness = max_staleness
+        self.max_pending = max_pending
+        self._pending: Dict[int, Tuple[datetime, Optional[str]]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._lock = asyncio.Lock()
+        # 统计计数
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def touch(self, device_pk: int, last_heartbeat: datetime, ip_address: Optional[str]):
+        """记录一次心跳，同一设备只保留最新值"""
+        if device_pk in self._pending:
+            self.coalesced += 1
+        self._pending[device_pk] = (last_heartbeat, ip_address)
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    def pending(self, device_pk: int) -> Optional[Tuple[datetime, Optional[str]]]:
+        """获取尚未写入数据库的最新心跳"""
+        return self._pending.get(device_pk)
+
+    async def flush(self) -> int:
+        """把合并后的更新一次性写入数据库，返回更新的设备数"""
+        async with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            rows = [(pk, ts, ip) for pk, (ts, ip) in batch.items()]
+            try:
+                async with async_session() as db:
+                    if db.bind.dialect.name == "postgresql":
+                        # UPDATE ... FROM (VALUES ...) 单条语句完成
+                        data = values(
+                            column("id", Integer),
+                            column("ts", DateTime),
+                            column("ip", String),
+                            name="v"
+                        ).data(rows)
+                        await db.execute(
+                            update(Device)
+                            .where(Device.id == data.c.id)
+                            .values(last_heartbeat=data.c.ts, ip_address=data.c.ip)
+                        )
+                    else:
+                        # SQLite不支持VALUES列别名，按主键批量更新
+                        await db.execute(
+                            update(Device),
+                            [{"id": pk, "last_heartbeat": ts, "ip_address": ip} for pk, ts, ip in rows]
+                        )
+                    await db.commit()
+            except Exception as e:
+                # 写入失败时放回队列，保留期间产生的更新的新值
+                for pk, value in batch.items():
+                    self._pending.setdefault(pk, value)
+                self.failed += len(rows)
+                print(f"[在线状态] 批量更新失败: {e}")
+                return 0
+            self.written += len(rows)
+            self.flushes += 1
+            return len(rows)
+
+    async def _run(self):
+        """后台刷新循环"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        """启动后台刷新任务"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务并写入剩余更新"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        """待写入数量与计数"""
+        return {
+            "pending": len(self._pending),
+            "max_staleness": self.max_staleness,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "failed": self.failed,
+            "flushes": self.flushes,
+        }
+
+
+device_updates = DeviceUpdateCoalescer(
+    flush_interval=settings.DEVICE_UPDATE_FLUSH_INTERVAL,
+    max_staleness=settings.DEVICE_UPDATE_MAX_STALENESS,
+    max_pending=settings.DEVICE_UPDATE_MAX_PENDING
+)
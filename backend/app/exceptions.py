@@ -34,3 +34,8 @@ class RateLimitError(AppException):
     """频率限制"""
     def __init__(self, detail: str = "请求过于频繁，请稍后再试"):
         super().__init__(detail=detail, status_code=status.HTTP_429_TOO_MANY_REQUESTS)
+
+class ServiceUnavailableError(AppException):
+    """服务暂不可用"""
+    def __init__(self, detail: str = "服务器繁忙，请稍后再试"):
+        super().__init__(detail=detail, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
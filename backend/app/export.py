@@ -0,0 +1,87 @@
+"""
+流式导出模块
+查询结果通过stream()按yield_per分批读取（PostgreSQL使用服务端游标），
+每批编码成CSV、NDJSON或JSON数组片段后立即写入响应，可选边编码边gzip压缩，
+内存占用只与批大小有关，与导出总行数无关
+"""
+
+import csv
+import enum
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Callable, Iterable, List, Sequence
+from sqlalchemy import Select
+from app.config import settings
+from app.database import async_session
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    raise TypeError(f"无法序列化: {type(value).__name__}")
+
+
+async def stream_rows(query: Select, chunk_size: int = settings.EXPORT_CHUNK_SIZE) -> AsyncIterator[List[dict]]:
+    """分批读取查询结果（使用独立会话，响应发送期间一直持有连接）"""
+    async with async_session() as db:
+        result = await db.stream(query.execution_options(yield_per=chunk_size))
+        keys = list(result.keys())
+        async for partition in result.partitions():
+            yield [dict(zip(keys, row)) for row in partition]
+
+
+async def iterate_chunks(chunks: Iterable[List[dict]]) -> AsyncIterator[List[dict]]:
+    """把已在内存中的分批记录作为异步迭代器输出"""
+    for rows in chunks:
+        yield rows
+
+
+async def json_array(chunks: AsyncIterator[List[dict]]) -> AsyncIterator[str]:
+    """把逐批产生的记录输出为一个JSON数组"""
+    yield "["
+    first = True
+    async for rows in chunks:
+        if not rows:
+            continue
+        body = json.dumps(rows, ensure_ascii=False, default=_json_default)[1:-1]
+        yield body if first else "," + body
+        first = False
+    yield "]"
+
+
+async def ndjson_lines(chunks: AsyncIterator[List[dict]]) -> AsyncIterator[str]:
+    """每条记录输出为一行JSON"""
+    async for rows in chunks:
+        if rows:
+            yield "".join(json.dumps(row, ensure_ascii=False, default=_json_default) + "\n" for row in rows)
+
+
+async def csv_lines(
+    chunks: AsyncIterator[List[dict]],
+    header: Sequence[str],
+    to_row: Callable[[dict], Sequence]
+) -> AsyncIterator[str]:
+    """输出CSV：先输出表头，之后每批记录由to_row转换成一组CSV行"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield buffer.getvalue()
+    async for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(to_row(row) for row in rows)
+        yield buffer.getvalue()
+
+
+async def gzip_stream(chunks: AsyncIterator[str], level: int = 6) -> AsyncIterator[bytes]:
+    """边编码边压缩为gzip格式"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,53 @@
+"""
+HyperLogLog基数估计
+用固定大小的寄存器估计不同元素的个数，内存不随元素数量增长；
+两个草图按寄存器取最大值即可合并，合并结果等于对两组元素的并集做估计（多worker的分钟汇总据此去重）
+"""
+
+import hashlib
+import math
+from typing import Optional
+
+# 2^10个寄存器，每个1字节，标准误差约1.04/sqrt(1024) ≈ 3.3%
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+_RANK_BITS = 64 - PRECISION
+_ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """基数估计草图"""
+
+    __slots__ = ("registers",)
+
+    def __init__(self, registers: Optional[bytes] = None):
+        if registers is not None and len(registers) != REGISTERS:
+            raise ValueError("寄存器数量不匹配")
+        self.registers = bytearray(registers) if registers is not None else bytearray(REGISTERS)
+
+    def add(self, value: str):
+        h = _hash(value)
+        index = h >> _RANK_BITS
+        rest = h & ((1 << _RANK_BITS) - 1)
+        # 剩余位中第一个1出现的位置（从1开始）
+        rank = _RANK_BITS - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self) -> int:
+        estimate = _ALPHA * REGISTERS * REGISTERS / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * REGISTERS and zeros:
+            # 小基数时改用线性计数，结果接近精确值
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return round(estimate)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
@@ -0,0 +1,100 @@
+"""
+IP信誉模块
+记录各IP的失败次数和封禁状态，条目数有上限并按时间自动过期。
+失败计数窗口和封禁时长都是固定值，按插入顺序排列即按过期时间排列，
+因此用有序字典作为过期队列：过期清理只需从队首弹出，查询和更新均为O(1)
+"""
+
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from app.config import settings
+
+
+class IPReputation:
+    """失败次数与封禁表（单进程，供事件循环内使用）"""
+
+    def __init__(self, max_failures: int, block_duration: float, max_entries: int):
+        self.max_failures = max_failures
+        self.block_duration = block_duration
+        self.max_entries = max_entries
+        # ip -> [窗口开始时间, 失败次数]，按窗口开始时间排列
+        self._failures: "OrderedDict[str, List]" = OrderedDict()
+        # ip -> 解封时间，按封禁时间排列
+        self._blocked: "OrderedDict[str, float]" = OrderedDict()
+        # 统计计数
+        self.blocks = 0
+        self.evicted = 0
+
+    def _expire(self, now: float):
+        """从队首弹出已过期的条目，均摊O(1)"""
+        window_start = now - self.block_duration
+        failures = self._failures
+        while failures and next(iter(failures.values()))[0] <= window_start:
+            failures.popitem(last=False)
+        blocked = self._blocked
+        while blocked and next(iter(blocked.values())) <= now:
+            blocked.popitem(last=False)
+
+    def is_blocked(self, ip: str) -> bool:
+        """检查IP是否被封禁"""
+        until = self._blocked.get(ip)
+        if until is None:
+            return False
+        if until > time.time():
+            return True
+        del self._blocked[ip]
+        return False
+
+    def record_failure(self, ip: str, now: Optional[float] = None) -> Optional[float]:
+        """记录一次失败，达到阈值时封禁并返回解封时间"""
+        now = now or time.time()
+        self._expire(now)
+        entry = self._failures.get(ip)
+        if entry is None:
+            entry = self._failures[ip] = [now, 0]
+            if len(self._failures) > self.max_entries:
+                self._failures.popitem(last=False)
+                self.evicted += 1
+        entry[1] += 1
+        if entry[1] < self.max_failures:
+            return None
+        del self._failures[ip]
+        until = now + self.block_duration
+        self.block(ip, until)
+        self.blocks += 1
+        return until
+
+    def block(self, ip: str, until: float):
+        """封禁IP到指定时间"""
+        self._blocked[ip] = until
+        self._blocked.move_to_end(ip)
+        if len(self._blocked) > self.max_entries:
+            self._blocked.popitem(last=False)
+            self.evicted += 1
+
+    def clear(self, ip: str):
+        """清除失败记录"""
+        self._failures.pop(ip, None)
+
+    def on_block(self, payload: str):
+        """处理其他worker广播的封禁消息，格式: IP|解封时间戳"""
+        ip, until = payload.rsplit("|", 1)
+        self.block(ip, float(until))
+
+    def stats(self) -> dict:
+        self._expire(time.time())
+        return {
+            "tracked": len(self._failures),
+            "blocked": len(self._blocked),
+            "max_entries": self.max_entries,
+            "blocks": self.blocks,
+            "evicted": self.evicted,
+        }
+
+
+ip_reputation = IPReputation(
+    max_failures=settings.MAX_FAILED_ATTEMPTS,
+    block_duration=settings.BLOCK_DURATION,
+    max_entries=settings.IP_REPUTATION_MAX_ENTRIES
+)
@@ -0,0 +1,60 @@
+"""
+后台任务租约模块
+每个worker都会启动同样的后台维护任务，通过task_leases表中的租约保证同一时间只有一个worker执行：
+租约已过期或由本进程持有时，以条件UPDATE取得（并发执行时只有一个worker更新成功）；
+执行时间可能超过租约期限的任务在执行过程中续期
+"""
+
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import or_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from app.database import async_session
+from app.models import TaskLease
+
+# 当前进程的持有者标识
+HOLDER = uuid.uuid4().hex
+
+
+class Lease:
+    """命名租约"""
+
+    def __init__(self, name: str, ttl: float, holder: str = HOLDER):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder
+        # 统计计数
+        self.acquired = 0
+        self.skipped = 0
+
+    async def acquire(self) -> bool:
+        """取得或续期租约，其他worker持有未过期的租约时返回False"""
+        now = datetime.utcnow()
+        async with async_session() as db:
+            insert = pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+            await db.execute(
+                insert(TaskLease)
+                .values(name=self.name, holder=None, expires_at=now)
+                .on_conflict_do_nothing(index_elements=["name"])
+            )
+            result = await db.execute(
+                update(TaskLease)
+                .where(
+                    TaskLease.name == self.name,
+                    or_(TaskLease.expires_at <= now, TaskLease.holder == self.holder)
+                )
+                .values(holder=self.holder, expires_at=now + timedelta(seconds=self.ttl))
+            )
+            await db.commit()
+        if result.rowcount == 1:
+            self.acquired += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "skipped": self.skipped,
+        }
@@ -0,0 +1,225 @@
+"""
+心跳日志写缓冲模块
+心跳请求只把日志放入内存有界队列，由后台任务按数量或时间批量写入数据库，
+日志写入不再占用请求耗时，也不再每次心跳一次INSERT+提交。
+每条心跳都计入按分钟汇总的heartbeat_rollups；明细只保留失败记录和按比例抽样的成功记录。
+汇总的设备数用HyperLogLog草图估计，每个分钟汇总占用固定内存，
+写入时与数据库中已有的草图合并，同一设备的心跳落在多个worker上也只计一次
+"""
+
+import asyncio
+import random
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+from sqlalchemy import insert, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.database import async_session
+from app.models import HeartbeatLog, HeartbeatRollup
+from app.hll import HyperLogLog
+
+# (应用ID, 分钟, 状态)
+RollupKey = Tuple[int, datetime, str]
+
+
+class HeartbeatLogSink:
+    """心跳日志写缓冲（write-behind）"""
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float, sample_rate: float):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self._queue: Deque[Dict] = deque()
+        # 分钟汇总：[次数, 设备草图]
+        self._rollups: Dict[RollupKey, List] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._lock = asyncio.Lock()
+        # 统计计数
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.sampled_out = 0
+        self.rollups_written = 0
+
+    def submit(
+        self,
+        device_id: str,
+        application_id: int,
+        ip_address: Optional[str],
+        status: str,
+        message: Optional[str] = None,
+        created_at: Optional[datetime] = None
+    ) -> bool:
+        """提交一条日志（不阻塞），队列已满时丢弃并计数"""
+        created_at = created_at or datetime.utcnow()
+
+        # 每条心跳都计入分钟汇总
+        key = (application_id, created_at.replace(second=0, microsecond=0), status)
+        rollup = self._rollups.get(key)
+        if rollup is None:
+            rollup = self._rollups[key] = [0, HyperLogLog()]
+        rollup[0] += 1
+        rollup[1].add(device_id)
+
+        # 成功心跳按比例抽样保留明细
+        if status == "success" and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return True
+
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            return False
+
+        self._queue.append({
+            "device_id": device_id,
+            "application_id": application_id,
+            "ip_address": ip_address,
+            "status": status,
+            "message": message,
+            "created_at": created_at,
+        })
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def _write_rollups(self, db: AsyncSession, final: bool):
+        """写入已结束分钟的汇总（final时写入全部）：次数累加，设备草图与已有草图合并"""
+        current = datetime.utcnow().replace(second=0, microsecond=0)
+        # 按主键顺序加锁，避免多个worker同时写入时死锁
+        keys = sorted(key for key in self._rollups if final or key[1] < current)
+        if not keys:
+            return
+        batch = {key: self._rollups.pop(key) for key in keys}
+
+        dialect = db.bind.dialect.name
+        stmt = pg_insert(HeartbeatRollup) if dialect == "postgresql" else sqlite_insert(HeartbeatRollup)
+        pk = tuple_(HeartbeatRollup.application_id, HeartbeatRollup.minute, HeartbeatRollup.status)
+        try:
+            # 先补齐不存在的行，再锁定读取已有的值（SQLite在第一条写语句时已持有写锁）
+            await db.execute(
+                stmt.on_conflict_do_nothing(),
+                [
+                    {"application_id": key[0], "minute": key[1], "status": key[2],
+                     "heartbeat_count": 0, "device_count": 0}
+                    for key in keys
+                ]
+            )
+            result = await db.execute(
+                select(
+                    HeartbeatRollup.application_id,
+                    HeartbeatRollup.minute,
+                    HeartbeatRollup.status,
+                    HeartbeatRollup.heartbeat_count,
+                    HeartbeatRollup.device_count,
+                    HeartbeatRollup.device_sketch
+                ).where(pk.in_(keys)).order_by(
+                    HeartbeatRollup.application_id, HeartbeatRollup.minute, HeartbeatRollup.status
+                ).with_for_update()
+            )
+            rows = []
+            for row in result:
+                key = (row.application_id, row.minute, row.status)
+                count, sketch = batch[key]
+                legacy = 0
+                if row.device_sketch is not None:
+                    sketch.merge(HyperLogLog(row.device_sketch))
+                else:
+                    # 升级前写入的汇总没有草图，只能累加
+                    legacy = row.device_count
+                rows.append({
+                    "application_id": key[0],
+                    "minute": key[1],
+                    "status": key[2],
+                    "heartbeat_count": row.heartbeat_count + count,
+                    "device_count": legacy + sketch.count(),
+                    "device_sketch": sketch.to_bytes(),
+                })
+            await db.execute(update(HeartbeatRollup), rows)
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            print(f"[日志缓冲] 汇总写入失败，丢弃{len(keys)}条: {e}")
+            return
+        self.rollups_written += len(keys)
+
+    async def flush(self, final: bool = False) -> int:
+        """把汇总和队列中的日志分批写入数据库，返回写入的明细条数"""
+        total = 0
+        async with self._lock:
+            if self._rollups:
+                async with async_session() as db:
+                    await self._write_rollups(db, final)
+            while self._queue:
+                batch: List[Dict] = []
+                while self._queue and len(batch) < self.batch_size:
+                    batch.append(self._queue.popleft())
+                try:
+                    async with async_session() as db:
+                        # executemany会被编译为多行INSERT
+                        await db.execute(insert(HeartbeatLog), batch)
+                        await db.commit()
+                except Exception as e:
+                    self.failed += len(batch)
+                    print(f"[日志缓冲] 写入失败，丢弃{len(batch)}条: {e}")
+                    continue
+                self.written += len(batch)
+                self.flushes += 1
+                total += len(batch)
+        return total
+
+    async def _run(self):
+        """后台刷新循环：满批次或到达时间间隔即写入，单次失败不终止循环"""
+        while not self._stopping:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.flush()
+            except Exception as e:
+                print(f"[日志缓冲] 后台刷新失败: {e}")
+
+    def start(self):
+        """启动后台刷新任务"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务并写入剩余日志"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush(final=True)
+
+    def stats(self) -> dict:
+        """队列状态与计数"""
+        return {
+            "queue_depth": len(self._queue),
+            "max_size": self.max_size,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "sampled_out": self.sampled_out,
+            "open_rollups": len(self._rollups),
+            "rollups_written": self.rollups_written,
+        }
+
+
+log_sink = HeartbeatLogSink(
+    max_size=settings.LOG_BUFFER_MAX_SIZE,
+    batch_size=settings.LOG_BUFFER_BATCH_SIZE,
+    flush_interval=settings.LOG_BUFFER_FLUSH_INTERVAL,
+    sample_rate=settings.HEARTBEAT_LOG_SAMPLE_RATE
+)
@@ -1,17 +1,30 @@
+import secrets
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from sqlalchemy import select
-from slowapi import _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
 from app.config import settings
 from app.database import init_db, async_session
 from app.models import User, UserRole
-from app.auth import get_password_hash
+from app.auth import get_password_hash, principal_cache, password_hasher
+from app.log_sink import log_sink
+from app.device_updates import device_updates
+from app.device_tokens import revoked_devices
+from app.cache import app_registry, card_counts
+from app.shared_cache import invalidation_bus, init_shared_cache, close_shared_cache, get_redis
+from app.retention import prepare_log_partitions, log_retention
+from app.pacing import heartbeat_pacer
+from app.ratelimit import RateLimitExceeded
+from app.ip_reputation import ip_reputation
+from app.metrics import metrics_exporter
+from app.card_issuer import card_issuer
+from app.card_search import card_search
+from app.stats_counters import stats_counters
+from app.presence import presence
 from app.routers import auth, applications, cards, heartbeat, agents, dashboard
 from app.middleware import (
-    limiter,
     SecurityHeadersMiddleware,
     IPBlacklistMiddleware,
     RequestLoggingMiddleware,
@@ -21,7 +34,9 @@ from app.middleware import (
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 启动时初始化数据库
+    await prepare_log_partitions()
     await init_db()
+    await card_search.prepare()
     
     # 创建默认管理员
     async with async_session() as db:
@@ -34,6 +49,7 @@ async def lifespan(app: FastAPI):
             )
             db.add(admin)
             await db.commit()
+            stats_counters.add(None, total_users=1)
             print(f"")
             print(f"{'='*50}")
             print(f"  管理员账户已创建")
@@ -44,12 +60,57 @@ async def lifespan(app: FastAPI):
             print(f"{'='*50}")
             print(f"")
     
+    # 加载已禁用设备（签名令牌校验用）
+    await revoked_devices.reload()
+    
+    # 共享缓存与跨worker缓存失效
+    invalidation_bus.subscribe("app", app_registry.invalidate)
+    invalidation_bus.subscribe("revoke", revoked_devices.on_revoke)
+    invalidation_bus.subscribe("revoke", presence.on_revoke)
+    invalidation_bus.subscribe("restore", revoked_devices.on_restore)
+    invalidation_bus.subscribe("pacing", heartbeat_pacer.on_override)
+    invalidation_bus.subscribe("block", ip_reputation.on_block)
+    invalidation_bus.subscribe("user", principal_cache.on_invalidate)
+    invalidation_bus.subscribe("cards", lambda _: card_counts.clear())
+    # 订阅断线期间可能漏收失效消息，重连后重新加载吊销表和心跳间隔，清空本地缓存
+    invalidation_bus.on_resync(revoked_devices.reload)
+    invalidation_bus.on_resync(heartbeat_pacer.load_override)
+    invalidation_bus.on_resync(app_registry.clear)
+    invalidation_bus.on_resync(principal_cache.clear)
+    invalidation_bus.on_resync(card_counts.clear)
+    await init_shared_cache()
+    # 没有Redis时吊销消息只在本worker生效，多worker时其他worker靠定期重新加载吊销表
+    if get_redis() is None and settings.WORKERS > 1:
+        revoked_devices.start(settings.REVOCATION_RELOAD_INTERVAL)
+    
+    # 启动心跳日志写缓冲、设备心跳时间合并写入和日志清理任务
+    log_sink.start()
+    device_updates.start()
+    log_retention.start()
+    await heartbeat_pacer.start()
+    metrics_exporter.start()
+    await stats_counters.start()
+    await presence.start()
+    
     print(f"[启动] {settings.APP_NAME} v{settings.APP_VERSION}")
     print(f"[启动] 管理后台: http://{settings.HOST}:{settings.PORT}")
     print(f"[启动] API文档: http://{settings.HOST}:{settings.PORT}/docs")
     
     yield
     
+    # 关闭前写入缓冲中的剩余日志和心跳时间
+    await card_issuer.stop()
+    await card_search.stop()
+    await stats_counters.stop()
+    await presence.stop()
+    await revoked_devices.stop()
+    await metrics_exporter.stop()
+    await heartbeat_pacer.stop()
+    await log_retention.stop()
+    await log_sink.stop()
+    await device_updates.stop()
+    await close_shared_cache()
+    password_hasher.shutdown()
     print("[关闭] 服务已停止")
 
 app = FastAPI(
@@ -60,7 +121,6 @@ app = FastAPI(
 )
 
 # 速率限制
-app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, rate_limit_exceeded_handler)
 
 # 安全中间件（顺序很重要：先执行的放后面）
@@ -107,6 +167,17 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics(request: Request):
+    """Prometheus格式运行指标（配置METRICS_DIR时汇总所有worker）"""
+    if settings.METRICS_TOKEN:
+        if not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"):
+            raise HTTPException(status_code=401, detail="未授权访问")
+    return PlainTextResponse(
+        metrics_exporter.render(),
+        media_type="text/plain; version=0.0.4"
+    )
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
@@ -0,0 +1,390 @@
+"""
+运行指标模块
+进程内的计数器、直方图和采集时读取的仪表，以Prometheus文本格式输出。
+指标只在事件循环线程中更新，无需加锁；多worker部署时配置METRICS_DIR，
+各worker定期把快照写入该目录下以pid命名的文件，/metrics读取全部文件后合并输出；
+已退出worker的计数器和直方图合并到retired.json后删除其快照文件，目录中的文件数不随重启次数增长
+"""
+
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from sqlalchemy.pool import QueuePool
+from app.config import settings
+from app.database import engine
+
+try:
+    import fcntl
+except ImportError:  # Windows不支持文件锁，合并时不加锁
+    fcntl = None
+
+# 请求耗时直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """单调递增计数器"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        registry.register(self)
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List:
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Histogram:
+    """分桶直方图，每组标签保存各桶计数（非累计）、+Inf桶计数和总和"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+        registry.register(self)
+
+    def observe(self, value: float, *labels: str):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def samples(self) -> List:
+        return [[list(labels), list(entry)] for labels, entry in self.values.items()]
+
+
+class Gauge:
+    """仪表：采集时调用回调函数读取当前值"""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Dict[Tuple[str, ...], float]],
+        labelnames: Sequence[str] = ()
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        registry.register(self)
+
+    def samples(self) -> List:
+        try:
+            return [[list(labels), value] for labels, value in self.collect().items()]
+        except Exception as e:
+            print(f"[指标] 采集{self.name}失败: {e}")
+            return []
+
+
+class Registry:
+    """指标注册表，负责快照、跨进程合并和文本输出"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def snapshot(self, include_gauges: bool = True) -> dict:
+        """当前进程的指标快照（可JSON序列化）"""
+        metrics = {}
+        for name, metric in self._metrics.items():
+            if metric.type == "gauge" and not include_gauges:
+                continue
+            metrics[name] = {
+                "type": metric.type,
+                "help": metric.help,
+                "labelnames": list(metric.labelnames),
+                "buckets": list(getattr(metric, "buckets", ())),
+                "samples": metric.samples(),
+            }
+        return {"pid": os.getpid(), "time": time.time(), "metrics": metrics}
+
+    @staticmethod
+    def merge(snapshots: List[dict]) -> dict:
+        """合并多个进程的快照：同名同标签的值相加"""
+        merged: Dict[str, dict] = {}
+        for snapshot in snapshots:
+            for name, metric in snapshot["metrics"].items():
+                target = merged.setdefault(name, {**metric, "values": {}})
+                values = target["values"]
+                for labels, value in metric["samples"]:
+                    key = tuple(labels)
+                    if isinstance(value, list):
+                        current = values.get(key)
+                        values[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        values[key] = values.get(key, 0) + value
+        return merged
+
+    @staticmethod
+    def to_snapshot(merged: dict) -> dict:
+        """把合并结果转换回快照格式"""
+        metrics = {
+            name: {
+                "type": metric["type"],
+                "help": metric["help"],
+                "labelnames": metric["labelnames"],
+                "buckets": metric["buckets"],
+                "samples": [[list(labels), value] for labels, value in metric["values"].items()],
+            }
+            for name, metric in merged.items()
+        }
+        return {"pid": None, "time": time.time(), "metrics": metrics}
+
+    @staticmethod
+    def render(merged: dict) -> str:
+        """输出Prometheus文本格式"""
+        lines = []
+        for name, metric in sorted(merged.items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labelnames = metric["labelnames"]
+            for labels, value in sorted(metric["values"].items()):
+                pairs = [f'{k}="{_escape(v)}"' for k, v in zip(labelnames, labels)]
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _number(bound)
+                    le_pair = f'le="{le}"'
+                    lines.append(f"{name}_bucket{_labels(pairs + [le_pair])} {_number(cumulative)}")
+                lines.append(f"{name}_sum{_labels(pairs)} {_number(value[-1])}")
+                lines.append(f"{name}_count{_labels(pairs)} {_number(cumulative)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs: List[str]) -> str:
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def route_label(scope) -> str:
+    """按路由模板（如/api/cards/{card_id}）统计，未匹配的路径归为一类，避免标签数量无限增长"""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+registry = Registry()
+
+
+class MetricsExporter:
+    """多worker指标汇总：定期写入本进程快照，输出时合并所有worker的快照"""
+
+    RETIRED = "retired.json"
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def _path(self) -> str:
+        return os.path.join(self.directory, f"metrics_{os.getpid()}.json")
+
+    def _write(self, snapshot: dict, path: Optional[str] = None):
+        path = path or self._path
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _load(path: str) -> Optional[dict]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _retire(self, filenames: List[str]):
+        """
+        把已退出worker的快照合并到retired.json并删除原文件（持有文件锁，多个worker不会重复合并）
+        retired.json记录已合并的快照（文件名和写入时间），合并后、删除前中断的文件下次直接删除
+        """
+        lock = open(os.path.join(self.directory, "retired.lock"), "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.directory, self.RETIRED)
+            retired = self._load(retired_path) or {"pid": None, "time": time.time(), "metrics": {}}
+            folded = set(retired.get("folded", ()))
+            snapshots = [retired]
+            done = []
+            for filename in filenames:
+                snapshot = self._load(os.path.join(self.directory, filename))
+                if snapshot is None:
+                    continue
+                done.append(filename)
+                identity = f"{filename}@{snapshot.get('time')}"
+                if identity in folded:
+                    continue
+                folded.add(identity)
+                snapshot["metrics"] = {
+                    name: metric for name, metric in snapshot["metrics"].items() if metric["type"] != "gauge"
+                }
+                snapshots.append(snapshot)
+            if len(snapshots) > 1:
+                retired = registry.to_snapshot(registry.merge(snapshots))
+                # 只需记住仍存在的快照文件
+                retired["folded"] = [item for item in folded if item.split("@")[0] in done]
+                self._write(retired, retired_path)
+            for filename in done:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+        finally:
+            lock.close()
+
+    def _read_others(self) -> List[dict]:
+        """读取其他worker的快照和已退出worker的累计值，发现已退出的worker时先合并其快照"""
+        snapshots = []
+        dead = []
+        own = os.path.basename(self._path)
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith("metrics_") and filename.endswith(".json")) or filename == own:
+                continue
+            snapshot = self._load(os.path.join(self.directory, filename))
+            if snapshot is None:
+                continue
+            pid = snapshot.get("pid")
+            if not pid or not _pid_alive(pid):
+                dead.append(filename)
+                continue
+            snapshots.append(snapshot)
+        if dead:
+            self._retire(dead)
+        retired = self._load(os.path.join(self.directory, self.RETIRED))
+        if retired is not None:
+            snapshots.append(retired)
+        return snapshots
+
+    def render(self) -> str:
+        snapshots = [registry.snapshot()]
+        if self.directory:
+            snapshots.extend(self._read_others())
+        return registry.render(registry.merge(snapshots))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self._write(registry.snapshot())
+            except OSError as e:
+                print(f"[指标] 写入快照失败: {e}")
+
+    def start(self):
+        if not self.directory or self._task is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # 与本进程同名的快照来自之前使用相同pid的进程，先合并，避免被本进程覆盖后计数看起来被重置
+        if os.path.exists(self._path):
+            try:
+                self._retire([os.path.basename(self._path)])
+            except OSError as e:
+                print(f"[指标] 合并旧快照失败: {e}")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            # 退出前写入最终的计数，仪表不再有意义
+            try:
+                self._write(registry.snapshot(include_gauges=False))
+            except OSError as e:
+                print(f"[指标] 写入快照失败: {e}")
+
+
+metrics_exporter = MetricsExporter(
+    directory=settings.METRICS_DIR,
+    interval=settings.METRICS_FLUSH_INTERVAL
+)
+
+# ==================== 指标定义 ====================
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "HTTP请求耗时（到响应头发出为止）",
+    ("method", "route", "status")
+)
+heartbeat_results = Counter(
+    "heartbeat_results_total",
+    "心跳验证结果",
+    ("status",)
+)
+rate_limit_rejections = Counter(
+    "rate_limit_rejections_total",
+    "速率限制拒绝次数",
+    ("route",)
+)
+blacklist_hits = Counter(
+    "ip_blacklist_hits_total",
+    "被IP黑名单拦截的请求数"
+)
+
+
+def _pool_stats() -> Dict[Tuple[str, ...], float]:
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    return {
+        ("size",): pool.size(),
+        ("checked_out",): pool.checkedout(),
+        ("overflow",): max(pool.overflow(), 0),
+    }
+
+
+db_pool_connections = Gauge(
+    "db_pool_connections",
+    "数据库连接池状态（size: 池大小, checked_out: 已借出, overflow: 溢出连接）",
+    _pool_stats,
+    ("state",)
+)
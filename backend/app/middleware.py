@@ -1,78 +1,102 @@
 """
 安全中间件模块
-包含：速率限制、安全头部、IP黑名单、请求签名验证
+包含：速率限制、安全头部、IP黑名单、请求日志与耗时统计、请求签名验证
 """
 
 import time
 import hashlib
 import hmac
+import ipaddress
 from datetime import datetime
-from typing import Dict, Set
+from functools import lru_cache
 from fastapi import Request, Response, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from app.config import settings
+from app.ratelimit import RateLimiter, RateLimitExceeded
+from app.ip_reputation import ip_reputation
+from app.nonce_cache import nonce_cache
+from app.metrics import http_request_duration, rate_limit_rejections, blacklist_hits, route_label
+from app.shared_cache import invalidation_bus
 
-# 速率限制器
-limiter = Limiter(
-    key_func=get_remote_address,
-    default_limits=["200/minute", "10/second"],
-    storage_uri="memory://"
-)
+_TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in settings.TRUSTED_PROXIES.split(",") if item.strip()
+]
 
-# IP黑名单（内存存储，生产环境应使用Redis）
-ip_blacklist: Set[str] = set()
-# 失败尝试计数
-failed_attempts: Dict[str, Dict] = {}
 
-# 配置
-MAX_FAILED_ATTEMPTS = 10
-BLOCK_DURATION = 3600  # 1小时
+@lru_cache(maxsize=4096)
+def is_trusted_proxy(ip: str) -> bool:
+    """是否为可信反向代理地址"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in network for network in _TRUSTED_PROXIES)
 
 
 def get_client_ip(request: Request) -> str:
     """获取真实客户端IP"""
-    forwarded = request.headers.get("X-Forwarded-For")
+    return get_scope_client_ip(request.scope)
+
+
+def get_scope_client_ip(scope: Scope) -> str:
+    """
+    从ASGI scope获取真实客户端IP（中间件中无需构造Request）
+    连接来自可信代理时才采用转发头：X-Forwarded-For从右向左跳过可信代理，取第一个不可信的地址
+    （最左侧的值由客户端自行填写，可以伪造）；直连的客户端伪造转发头不会生效
+    """
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    if not is_trusted_proxy(peer):
+        return peer
+
+    forwarded = []
+    real_ip = None
+    for name, value in scope.get("headers", ()):
+        if name == b"x-forwarded-for":
+            forwarded.extend(value.decode("latin-1").split(","))
+        elif name == b"x-real-ip":
+            real_ip = real_ip or value
     if forwarded:
-        return forwarded.split(",")[0].strip()
-    real_ip = request.headers.get("X-Real-IP")
+        for ip in reversed(forwarded):
+            ip = ip.strip()
+            if ip and not is_trusted_proxy(ip):
+                return ip
+        return forwarded[0].strip() or peer
     if real_ip:
-        return real_ip
-    return request.client.host if request.client else "unknown"
+        return real_ip.decode("latin-1").strip()
+    return peer
+
+
+# 速率限制器（配置REDIS_URL或共享内存时限额对所有worker生效）
+# 与心跳、激活接口使用同样的客户端IP，经反向代理部署时按真实客户端限流
+limiter = RateLimiter(
+    key_func=get_client_ip,
+    backend=settings.RATE_LIMIT_BACKEND,
+    local_max_keys=settings.RATE_LIMIT_LOCAL_MAX_KEYS,
+    shm_path=settings.RATE_LIMIT_SHM_PATH,
+    shm_slots=settings.RATE_LIMIT_SHM_SLOTS
+)
 
 
 def check_ip_blacklist(ip: str) -> bool:
     """检查IP是否在黑名单中"""
-    return ip in ip_blacklist
+    return ip_reputation.is_blocked(ip)
 
 
-def record_failed_attempt(ip: str):
-    """记录失败尝试"""
-    now = time.time()
-    if ip not in failed_attempts:
-        failed_attempts[ip] = {"count": 0, "first_attempt": now}
-    
-    info = failed_attempts[ip]
-    # 如果超过时间窗口，重置计数
-    if now - info["first_attempt"] > BLOCK_DURATION:
-        info["count"] = 0
-        info["first_attempt"] = now
-    
-    info["count"] += 1
-    
-    # 超过阈值，加入黑名单
-    if info["count"] >= MAX_FAILED_ATTEMPTS:
-        ip_blacklist.add(ip)
-        return True
-    return False
+async def record_failed_attempt(ip: str) -> bool:
+    """记录失败尝试，达到阈值时封禁并广播到所有worker"""
+    until = ip_reputation.record_failure(ip)
+    if until is None:
+        return False
+    await invalidation_bus.publish("block", f"{ip}|{until}")
+    return True
 
 
 def clear_failed_attempts(ip: str):
     """清除失败尝试记录"""
-    if ip in failed_attempts:
-        del failed_attempts[ip]
+    ip_reputation.clear(ip)
 
 
 def generate_request_signature(data: str, timestamp: str) -> str:
@@ -100,93 +124,107 @@ def verify_request_signature(data: str, timestamp: str, signature: str) -> bool:
     return hmac.compare_digest(expected, signature)
 
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    """安全头部中间件"""
+class SecurityHeadersMiddleware:
+    """安全头部中间件（纯ASGI实现）"""
     
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        
+    def __init__(self, app: ASGIApp):
+        self.app = app
         # 安全响应头
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        response.headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
-        
+        self.security_headers = {
+            "X-Content-Type-Options": "nosniff",
+            "X-Frame-Options": "DENY",
+            "X-XSS-Protection": "1; mode=block",
+            "Referrer-Policy": "strict-origin-when-cross-origin",
+            "Permissions-Policy": "geolocation=(), microphone=(), camera=()",
+        }
         # HSTS (仅生产环境)
         if not settings.DEBUG:
-            response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
+            self.security_headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
         
-        return response
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                for name, value in self.security_headers.items():
+                    headers[name] = value
+            await send(message)
+        
+        await self.app(scope, receive, send_with_headers)
 
 
-class IPBlacklistMiddleware(BaseHTTPMiddleware):
-    """IP黑名单中间件"""
+class IPBlacklistMiddleware:
+    """IP黑名单中间件（纯ASGI实现）"""
     
-    async def dispatch(self, request: Request, call_next):
-        client_ip = get_client_ip(request)
-        
-        if check_ip_blacklist(client_ip):
-            return Response(
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and check_ip_blacklist(get_scope_client_ip(scope)):
+            blacklist_hits.inc()
+            response = Response(
                 content='{"detail": "IP已被封禁"}',
                 status_code=403,
                 media_type="application/json"
             )
+            await response(scope, receive, send)
+            return
         
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
 
 
-class RequestLoggingMiddleware(BaseHTTPMiddleware):
-    """请求日志中间件"""
+class RequestLoggingMiddleware:
+    """请求日志中间件（纯ASGI实现）"""
     
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        client_ip = get_client_ip(request)
-        
-        response = await call_next(request)
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
         
-        process_time = time.time() - start_time
+        start_time = time.perf_counter()
         
-        # 记录慢请求
-        if process_time > 1.0:
-            print(f"[慢请求] {request.method} {request.url.path} - {client_ip} - {process_time:.3f}s")
+        async def send_with_timing(message: Message):
+            if message["type"] == "http.response.start":
+                process_time = time.perf_counter() - start_time
+                http_request_duration.observe(
+                    process_time, scope["method"], route_label(scope), str(message["status"])
+                )
+                
+                # 记录慢请求
+                if process_time > 1.0:
+                    client_ip = get_scope_client_ip(scope)
+                    print(f"[慢请求] {scope['method']} {scope['path']} - {client_ip} - {process_time:.3f}s")
+                
+                headers = MutableHeaders(scope=message)
+                headers["X-Process-Time"] = str(process_time)
+            await send(message)
         
-        response.headers["X-Process-Time"] = str(process_time)
-        return response
+        await self.app(scope, receive, send_with_timing)
 
 
-def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
+async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
     """速率限制异常处理"""
     client_ip = get_client_ip(request)
-    record_failed_attempt(client_ip)
+    await record_failed_attempt(client_ip)
+    rate_limit_rejections.inc(route_label(request.scope))
     
     return Response(
         content='{"detail": "请求过于频繁，请稍后再试"}',
         status_code=429,
-        media_type="application/json"
+        media_type="application/json",
+        headers={"Retry-After": str(max(int(exc.retry_after + 0.999), 1))}
     )
 
 
-# 防重放攻击：Nonce存储
-used_nonces: Dict[str, float] = {}
-NONCE_EXPIRY = 300  # 5分钟
-
-
-def verify_nonce(nonce: str) -> bool:
+async def verify_nonce(nonce: str) -> bool:
     """验证Nonce（防重放）"""
-    now = time.time()
-    
-    # 清理过期Nonce
-    expired = [k for k, v in used_nonces.items() if now - v > NONCE_EXPIRY]
-    for k in expired:
-        del used_nonces[k]
-    
-    if nonce in used_nonces:
-        return False
-    
-    used_nonces[nonce] = now
-    return True
+    return await nonce_cache.verify(nonce)
 
 
 def hash_sensitive_data(data: str) -> str:
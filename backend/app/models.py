@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Float, ForeignKey, Text, Enum as SQLEnum
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Float, ForeignKey, Text, LargeBinary, Index, Enum as SQLEnum
 from sqlalchemy.orm import relationship
 from app.database import Base
 import enum
@@ -67,11 +67,43 @@ class Card(Base):
     used_by = Column(String(100), nullable=True)  # 使用者标识
     used_at = Column(DateTime, nullable=True)
     expires_at = Column(DateTime, nullable=True)  # 到期时间
+    # 已绑定的设备数（上限为应用的max_devices）；旧数据按是否已使用补齐
+    device_count = Column(Integer, nullable=False, default=0, server_default="0",
+                          info={"backfill": "CASE WHEN is_used THEN 1 ELSE 0 END"})
+    batch_id = Column(String(32), nullable=True, index=True)  # 生成批次
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
     application = relationship("Application", back_populates="cards")
     creator = relationship("User", back_populates="cards_created")
+    
+    __table_args__ = (
+        # 卡密列表按(created_at, id)倒序游标分页，索引只覆盖管理后台实际使用的过滤组合：
+        # 管理员按应用、是否已使用过滤，代理的查询总带creator_id。等值过滤列在前、排序列在后，沿索引顺序读取即可取到一页。
+        # 代理同时按应用过滤时沿应用的索引读取再过滤creator_id（应用的卡密基本由其所有者创建）；
+        # 按卡密类型过滤（后台没有此选项）沿时间索引读取再过滤
+        Index("ix_cards_created", "created_at", "id"),
+        Index("ix_cards_creator_created", "creator_id", "created_at", "id"),
+        Index("ix_cards_creator_used_created", "creator_id", "is_used", "created_at", "id"),
+        Index("ix_cards_app_created", "application_id", "created_at", "id"),
+        Index("ix_cards_app_used_created", "application_id", "is_used", "created_at", "id"),
+    )
+
+# 卡密生成批次表（批量生成的进度和结果查询）
+class CardBatch(Base):
+    __tablename__ = "card_batches"
+    
+    id = Column(String(32), primary_key=True)  # 批次号
+    application_id = Column(Integer, ForeignKey("applications.id"), nullable=False)
+    creator_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    card_type = Column(SQLEnum(CardType), nullable=False)
+    count = Column(Integer, nullable=False)  # 请求生成数量
+    issued = Column(Integer, nullable=False, default=0)  # 已生成数量
+    status = Column(String(20), nullable=False, default="pending")  # pending, running, completed, failed
+    error = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)  # 最近一次进度更新
+    finished_at = Column(DateTime, nullable=True)
 
 # 授权设备表
 class Device(Base):
@@ -91,6 +123,37 @@ class Device(Base):
     
     # 关系
     application = relationship("Application", back_populates="devices")
+    
+    __table_args__ = (
+        # 激活时检查设备是否已绑定该卡密
+        Index("ix_devices_card_device", "card_key", "device_id"),
+        # 统计计数按到期时间扣减过期设备
+        Index("ix_devices_expires", "expires_at"),
+        # 在线设备按最后心跳时间倒序读取（在线状态使用sql后端、启动时载入在线设备）
+        Index("ix_devices_active_heartbeat", "is_active", "last_heartbeat"),
+    )
+
+# 仪表盘统计计数表（增量维护，定期按实际数据校正）
+class StatsCounter(Base):
+    __tablename__ = "stats_counters"
+    
+    scope_id = Column(Integer, primary_key=True, autoincrement=False)  # 0为全局，其余为用户ID（代理看到的范围）
+    total_users = Column(Integer, nullable=False, default=0)  # 下级用户数
+    total_apps = Column(Integer, nullable=False, default=0)  # 拥有的应用数
+    total_cards = Column(Integer, nullable=False, default=0)  # 创建的卡密数
+    used_cards = Column(Integer, nullable=False, default=0)  # 其中已使用的卡密数
+    active_devices = Column(Integer, nullable=False, default=0)  # 名下应用中未禁用且未到期的设备数
+    expired_before = Column(DateTime, nullable=True)  # 仅全局行：已扣减到期时间早于该值的设备
+    reconciled_at = Column(DateTime, nullable=True)  # 仅全局行：最近一次校正时间
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# 后台任务租约表（多个worker中只有持有租约的一个执行维护任务）
+class TaskLease(Base):
+    __tablename__ = "task_leases"
+    
+    name = Column(String(50), primary_key=True)  # 任务名
+    holder = Column(String(32), nullable=True)  # 持有者（worker进程标识）
+    expires_at = Column(DateTime, nullable=False)  # 租约到期时间
 
 # 心跳日志表
 class HeartbeatLog(Base):
@@ -102,5 +165,20 @@ class HeartbeatLog(Base):
     ip_address = Column(String(50), nullable=True)
     status = Column(String(20), nullable=False)  # success, expired, invalid
     message = Column(String(255), nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (
+        # 代理查看自己应用的最近心跳
+        Index("ix_heartbeat_logs_app_created", "application_id", "created_at"),
+    )
 
+# 心跳分钟汇总表（按应用、分钟、状态统计）
+class HeartbeatRollup(Base):
+    __tablename__ = "heartbeat_rollups"
+    
+    application_id = Column(Integer, ForeignKey("applications.id"), primary_key=True)
+    minute = Column(DateTime, primary_key=True)  # 所在分钟（秒和微秒为0）
+    status = Column(String(20), primary_key=True)  # success, expired, invalid
+    heartbeat_count = Column(Integer, nullable=False, default=0)  # 心跳次数
+    device_count = Column(Integer, nullable=False, default=0)  # 不同设备数（HyperLogLog估计，各worker合并去重）
+    device_sketch = Column(LargeBinary, nullable=True)  # 设备HyperLogLog草图
@@ -0,0 +1,111 @@
+"""
+防重放Nonce缓存模块
+字典记录每个Nonce到达时的时间桶号，队列按到达顺序保存Nonce：
+到达顺序即过期顺序，过期和超出上限时都从队首弹出，检查和写入均为O(1)。
+配置REDIS_URL时同时写入Redis（SET NX EX），Nonce重放到其他worker也会被拒绝
+"""
+
+import sys
+import time
+from collections import deque
+from typing import Deque, Dict
+from app.config import settings
+from app.shared_cache import get_redis, redis_key
+
+# 每个条目除字符串本身外的大致开销（字典槽位和索引、队列中的引用）
+_ENTRY_OVERHEAD = 48
+
+
+class NonceCache:
+    """时间分桶的Nonce缓存（单进程，供事件循环内使用）"""
+
+    def __init__(self, expiry: float, buckets: int, max_entries: int, max_length: int):
+        self.expiry = expiry
+        self.buckets = buckets
+        self.bucket_width = expiry / buckets
+        self.max_entries = max_entries
+        self.max_length = max_length
+        # nonce -> 到达时的桶号（同一桶内共用一个整数对象）
+        self._seen: Dict[str, int] = {}
+        # 按到达顺序排列的nonce
+        self._queue: Deque[str] = deque()
+        self._current = -1
+        self._bytes = 0
+        # 统计计数
+        self.accepted = 0
+        self.replayed = 0
+        self.evicted = 0
+        self.errors = 0
+
+    def _pop_oldest(self):
+        nonce = self._queue.popleft()
+        del self._seen[nonce]
+        self._bytes -= sys.getsizeof(nonce) + _ENTRY_OVERHEAD
+
+    def check_local(self, nonce: str, now: float) -> bool:
+        """检查并记录Nonce，重复返回False"""
+        current = int(now / self.bucket_width)
+        if current != self._current:
+            self._current = current
+        # 多保留一个桶，保证每个Nonce至少保留expiry秒
+        oldest = self._current - self.buckets - 1
+        queue, seen = self._queue, self._seen
+        while queue and seen[queue[0]] <= oldest:
+            self._pop_oldest()
+
+        if nonce in seen:
+            return False
+
+        # 超出上限时淘汰最早的Nonce（最接近过期）
+        if len(seen) >= self.max_entries:
+            self._pop_oldest()
+            self.evicted += 1
+
+        seen[nonce] = self._current
+        queue.append(nonce)
+        self._bytes += sys.getsizeof(nonce) + _ENTRY_OVERHEAD
+        return True
+
+    async def verify(self, nonce: str) -> bool:
+        """验证Nonce（防重放），过长、重复返回False"""
+        if len(nonce) > self.max_length or not self.check_local(nonce, time.time()):
+            self.replayed += 1
+            return False
+
+        redis = get_redis()
+        if redis is not None:
+            try:
+                if not await redis.set(redis_key("nonce", nonce), b"1", nx=True, ex=int(self.expiry)):
+                    # 已在其他worker使用过
+                    self.replayed += 1
+                    return False
+            except Exception as e:
+                # Redis不可用时仅按本进程记录判断
+                self.errors += 1
+                print(f"[防重放] Redis写入失败: {e}")
+
+        self.accepted += 1
+        return True
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def stats(self) -> dict:
+        return {
+            "shared": get_redis() is not None,
+            "size": len(self._seen),
+            "max_entries": self.max_entries,
+            "memory_bytes": self._bytes,
+            "accepted": self.accepted,
+            "replayed": self.replayed,
+            "evicted": self.evicted,
+            "errors": self.errors,
+        }
+
+
+nonce_cache = NonceCache(
+    expiry=settings.NONCE_EXPIRY,
+    buckets=settings.NONCE_BUCKETS,
+    max_entries=settings.NONCE_CACHE_MAX_SIZE,
+    max_length=settings.NONCE_MAX_LENGTH
+)
@@ -0,0 +1,153 @@
+"""
+心跳节奏控制模块
+根据应用配置的心跳间隔和服务器当前负载（事件循环延迟、数据库连接池占用）计算客户端下次心跳间隔，
+管理员可设置全局最小间隔，故障期间统一拉长所有客户端的心跳间隔
+"""
+
+import asyncio
+from typing import Optional, Tuple
+from sqlalchemy.pool import QueuePool
+from app.config import settings
+from app.database import engine
+from app.shared_cache import get_redis, redis_key, invalidation_bus
+
+
+class HeartbeatPacer:
+    """心跳间隔计算：负载越高间隔越长，最长拉长到配置间隔的max_stretch倍
+    下发的间隔（包括管理员设置的最小间隔）加上抖动后始终小于心跳超时，客户端按建议间隔心跳不会被判为离线
+    """
+
+    def __init__(
+        self,
+        timeout: int,
+        max_interval: int,
+        max_stretch: float,
+        jitter_ratio: float,
+        lag_threshold: float,
+        pool_threshold: float,
+        probe_interval: float
+    ):
+        self.max_interval = max_interval
+        self.max_stretch = max_stretch
+        self.jitter_ratio = jitter_ratio
+        self.lag_threshold = lag_threshold
+        self.pool_threshold = pool_threshold
+        self.probe_interval = probe_interval
+        # 间隔上限：interval + int(interval * jitter_ratio) < timeout
+        self.ceiling = max(int((timeout - 1) / (1 + jitter_ratio)), 1)
+        self._task: Optional[asyncio.Task] = None
+        # 负载指标（后台任务定期更新，请求路径只读取factor）
+        self.loop_lag = 0.0
+        self.pool_usage = 0.0
+        self.factor = 1.0
+        # 管理员设置的最小间隔（秒），0为不限制
+        self.override = 0
+
+    def _pool_usage(self) -> float:
+        """连接池占用比例，非QueuePool（如SQLite的NullPool）返回0"""
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            return 0.0
+        capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+        if capacity <= 0:
+            return 0.0
+        return pool.checkedout() / capacity
+
+    def _compute_factor(self) -> float:
+        """按事件循环延迟和连接池占用计算拉长倍数"""
+        factor = 1.0
+        if self.lag_threshold > 0 and self.loop_lag > self.lag_threshold:
+            # 延迟每超出阈值一倍，间隔增加一倍
+            factor = max(factor, self.loop_lag / self.lag_threshold)
+        if self.pool_threshold < 1 and self.pool_usage > self.pool_threshold:
+            # 占用从阈值到100%时，线性拉长到max_stretch倍
+            ratio = (self.pool_usage - self.pool_threshold) / (1 - self.pool_threshold)
+            factor = max(factor, 1 + ratio * (self.max_stretch - 1))
+        return min(factor, self.max_stretch)
+
+    def next_interval(self, base_interval: int) -> Tuple[int, int]:
+        """返回(下次心跳间隔, 随机抖动范围)，单位秒"""
+        interval = min(round(base_interval * self.factor), max(self.max_interval, base_interval))
+        interval = min(max(interval, self.override), self.ceiling)
+        return interval, int(interval * self.jitter_ratio)
+
+    def on_override(self, payload: str):
+        """处理其他worker广播的最小间隔设置"""
+        self.override = min(max(int(payload), 0), self.ceiling)
+
+    async def set_override(self, seconds: int) -> int:
+        """设置全局最小心跳间隔并广播到所有worker，0为取消，返回实际生效的值（不超过间隔上限）"""
+        seconds = min(max(seconds, 0), self.ceiling)
+        redis = get_redis()
+        if redis is not None:
+            # 持久化到Redis，之后启动的worker也能读取
+            try:
+                if seconds:
+                    await redis.set(redis_key("pacing"), str(seconds))
+                else:
+                    await redis.delete(redis_key("pacing"))
+            except Exception as e:
+                print(f"[心跳节奏] 保存失败: {e}")
+        await invalidation_bus.publish("pacing", str(seconds))
+        return seconds
+
+    async def _probe(self):
+        """定期测量事件循环延迟和连接池占用"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.probe_interval)
+            lag = max(loop.time() - started - self.probe_interval, 0.0)
+            # 指数平滑，避免单次抖动导致间隔频繁变化
+            self.loop_lag = self.loop_lag * 0.8 + lag * 0.2
+            self.pool_usage = self._pool_usage()
+            self.factor = self._compute_factor()
+
+    async def load_override(self):
+        """从Redis读取持久化的最小间隔（启动时和广播订阅重连后调用）"""
+        redis = get_redis()
+        if redis is None:
+            return
+        try:
+            value = await redis.get(redis_key("pacing"))
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            # 未设置时为0（可能在断线期间被取消）
+            self.on_override(value or "0")
+        except Exception as e:
+            print(f"[心跳节奏] 读取失败: {e}")
+
+    async def start(self):
+        if self._task is not None:
+            return
+        await self.load_override()
+        self._task = asyncio.create_task(self._probe())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "loop_lag_ms": round(self.loop_lag * 1000, 2),
+            "pool_usage": round(self.pool_usage, 3),
+            "factor": round(self.factor, 2),
+            "override": self.override,
+            "ceiling": self.ceiling,
+        }
+
+
+heartbeat_pacer = HeartbeatPacer(
+    timeout=settings.HEARTBEAT_TIMEOUT,
+    max_interval=settings.HEARTBEAT_INTERVAL_MAX,
+    max_stretch=settings.HEARTBEAT_INTERVAL_MAX_STRETCH,
+    jitter_ratio=settings.HEARTBEAT_INTERVAL_JITTER,
+    lag_threshold=settings.HEARTBEAT_LOOP_LAG_THRESHOLD,
+    pool_threshold=settings.HEARTBEAT_POOL_USAGE_THRESHOLD,
+    probe_interval=settings.HEARTBEAT_LOAD_PROBE_INTERVAL
+)
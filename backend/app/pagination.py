@@ -1,6 +1,9 @@
-from typing import Generic, TypeVar, List, Optional
+import base64
+import json
+from typing import Generic, TypeVar, List, Optional, Tuple
 from pydantic import BaseModel, Field
 from fastapi import Query
+from app.exceptions import ValidationError
 
 T = TypeVar('T')
 
@@ -37,3 +40,19 @@ class PaginatedResponse(BaseModel, Generic[T]):
             has_next=page < total_pages,
             has_prev=page > 1
         )
+
+def encode_cursor(values: list, direction: str = "next") -> str:
+    """生成游标：排序键的值和翻页方向（next: 向后, prev: 向前），编码为不透明字符串"""
+    raw = json.dumps({"k": values, "d": direction}, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[list, str]:
+    """解析游标，返回(排序键的值, 翻页方向)"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        values, direction = data["k"], data["d"]
+    except (ValueError, TypeError, KeyError):
+        raise ValidationError("无效的分页游标")
+    if not isinstance(values, list) or direction not in ("next", "prev"):
+        raise ValidationError("无效的分页游标")
+    return values, direction
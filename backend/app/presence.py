@@ -0,0 +1,398 @@
+"""
+设备在线状态模块
+心跳成功时记录设备的最后在线时间，按应用维护在线设备集合，
+仪表盘的在线设备列表和在线数直接从这里读取，不再按last_heartbeat扫描devices表：
+  - memory: 每个应用一个按最后在线时间排序的OrderedDict，心跳时移到末尾（O(1)），
+    超过HEARTBEAT_TIMEOUT的设备从头部淘汰，在线数即集合大小；只能看到本进程收到的心跳
+  - redis: 各worker把心跳合并后定期写入每个应用的有序集合（分数为最后在线时间），
+    超时前授权就会到期的设备另记入到期集合（分数为到期时间）；
+    读取时ZREMRANGEBYSCORE淘汰超时设备，移除到期集合中已到期的设备，ZREVRANGE取最近在线的设备（O(log n)），ZCARD计数
+  - sql: 仍按last_heartbeat查询devices表（多worker且未配置REDIS_URL时使用）
+auto在未配置REDIS_URL时，单worker用memory；多worker（WEB_CONCURRENCY大于1）时每个进程只看到部分心跳，改用sql；
+指定redis但未连接Redis时同样按worker数退回memory或sql
+授权在超时前到期的设备放入按到期时间排序的堆，到期后移出；禁用设备通过缓存失效广播移出
+"""
+
+import asyncio
+import heapq
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from sqlalchemy import select
+from app.config import settings
+from app.database import async_session
+from app.models import Device
+from app.shared_cache import EPOCH, get_redis, redis_key
+
+
+class Presence(NamedTuple):
+    """在线设备"""
+    device_pk: int
+    device_id: str
+    application_id: int
+    expires_at: datetime
+    last_seen: datetime
+    ip_address: Optional[str]
+
+
+def _ts(value: datetime) -> float:
+    return (value - EPOCH).total_seconds()
+
+
+def _app_key(application_id: int) -> str:
+    return redis_key("presence", "app", str(application_id))
+
+
+def _expiring_key(application_id: int) -> str:
+    return redis_key("presence", "exp", str(application_id))
+
+
+def _info_key(device_pk: int) -> str:
+    return redis_key("presence", "dev", str(device_pk))
+
+
+def _encode(entry: Presence) -> str:
+    # device_id由客户端提供，可能包含分隔符，放在最后
+    expires_us = int(_ts(entry.expires_at) * 1000000)
+    return f"{entry.application_id}|{expires_us}|{entry.ip_address or ''}|{entry.device_id}"
+
+
+def _decode(device_pk: int, last_seen: float, value) -> Presence:
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    application_id, expires_us, ip_address, device_id = value.split("|", 3)
+    return Presence(
+        device_pk=device_pk,
+        device_id=device_id,
+        application_id=int(application_id),
+        expires_at=EPOCH + timedelta(microseconds=int(expires_us)),
+        last_seen=EPOCH + timedelta(seconds=last_seen),
+        ip_address=ip_address or None
+    )
+
+
+class PresenceTracker:
+    """按应用维护在线设备，按最后在线时间排序"""
+
+    def __init__(self, backend: str, timeout: float, flush_interval: float, workers: int = 1):
+        self.backend = backend
+        self.workers = workers
+        self.timeout = timeout
+        self._window = timedelta(seconds=timeout)
+        self.flush_interval = flush_interval
+        # 应用ID -> {设备ID: 在线记录}，按最后在线时间从旧到新排列
+        self._apps: Dict[int, "OrderedDict[int, Presence]"] = {}
+        self._where: Dict[int, int] = {}
+        # (授权到期时间, 设备ID)，只放超时前就会到期的设备
+        self._expiring: List[Tuple[datetime, int]] = []
+        # 尚未写入Redis的心跳和移除
+        self._pending: Dict[int, Presence] = {}
+        self._removed: Set[Tuple[int, int]] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        # 统计计数
+        self.touches = 0
+        self.timed_out = 0
+        self.expired = 0
+        self.revoked = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def _backend_name(self) -> str:
+        if self.backend in ("auto", "redis") and get_redis() is not None:
+            return "redis"
+        if self.backend == "sql" or (self.backend in ("auto", "redis") and self.workers > 1):
+            return "sql"
+        return "memory"
+
+    @property
+    def enabled(self) -> bool:
+        """为False时仪表盘仍查询devices表"""
+        return self._backend_name() != "sql"
+
+    def touch(
+        self,
+        device_pk: int,
+        device_id: str,
+        application_id: int,
+        expires_at: datetime,
+        now: datetime,
+        ip_address: Optional[str]
+    ):
+        """记录一次成功的心跳"""
+        if not self.enabled:
+            return
+        entry = Presence(device_pk, device_id, application_id, expires_at, now, ip_address)
+        devices = self._apps.get(application_id)
+        if devices is None:
+            devices = self._apps[application_id] = OrderedDict()
+        devices[device_pk] = entry
+        devices.move_to_end(device_pk)
+        self._where[device_pk] = application_id
+        if expires_at < now + self._window:
+            heapq.heappush(self._expiring, (expires_at, device_pk))
+        if self._backend_name() == "redis":
+            self._pending[device_pk] = entry
+        self.touches += 1
+
+    def _drop(self, device_pk: int) -> bool:
+        application_id = self._where.pop(device_pk, None)
+        if application_id is None:
+            return False
+        devices = self._apps[application_id]
+        del devices[device_pk]
+        if not devices:
+            del self._apps[application_id]
+        self._pending.pop(device_pk, None)
+        return True
+
+    def purge(self, now: datetime):
+        """淘汰超时未心跳和授权已到期的设备"""
+        cutoff = now - self._window
+        for application_id in list(self._apps):
+            devices = self._apps[application_id]
+            while devices:
+                device_pk, entry = next(iter(devices.items()))
+                if entry.last_seen > cutoff:
+                    break
+                devices.popitem(last=False)
+                del self._where[device_pk]
+                self.timed_out += 1
+            if not devices:
+                del self._apps[application_id]
+
+        while self._expiring and self._expiring[0][0] <= now:
+            _, device_pk = heapq.heappop(self._expiring)
+            application_id = self._where.get(device_pk)
+            if application_id is None:
+                continue
+            # 续期后的心跳会带上新的到期时间，以集合中的记录为准
+            if self._apps[application_id][device_pk].expires_at <= now:
+                self._drop(device_pk)
+                self._removed.add((application_id, device_pk))
+                self.expired += 1
+
+    def on_revoke(self, payload: str):
+        """设备被禁用（缓存失效广播，payload为"设备ID|到期时间戳"）"""
+        device_pk = int(payload.split("|", 1)[0])
+        if self._drop(device_pk):
+            self.revoked += 1
+
+    async def discard(self, application_id: int, device_pk: int):
+        """把设备移出在线集合（禁用设备时调用，Redis中的记录立即删除）"""
+        self._drop(device_pk)
+        if self._backend_name() != "redis":
+            return
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.zrem(_app_key(application_id), str(device_pk))
+                pipe.zrem(_expiring_key(application_id), str(device_pk))
+                pipe.delete(_info_key(device_pk))
+                await pipe.execute()
+        except Exception as e:
+            self._removed.add((application_id, device_pk))
+            self.errors += 1
+            print(f"[在线设备] 删除失败: {e}")
+
+    async def flush(self) -> int:
+        """把合并后的心跳写入Redis，返回写入的设备数"""
+        redis = get_redis()
+        if self._backend_name() != "redis":
+            self._removed.clear()
+            return 0
+        async with self._lock:
+            if not self._pending and not self._removed:
+                return 0
+            batch, self._pending = self._pending, {}
+            removed, self._removed = self._removed, set()
+            scores: Dict[int, Dict[str, float]] = {}
+            expiring: Dict[int, Dict[str, float]] = {}
+            renewed: Dict[int, List[str]] = {}
+            for device_pk, entry in batch.items():
+                scores.setdefault(entry.application_id, {})[str(device_pk)] = _ts(entry.last_seen)
+                if entry.expires_at < entry.last_seen + self._window:
+                    expiring.setdefault(entry.application_id, {})[str(device_pk)] = _ts(entry.expires_at)
+                else:
+                    renewed.setdefault(entry.application_id, []).append(str(device_pk))
+            try:
+                async with redis.pipeline(transaction=False) as pipe:
+                    for application_id, device_pk in removed:
+                        pipe.zrem(_app_key(application_id), str(device_pk))
+                        pipe.zrem(_expiring_key(application_id), str(device_pk))
+                        pipe.delete(_info_key(device_pk))
+                    for device_pk, entry in batch.items():
+                        pipe.set(_info_key(device_pk), _encode(entry), ex=int(self.timeout))
+                    for application_id, members in scores.items():
+                        # 其他worker可能已写入更新的心跳，分数只增不减
+                        pipe.zadd(_app_key(application_id), members, gt=True)
+                        pipe.expire(_app_key(application_id), int(self.timeout))
+                    for application_id, members in expiring.items():
+                        pipe.zadd(_expiring_key(application_id), members)
+                        pipe.expire(_expiring_key(application_id), int(self.timeout))
+                    for application_id, members in renewed.items():
+                        # 续期后超时前不会到期
+                        pipe.zrem(_expiring_key(application_id), *members)
+                    await pipe.execute()
+            except Exception as e:
+                # 写入失败时放回队列，保留期间产生的新心跳
+                for device_pk, entry in batch.items():
+                    self._pending.setdefault(device_pk, entry)
+                self._removed |= removed
+                self.errors += 1
+                print(f"[在线设备] 写入Redis失败: {e}")
+                return 0
+            self.flushes += 1
+            return len(batch)
+
+    def _local_online(self, application_ids: Iterable[int], limit: int) -> Tuple[int, List[Presence]]:
+        selected = [self._apps[a] for a in set(application_ids) if a in self._apps]
+        count = sum(len(devices) for devices in selected)
+        latest = heapq.merge(
+            *(reversed(devices.values()) for devices in selected),
+            key=lambda entry: entry.last_seen,
+            reverse=True
+        )
+        return count, list(islice(latest, limit))
+
+    async def _redis_online(self, application_ids: List[int], limit: int, now: datetime) -> Tuple[int, List[Presence]]:
+        redis = get_redis()
+        cutoff = _ts(now - self._window)
+        async with redis.pipeline(transaction=False) as pipe:
+            for application_id in application_ids:
+                pipe.zremrangebyscore(_app_key(application_id), "-inf", cutoff)
+                pipe.zrangebyscore(_expiring_key(application_id), "-inf", _ts(now))
+            results = await pipe.execute()
+
+        expired = {
+            application_id: members
+            for application_id, members in zip(application_ids, results[1::2]) if members
+        }
+        if expired:
+            # 授权已到期的设备不计入在线数，从在线集合和到期集合中删除
+            async with redis.pipeline(transaction=False) as pipe:
+                for application_id, members in expired.items():
+                    pipe.zrem(_app_key(application_id), *members)
+                    pipe.zrem(_expiring_key(application_id), *members)
+                    pipe.delete(*(_info_key(int(member)) for member in members))
+                await pipe.execute()
+
+        async with redis.pipeline(transaction=False) as pipe:
+            for application_id in application_ids:
+                key = _app_key(application_id)
+                pipe.zcard(key)
+                if limit > 0:
+                    pipe.zrevrange(key, 0, limit - 1, withscores=True)
+            results = await pipe.execute()
+
+        step = 2 if limit > 0 else 1
+        count = 0
+        latest: List[Tuple[float, int]] = []
+        for i in range(0, len(results), step):
+            count += results[i]
+            if limit > 0:
+                latest.extend((score, int(member)) for member, score in results[i + 1])
+        latest = heapq.nlargest(limit, latest)
+        if not latest:
+            return count, []
+
+        values = await redis.mget([_info_key(device_pk) for _, device_pk in latest])
+        entries = []
+        for (score, device_pk), value in zip(latest, values):
+            # 设备记录已删除（禁用）或在读取期间到期
+            if value is None:
+                continue
+            entry = _decode(device_pk, score, value)
+            if entry.expires_at > now:
+                entries.append(entry)
+        return count, entries
+
+    async def online(self, application_ids: Iterable[int], limit: int) -> Tuple[int, List[Presence]]:
+        """指定应用的在线设备数，以及最近在线的limit台设备（按最后在线时间倒序）"""
+        application_ids = list(application_ids)
+        limit = max(limit, 0)
+        now = datetime.utcnow()
+        self.purge(now)
+        if not application_ids:
+            return 0, []
+        if self._backend_name() == "redis":
+            try:
+                return await self._redis_online(application_ids, limit, now)
+            except Exception as e:
+                # Redis不可用时退化为本进程看到的在线设备
+                self.errors += 1
+                print(f"[在线设备] 读取Redis失败: {e}")
+        return self._local_online(application_ids, limit)
+
+    async def load(self):
+        """从devices表载入超时时间内有心跳的设备（重启后进程内的在线状态为空）"""
+        now = datetime.utcnow()
+        async with async_session() as db:
+            result = await db.execute(
+                select(
+                    Device.id, Device.device_id, Device.application_id,
+                    Device.expires_at, Device.last_heartbeat, Device.ip_address
+                ).where(
+                    Device.is_active == True,
+                    Device.expires_at > now,
+                    Device.last_heartbeat > now - self._window
+                ).order_by(Device.last_heartbeat)
+            )
+            for row in result:
+                self.touch(row.id, row.device_id, row.application_id, row.expires_at, row.last_heartbeat, row.ip_address)
+
+    async def _run(self):
+        """后台循环：淘汰超时设备，把心跳写入Redis"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self.purge(datetime.utcnow())
+            await self.flush()
+
+    async def start(self):
+        """启动后台任务；只用进程内集合时先从数据库载入在线设备"""
+        if self.backend == "redis" and get_redis() is None:
+            print(f"[在线设备] 指定了redis但未连接Redis，改用{self._backend_name()}")
+        if not self.enabled:
+            return
+        if self._backend_name() == "memory":
+            await self.load()
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务并写入剩余心跳"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "backend": self._backend_name(),
+            "online": len(self._where),
+            "applications": len(self._apps),
+            "pending": len(self._pending),
+            "touches": self.touches,
+            "timed_out": self.timed_out,
+            "expired": self.expired,
+            "revoked": self.revoked,
+            "flushes": self.flushes,
+            "errors": self.errors,
+        }
+
+
+presence = PresenceTracker(
+    backend=settings.PRESENCE_BACKEND,
+    timeout=settings.HEARTBEAT_TIMEOUT,
+    flush_interval=settings.PRESENCE_FLUSH_INTERVAL,
+    workers=settings.WORKERS
+)
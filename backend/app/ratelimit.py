@@ -0,0 +1,315 @@
+"""
+速率限制模块
+GCRA（通用信元速率算法）限流：每个键只保存一个“理论到达时间”，检查为O(1)。
+先在进程内预检查（本进程已超限时直接拒绝，无需访问共享存储），
+再由共享后端统一计数，使多worker部署下的限额对整个集群生效：
+  - redis: 配置REDIS_URL时，使用Lua脚本原子更新
+  - shm:   单机多worker，使用共享内存文件（mmap + 文件锁）
+  - memory: 仅进程内计数
+"""
+
+import functools
+import hashlib
+import inspect
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from fastapi import Request
+from app.config import settings
+from app.shared_cache import get_redis, redis_key
+
+try:
+    import fcntl
+except ImportError:  # Windows不支持共享内存后端
+    fcntl = None
+
+_PERIODS = {
+    "second": 1, "seconds": 1,
+    "minute": 60, "minutes": 60,
+    "hour": 3600, "hours": 3600,
+    "day": 86400, "days": 86400,
+}
+
+
+class RateLimitExceeded(Exception):
+    """超出速率限制"""
+
+    def __init__(self, limit: str, retry_after: float):
+        super().__init__(f"超出速率限制: {limit}")
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+def parse_rate(rate: str) -> Tuple[int, float]:
+    """解析限额字符串，如"60/minute"、"10/5 minutes"，返回(次数, 周期秒数)"""
+    count, _, period = rate.partition("/")
+    period = period.strip().lower()
+    if " " in period:
+        multiple, period = period.split(None, 1)
+        seconds = int(multiple) * _PERIODS[period]
+    else:
+        seconds = _PERIODS[period]
+    return int(count), float(seconds)
+
+
+def gcra(tat: float, now: float, interval: float, period: float) -> Tuple[bool, float, float]:
+    """
+    GCRA判定
+    tat: 上次记录的理论到达时间；interval: 每次请求占用的时间（周期/次数）；period: 允许的突发窗口
+    返回(是否允许, 新的理论到达时间, 需等待秒数)
+    """
+    new_tat = max(tat, now) + interval
+    if new_tat - now > period:
+        return False, tat, new_tat - now - period
+    return True, new_tat, 0.0
+
+
+def get_remote_address(request: Request) -> str:
+    """按连接来源地址限流（与原slowapi行为一致）"""
+    return request.client.host if request.client else "127.0.0.1"
+
+
+class LocalStore:
+    """
+    进程内理论到达时间表，按最近使用排序（读取和写入都移到末尾）；
+    超出容量时从最久未使用的一端淘汰到容量的90%，淘汰代价均摊到每次写入为O(1)
+    """
+
+    LOW_WATER = 0.9
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+        self.evicted = 0
+
+    def get(self, key: str) -> float:
+        tat = self._tats.get(key)
+        if tat is None:
+            return 0.0
+        self._tats.move_to_end(key)
+        return tat
+
+    def set(self, key: str, tat: float, now: float):
+        self._tats[key] = tat
+        self._tats.move_to_end(key)
+        if len(self._tats) > self.max_keys:
+            self.evict()
+
+    def evict(self):
+        """淘汰最久未使用的键（它们的理论到达时间通常早已过去，状态与新键相同）"""
+        target = int(self.max_keys * self.LOW_WATER)
+        while len(self._tats) > target:
+            self._tats.popitem(last=False)
+            self.evicted += 1
+
+    def __len__(self) -> int:
+        return len(self._tats)
+
+
+class SharedMemoryStore:
+    """
+    单机多worker共享的理论到达时间表
+    固定大小的哈希表映射到共享内存文件，每个槽位为(键哈希, 理论到达时间)，线性探测，
+    探测范围内没有空位时覆盖最早过期的槽位；每次更新持有文件排他锁
+    """
+
+    SLOT = struct.Struct("<Qd")
+    PROBES = 8
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # 0表示空槽位
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+    def update(self, key: str, now: float, interval: float, period: float) -> Tuple[bool, float]:
+        """原子地执行一次GCRA判定，返回(是否允许, 需等待秒数)"""
+        key_hash = self._hash(key)
+        start = key_hash % self.slots
+        slot_size = self.SLOT.size
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            target = None
+            target_tat = 0.0
+            oldest = None
+            oldest_tat = float("inf")
+            for i in range(self.PROBES):
+                offset = ((start + i) % self.slots) * slot_size
+                stored_hash, tat = self.SLOT.unpack_from(self._mm, offset)
+                if stored_hash == key_hash:
+                    target, target_tat = offset, tat
+                    break
+                if tat < oldest_tat:
+                    oldest, oldest_tat = offset, tat
+            if target is None:
+                # 空槽位的tat为0，已过期槽位的tat小于now，都会被优先选中
+                target, target_tat = oldest, 0.0
+
+            allowed, new_tat, retry_after = gcra(target_tat, now, interval, period)
+            if allowed:
+                self.SLOT.pack_into(self._mm, target, key_hash, new_tat)
+            return allowed, retry_after
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+# 在Redis服务器上原子执行GCRA，使用Redis时间避免各worker时钟偏差
+_GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < now then tat = now end
+local new_tat = tat + interval
+if new_tat - now > period then
+    return {0, tostring(new_tat - now - period)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return {1, '0'}
+"""
+
+
+class RateLimiter:
+    """速率限制器，提供与slowapi兼容的@limiter.limit("60/minute")装饰器"""
+
+    def __init__(
+        self,
+        key_func: Callable[[Request], str] = get_remote_address,
+        backend: str = "auto",
+        local_max_keys: int = 100000,
+        shm_path: str = "",
+        shm_slots: int = 65536
+    ):
+        self.key_func = key_func
+        self.backend = backend
+        self.enabled = True
+        self._local = LocalStore(local_max_keys)
+        self._shm: Optional[SharedMemoryStore] = None
+        self._shm_path = shm_path
+        self._shm_slots = shm_slots
+        self._script = None
+        self._script_client = None
+        # 统计计数
+        self.allowed = 0
+        self.rejected = 0
+        self.local_rejected = 0
+        self.errors = 0
+
+    def _shared_memory(self) -> Optional[SharedMemoryStore]:
+        """首次使用时打开共享内存文件（各worker各自映射同一文件）"""
+        if self._shm is None and self._shm_path:
+            if fcntl is None:
+                print("[速率限制] 当前平台不支持共享内存，使用进程内计数")
+                self._shm_path = ""
+                return None
+            try:
+                self._shm = SharedMemoryStore(self._shm_path, self._shm_slots)
+            except OSError as e:
+                print(f"[速率限制] 打开共享内存失败，使用进程内计数: {e}")
+                self._shm_path = ""
+        return self._shm
+
+    def _redis_script(self, redis):
+        if self._script is None or self._script_client is not redis:
+            self._script = redis.register_script(_GCRA_SCRIPT)
+            self._script_client = redis
+        return self._script
+
+    def _backend_name(self) -> str:
+        if self.backend in ("auto", "redis") and get_redis() is not None:
+            return "redis"
+        if self.backend == "shm" and self._shared_memory() is not None:
+            return "shm"
+        return "memory"
+
+    async def hit(self, key: str, limit: str, count: int, period: float):
+        """计入一次请求，超限时抛出RateLimitExceeded"""
+        if not self.enabled:
+            return
+        interval = period / count
+        now = time.time()
+
+        # 进程内预检查：本进程的计数不会超过全局计数，本地已超限则全局必然超限
+        allowed, local_tat, retry_after = gcra(self._local.get(key), now, interval, period)
+        if not allowed:
+            self.local_rejected += 1
+            self.rejected += 1
+            raise RateLimitExceeded(limit, retry_after)
+
+        backend = self._backend_name()
+        if backend == "redis":
+            try:
+                result = await self._redis_script(get_redis())(
+                    keys=[redis_key("rl", key)], args=[interval, period]
+                )
+                allowed, retry_after = bool(int(result[0])), float(result[1])
+            except Exception as e:
+                # Redis不可用时退化为进程内限流
+                self.errors += 1
+                print(f"[速率限制] Redis执行失败: {e}")
+        elif backend == "shm":
+            allowed, retry_after = self._shm.update(key, now, interval, period)
+
+        if allowed:
+            self._local.set(key, local_tat, now)
+            self.allowed += 1
+            return
+
+        # 全局已超限：本地记录到可以再次请求的时间，等待期间的请求在本地直接拒绝
+        self._local.set(key, now + retry_after + period - interval, now)
+        self.rejected += 1
+        raise RateLimitExceeded(limit, retry_after)
+
+    def limit(self, limit_value: str, key_func: Optional[Callable[[Request], str]] = None):
+        """路由限流装饰器，被装饰的函数需要有Request类型的request参数"""
+        count, period = parse_rate(limit_value)
+        key_func = key_func or self.key_func
+
+        def decorator(func):
+            if not inspect.iscoroutinefunction(func):
+                raise TypeError(f"{func.__name__}: 仅支持async路由")
+            params = inspect.signature(func).parameters
+            if "request" not in params:
+                raise TypeError(f"{func.__name__}: 限流路由需要request参数")
+            scope = f"{func.__module__}.{func.__name__}:{limit_value}"
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                request: Request = kwargs["request"]
+                await self.hit(f"{scope}:{key_func(request)}", limit_value, count, period)
+                return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        """清空进程内计数"""
+        self._local = LocalStore(self._local.max_keys)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self._backend_name(),
+            "local_keys": len(self._local),
+            "local_evicted": self._local.evicted,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "local_rejected": self.local_rejected,
+            "errors": self.errors,
+        }
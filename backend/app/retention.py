@@ -0,0 +1,205 @@
+"""
+心跳日志保留与清理模块
+后台任务定期清理超过保留期的heartbeat_logs和heartbeat_rollups：
+普通表按小批量删除，避免长时间锁表；PostgreSQL启用按天分区时直接删除过期分区。
+各worker都启动该任务，每轮先取得租约，只有一个worker执行删除和分区维护
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import delete, select, text
+from app.config import settings
+from app.database import async_session, engine
+from app.models import HeartbeatLog, HeartbeatRollup
+from app.leases import Lease
+
+PARTITION_PREFIX = "heartbeat_logs_p"
+
+# 按created_at范围分区的心跳日志表（主键必须包含分区键）
+PARTITIONED_LOGS_DDL = """
+CREATE TABLE IF NOT EXISTS heartbeat_logs (
+    id SERIAL,
+    device_id VARCHAR(100) NOT NULL,
+    application_id INTEGER NOT NULL,
+    ip_address VARCHAR(50),
+    status VARCHAR(20) NOT NULL,
+    message VARCHAR(255),
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at)
+"""
+
+
+def _is_postgresql() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+async def prepare_log_partitions():
+    """启用分区时，在create_all之前创建分区父表和默认分区（已有的普通表保持不变）"""
+    if not (settings.HEARTBEAT_LOG_PARTITIONING and _is_postgresql()):
+        return
+    async with engine.begin() as conn:
+        exists = await conn.scalar(text("SELECT to_regclass('heartbeat_logs') IS NOT NULL"))
+        if exists:
+            return
+        await conn.execute(text(PARTITIONED_LOGS_DDL))
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS heartbeat_logs_default PARTITION OF heartbeat_logs DEFAULT"
+        ))
+        print("[日志保留] 已创建按天分区的heartbeat_logs")
+
+
+class HeartbeatLogRetention:
+    """心跳日志定期清理任务"""
+
+    def __init__(
+        self,
+        retention_days: int,
+        rollup_retention_days: int,
+        batch_size: int,
+        interval: float,
+        partitions_ahead: int
+    ):
+        self.retention_days = retention_days
+        self.rollup_retention_days = rollup_retention_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.partitions_ahead = partitions_ahead
+        # 租约期限等于清理间隔：持有者下一轮可以续期，其他worker在租约过期前不会执行
+        self.lease = Lease("log_retention", interval)
+        self._task: Optional[asyncio.Task] = None
+        # 统计计数
+        self.deleted = 0
+        self.partitions_dropped = 0
+        self.runs = 0
+        self.last_run: Optional[datetime] = None
+
+    async def _is_partitioned(self) -> bool:
+        if not _is_postgresql():
+            return False
+        async with engine.connect() as conn:
+            relkind = await conn.scalar(text("SELECT relkind::text FROM pg_class WHERE relname = 'heartbeat_logs'"))
+        return relkind == "p"
+
+    async def _maintain_partitions(self, cutoff: datetime):
+        """创建未来几天的分区，删除整天都早于保留期的分区"""
+        today = datetime.utcnow().date()
+        async with engine.begin() as conn:
+            for offset in range(self.partitions_ahead + 1):
+                day = today + timedelta(days=offset)
+                name = f"{PARTITION_PREFIX}{day:%Y%m%d}"
+                try:
+                    async with conn.begin_nested():
+                        await conn.execute(text(
+                            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF heartbeat_logs "
+                            f"FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')"
+                        ))
+                except Exception as e:
+                    # 默认分区中已有该范围的数据时无法创建，保留在默认分区中按批删除
+                    print(f"[日志保留] 创建分区{name}失败: {e}")
+
+            result = await conn.execute(text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'heartbeat_logs'"
+            ))
+            for (name,) in result.all():
+                if not name.startswith(PARTITION_PREFIX):
+                    continue
+                try:
+                    day = datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m%d")
+                except ValueError:
+                    continue
+                if day + timedelta(days=1) <= cutoff:
+                    await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                    self.partitions_dropped += 1
+                    print(f"[日志保留] 已删除分区{name}")
+
+    async def _delete_in_batches(self, cutoff: datetime):
+        """分批删除过期日志，每批之间让出事件循环"""
+        while True:
+            async with async_session() as db:
+                ids = select(HeartbeatLog.id).where(
+                    HeartbeatLog.created_at < cutoff
+                ).limit(self.batch_size).scalar_subquery()
+                result = await db.execute(
+                    delete(HeartbeatLog).where(
+                        HeartbeatLog.created_at < cutoff,
+                        HeartbeatLog.id.in_(ids)
+                    ).execution_options(synchronize_session=False)
+                )
+                await db.commit()
+            self.deleted += result.rowcount
+            if result.rowcount < self.batch_size:
+                break
+            # 删除量大时执行时间可能超过租约期限，每批之后续期
+            if not await self.lease.acquire():
+                break
+            await asyncio.sleep(0.1)
+
+    async def _prune_rollups(self):
+        """汇总表数据量小，按保留期一次删除"""
+        cutoff = datetime.utcnow() - timedelta(days=self.rollup_retention_days)
+        async with async_session() as db:
+            await db.execute(
+                delete(HeartbeatRollup).where(
+                    HeartbeatRollup.minute < cutoff
+                ).execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+    async def run_once(self):
+        """执行一次清理"""
+        if self.retention_days > 0:
+            cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+            if await self._is_partitioned():
+                await self._maintain_partitions(cutoff)
+            # 普通表，或分区表的默认分区中残留的数据
+            await self._delete_in_batches(cutoff)
+        if self.rollup_retention_days > 0:
+            await self._prune_rollups()
+        self.runs += 1
+        self.last_run = datetime.utcnow()
+
+    async def _run(self):
+        while True:
+            try:
+                if await self.lease.acquire():
+                    await self.run_once()
+            except Exception as e:
+                print(f"[日志保留] 清理失败: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "retention_days": self.retention_days,
+            "deleted": self.deleted,
+            "partitions_dropped": self.partitions_dropped,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "lease": self.lease.stats(),
+        }
+
+
+log_retention = HeartbeatLogRetention(
+    retention_days=settings.HEARTBEAT_LOG_RETENTION_DAYS,
+    rollup_retention_days=settings.HEARTBEAT_ROLLUP_RETENTION_DAYS,
+    batch_size=settings.HEARTBEAT_LOG_PRUNE_BATCH_SIZE,
+    interval=settings.HEARTBEAT_LOG_PRUNE_INTERVAL,
+    partitions_ahead=settings.HEARTBEAT_LOG_PARTITIONS_AHEAD
+)
@@ -5,7 +5,8 @@ from typing import List
 from app.database import get_db
 from app.models import User, UserRole
 from app.schemas import AgentCreate, UserResponse
-from app.auth import get_password_hash, get_admin_user, get_agent_or_admin
+from app.auth import password_hasher, get_admin_user, get_agent_or_admin, invalidate_user
+from app.stats_counters import stats_counters
 
 router = APIRouter(prefix="/agents", tags=["代理管理"])
 
@@ -22,13 +23,14 @@ async def create_agent(
     
     agent = User(
         username=data.username,
-        password_hash=get_password_hash(data.password),
+        password_hash=await password_hasher.hash(data.password),
         role=UserRole.AGENT,
         parent_id=admin.id
     )
     db.add(agent)
     await db.commit()
     await db.refresh(agent)
+    stats_counters.add(agent.parent_id, total_users=1)
     return agent
 
 @router.get("", response_model=List[UserResponse])
@@ -56,6 +58,9 @@ async def toggle_agent_status(
     
     user.is_active = is_active
     await db.commit()
+    
+    # 清除认证缓存，禁用立即生效
+    await invalidate_user(user.id)
     return {"message": "状态更新成功", "is_active": is_active}
 
 @router.get("/sub-agents", response_model=List[UserResponse])
@@ -7,6 +7,8 @@ from app.database import get_db
 from app.models import Application, User
 from app.schemas import ApplicationCreate, ApplicationResponse, ApplicationPublic
 from app.auth import get_current_user, get_agent_or_admin
+from app.shared_cache import invalidation_bus
+from app.stats_counters import stats_counters
 
 router = APIRouter(prefix="/applications", tags=["应用管理"])
 
@@ -29,6 +31,9 @@ async def create_application(
     db.add(app)
     await db.commit()
     await db.refresh(app)
+    stats_counters.add(app.owner_id, total_apps=1)
+    # 清除可能存在的未命中缓存
+    await invalidation_bus.publish("app", app.app_key)
     return app
 
 @router.get("", response_model=List[ApplicationResponse])
@@ -84,6 +89,7 @@ async def update_application(
     app.heartbeat_interval = data.heartbeat_interval
     await db.commit()
     await db.refresh(app)
+    await invalidation_bus.publish("app", app.app_key)
     return app
 
 @router.delete("/{app_id}")
@@ -104,6 +110,8 @@ async def delete_application(
     
     await db.delete(app)
     await db.commit()
+    stats_counters.add(app.owner_id, total_apps=-1)
+    await invalidation_bus.publish("app", app.app_key)
     return {"message": "应用已删除"}
 
 @router.post("/{app_id}/regenerate-secret", response_model=ApplicationResponse)
@@ -125,4 +133,5 @@ async def regenerate_secret(
     app.app_secret = secrets.token_urlsafe(32)
     await db.commit()
     await db.refresh(app)
+    await invalidation_bus.publish("app", app.app_key)
     return app
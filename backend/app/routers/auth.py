@@ -4,7 +4,8 @@ from sqlalchemy import select
 from app.database import get_db
 from app.models import User, UserRole
 from app.schemas import UserLogin, UserCreate, TokenResponse, UserResponse
-from app.auth import verify_password, get_password_hash, create_access_token, get_current_user, get_admin_user
+from app.auth import password_hasher, create_access_token, get_current_user, get_admin_user, invalidate_user
+from app.stats_counters import stats_counters
 
 router = APIRouter(prefix="/auth", tags=["认证"])
 
@@ -14,7 +15,7 @@ async def login(data: UserLogin, db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(User).where(User.username == data.username))
     user = result.scalar_one_or_none()
     
-    if not user or not verify_password(data.password, user.password_hash):
+    if not user or not await password_hasher.verify(data.password, user.password_hash):
         raise HTTPException(status_code=401, detail="用户名或密码错误")
     
     if not user.is_active:
@@ -32,12 +33,13 @@ async def register(data: UserCreate, db: AsyncSession = Depends(get_db), admin:
     
     user = User(
         username=data.username,
-        password_hash=get_password_hash(data.password),
+        password_hash=await password_hasher.hash(data.password),
         role=data.role
     )
     db.add(user)
     await db.commit()
     await db.refresh(user)
+    stats_counters.add(user.parent_id, total_users=1)
     return user
 
 @router.get("/me", response_model=UserResponse)
@@ -58,12 +60,16 @@ async def change_password(
     if not old_password or not new_password:
         raise HTTPException(status_code=400, detail="缺少密码参数")
     
-    if not verify_password(old_password, current_user.password_hash):
+    if not await password_hasher.verify(old_password, current_user.password_hash):
         raise HTTPException(status_code=400, detail="原密码错误")
     
     if len(new_password) < 6:
         raise HTTPException(status_code=400, detail="新密码长度至少6位")
     
-    current_user.password_hash = get_password_hash(new_password)
+    # current_user可能是认证缓存中的副本，需在当前会话中重新加载
+    user = await db.get(User, current_user.id)
+    user.password_hash = await password_hasher.hash(new_password)
     await db.commit()
+    
+    await invalidate_user(user.id)
     return {"message": "密码修改成功"}
@@ -1,44 +1,48 @@
 import secrets
 import hashlib
-from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends, HTTPException, Query, Request
-from fastapi.responses import StreamingResponse
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, func
+from sqlalchemy import select, insert, update, func, cast, literal, tuple_, DateTime, String
 from typing import List, Optional
-import csv
-import io
+from app.config import settings
 from app.database import get_db
-from app.models import Card, CardType, Application, User, Device, UserRole
-from app.schemas import CardCreate, CardResponse, CardActivate, CardActivateResponse
+from app.models import Card, CardBatch, CardType, Application, User, Device, UserRole
+from app.schemas import CardCreate, CardResponse, CardBatchResponse, CardActivate, CardActivateResponse
 from app.auth import get_current_user, get_agent_or_admin
 from app.middleware import limiter, verify_nonce, record_failed_attempt, get_client_ip
-from app.pagination import PaginationParams, PaginatedResponse
-from app.exceptions import NotFoundError, ForbiddenError
+from app.pagination import PaginationParams, PaginatedResponse, encode_cursor, decode_cursor
+from app.exceptions import NotFoundError, ForbiddenError, ValidationError
+from app.cache import card_counts, MISSING
+from app.shared_cache import invalidation_bus
+from app.device_tokens import issue_token, signing_key
+from app.card_issuer import card_issuer, RESULT_COLUMNS
+from app.card_search import card_search, compact_card_key
+from app.stats_counters import stats_counters
+from app.export import stream_rows, iterate_chunks, json_array, ndjson_lines, csv_lines, gzip_stream
 
 router = APIRouter(prefix="/cards", tags=["卡密管理"])
 
-CARD_DURATION = {
-    CardType.DAY: 1,
-    CardType.WEEK: 7,
-    CardType.MONTH: 30,
-    CardType.YEAR: 365,
-    CardType.PERMANENT: 36500,  # 100年
-}
-
-def generate_card_key() -> str:
-    """生成卡密格式: XXXX-XXXX-XXXX-XXXX"""
-    chars = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
-    parts = [''.join(secrets.choice(chars) for _ in range(4)) for _ in range(4)]
-    return '-'.join(parts)
+async def _get_batch(batch_id: str, db: AsyncSession, current_user: User) -> CardBatch:
+    batch = await db.get(CardBatch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="生成任务不存在")
+    if current_user.role != UserRole.ADMIN and batch.creator_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权查看此生成任务")
+    return batch
 
-@router.post("", response_model=List[CardResponse])
+@router.post("")
 async def create_cards(
     data: CardCreate,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_agent_or_admin)
 ):
-    """批量生成卡密"""
+    """
+    批量生成卡密
+    数量不超过CARD_SYNC_MAX_COUNT时全部写入并提交后返回生成的卡密（JSON数组，结构同CardResponse）；
+    超出时转为后台任务，返回202和任务状态，通过/cards/jobs/{job_id}查询进度和结果
+    """
     # 验证应用存在
     result = await db.execute(select(Application).where(Application.id == data.application_id))
     app = result.scalar_one_or_none()
@@ -49,24 +53,36 @@ async def create_cards(
     if current_user.role != UserRole.ADMIN and app.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="无权为此应用生成卡密")
     
-    duration_days = CARD_DURATION.get(data.card_type, 30)
-    cards = []
+    if not 1 <= data.count <= settings.CARD_MAX_COUNT:
+        raise HTTPException(status_code=400, detail=f"生成数量需在1到{settings.CARD_MAX_COUNT}之间")
     
-    for _ in range(data.count):
-        card = Card(
-            card_key=generate_card_key(),
-            card_type=data.card_type,
-            duration_days=duration_days,
-            application_id=data.application_id,
-            creator_id=current_user.id
-        )
-        db.add(card)
-        cards.append(card)
+    if data.count > settings.CARD_SYNC_MAX_COUNT:
+        batch = await card_issuer.start_job(data.application_id, current_user.id, data.card_type, data.count)
+        return JSONResponse(status_code=202, content=card_issuer.describe(batch).model_dump(mode="json"))
     
-    await db.commit()
-    for card in cards:
-        await db.refresh(card)
-    return cards
+    batches = await card_issuer.issue(data.application_id, current_user.id, data.card_type, data.count)
+    return StreamingResponse(json_array(iterate_chunks(batches)), media_type="application/json")
+
+@router.get("/jobs/{job_id}", response_model=CardBatchResponse)
+async def get_card_job(
+    job_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_agent_or_admin)
+):
+    """查询批量生成任务的进度"""
+    batch = await _get_batch(job_id, db, current_user)
+    return card_issuer.describe(batch)
+
+@router.get("/jobs/{job_id}/cards")
+async def get_card_job_cards(
+    job_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_agent_or_admin)
+):
+    """流式返回批量生成任务已生成的卡密（任务进行中时返回已提交的部分）"""
+    await _get_batch(job_id, db, current_user)
+    query = select(*RESULT_COLUMNS).where(Card.batch_id == job_id).order_by(Card.id)
+    return StreamingResponse(json_array(stream_rows(query)), media_type="application/json")
 
 @router.get("")
 async def list_cards(
@@ -74,45 +90,71 @@ async def list_cards(
     is_used: Optional[bool] = Query(None, description="是否已使用"),
     card_type: Optional[CardType] = Query(None, description="卡密类型"),
     keyword: Optional[str] = Query(None, description="搜索关键词"),
+    cursor: Optional[str] = Query(None, description="分页游标（上一次返回的next_cursor或prev_cursor），传入时忽略page"),
     page: int = Query(1, ge=1, description="页码"),
     page_size: int = Query(20, ge=1, le=100, description="每页数量"),
+    with_total: bool = Query(True, description="是否返回总数（按过滤条件缓存CARD_COUNT_CACHE_TTL秒）"),
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_agent_or_admin)
 ):
-    """获取卡密列表（支持分页和搜索）"""
-    # 基础查询
-    base_query = select(Card)
-    count_query = select(func.count(Card.id))
-    
+    """
+    获取卡密列表（支持分页和搜索）
+    按(created_at, id)倒序排列；传入cursor时从游标位置继续读取（keyset分页），
+    任意一页的代价与第一页相同，只传page时按偏移量分页
+    """
     # 非管理员只能看自己创建的
-    if current_user.role != UserRole.ADMIN:
-        base_query = base_query.where(Card.creator_id == current_user.id)
-        count_query = count_query.where(Card.creator_id == current_user.id)
+    creator_id = None if current_user.role == UserRole.ADMIN else current_user.id
     
     # 过滤条件
+    filters = []
+    if creator_id is not None:
+        filters.append(Card.creator_id == creator_id)
     if application_id:
-        base_query = base_query.where(Card.application_id == application_id)
-        count_query = count_query.where(Card.application_id == application_id)
+        filters.append(Card.application_id == application_id)
     if is_used is not None:
-        base_query = base_query.where(Card.is_used == is_used)
-        count_query = count_query.where(Card.is_used == is_used)
+        filters.append(Card.is_used == is_used)
     if card_type:
-        base_query = base_query.where(Card.card_type == card_type)
-        count_query = count_query.where(Card.card_type == card_type)
+        filters.append(Card.card_type == card_type)
     if keyword:
-        base_query = base_query.where(Card.card_key.contains(keyword))
-        count_query = count_query.where(Card.card_key.contains(keyword))
-    
-    # 获取总数
-    total = await db.scalar(count_query) or 0
-    
-    # 分页查询
-    offset = (page - 1) * page_size
-    base_query = base_query.order_by(Card.created_at.desc()).offset(offset).limit(page_size)
-    result = await db.execute(base_query)
-    items = result.scalars().all()
-    
-    total_pages = (total + page_size - 1) // page_size if page_size > 0 else 0
+        filters.append(card_search.keyword_filter(keyword))
+    
+    # 获取总数（缓存）
+    total = None
+    if with_total:
+        count_key = (creator_id, application_id, is_used, card_type, keyword)
+        total = card_counts.get(count_key)
+        if total is MISSING:
+            total = await db.scalar(select(func.count(Card.id)).where(*filters)) or 0
+            card_counts.set(count_key, total)
+    
+    # 分页查询（多取一条判断是否还有下一页）
+    sort_key = tuple_(Card.created_at, Card.id)
+    query = select(Card).where(*filters)
+    direction = "next"
+    if cursor:
+        values, direction = decode_cursor(cursor)
+        try:
+            position = tuple_(datetime.fromisoformat(values[0]), int(values[1]))
+        except (ValueError, TypeError, IndexError):
+            raise ValidationError("无效的分页游标")
+        if direction == "next":
+            query = query.where(sort_key < position).order_by(Card.created_at.desc(), Card.id.desc())
+        else:
+            query = query.where(sort_key > position).order_by(Card.created_at.asc(), Card.id.asc())
+    else:
+        query = query.order_by(Card.created_at.desc(), Card.id.desc()).offset((page - 1) * page_size)
+    result = await db.execute(query.limit(page_size + 1))
+    items = list(result.scalars().all())
+    more = len(items) > page_size
+    items = items[:page_size]
+    
+    if direction == "prev":
+        items.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = bool(cursor) or page > 1, more
+    
+    total_pages = (total + page_size - 1) // page_size if total is not None else None
     
     return {
         "items": [CardResponse.model_validate(item) for item in items],
@@ -120,20 +162,47 @@ async def list_cards(
         "page": page,
         "page_size": page_size,
         "total_pages": total_pages,
-        "has_next": page < total_pages,
-        "has_prev": page > 1
+        "has_next": has_next,
+        "has_prev": has_prev,
+        "next_cursor": encode_cursor([items[-1].created_at, items[-1].id]) if has_next and items else None,
+        "prev_cursor": encode_cursor([items[0].created_at, items[0].id], "prev") if has_prev and items else None
     }
 
-@router.get("/export/csv")
-async def export_cards_csv(
+CARD_TYPE_NAMES = {
+    CardType.DAY: '日卡',
+    CardType.WEEK: '周卡',
+    CardType.MONTH: '月卡',
+    CardType.YEAR: '年卡',
+    CardType.PERMANENT: '永久',
+}
+
+CSV_HEADER = ['卡密', '类型', '时长(天)', '状态', '创建时间', '激活时间', '到期时间']
+
+def _format_time(value: Optional[datetime]) -> str:
+    return value.isoformat(' ', 'seconds') if value else ''
+
+def _csv_row(card: dict) -> list:
+    return [
+        card["card_key"],
+        CARD_TYPE_NAMES.get(card["card_type"], card["card_type"].value),
+        card["duration_days"],
+        '已使用' if card["is_used"] else '未使用',
+        _format_time(card["created_at"]),
+        _format_time(card["used_at"]),
+        _format_time(card["expires_at"])
+    ]
+
+@router.get("/export/{export_format}")
+async def export_cards(
+    export_format: str = Path(..., pattern="^(csv|ndjson)$", description="导出格式: csv / ndjson"),
     application_id: Optional[int] = Query(None, description="应用ID"),
     is_used: Optional[bool] = Query(None, description="是否已使用"),
     card_type: Optional[CardType] = Query(None, description="卡密类型"),
-    db: AsyncSession = Depends(get_db),
+    gzip: bool = Query(False, description="是否gzip压缩"),
     current_user: User = Depends(get_agent_or_admin)
 ):
-    """导出卡密为CSV文件"""
-    query = select(Card)
+    """导出卡密（CSV或NDJSON，边查询边输出，内存占用与卡密数量无关）"""
+    query = select(*RESULT_COLUMNS)
     
     if current_user.role != UserRole.ADMIN:
         query = query.where(Card.creator_id == current_user.id)
@@ -146,31 +215,24 @@ async def export_cards_csv(
         query = query.where(Card.card_type == card_type)
     
     query = query.order_by(Card.created_at.desc())
-    result = await db.execute(query)
-    cards = result.scalars().all()
-    
-    # 生成CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['卡密', '类型', '时长(天)', '状态', '创建时间', '激活时间', '到期时间'])
-    
-    type_names = {'day': '日卡', 'week': '周卡', 'month': '月卡', 'year': '年卡', 'permanent': '永久'}
-    for card in cards:
-        writer.writerow([
-            card.card_key,
-            type_names.get(card.card_type.value, card.card_type.value),
-            card.duration_days,
-            '已使用' if card.is_used else '未使用',
-            card.created_at.strftime('%Y-%m-%d %H:%M:%S') if card.created_at else '',
-            card.activated_at.strftime('%Y-%m-%d %H:%M:%S') if card.activated_at else '',
-            card.expires_at.strftime('%Y-%m-%d %H:%M:%S') if card.expires_at else ''
-        ])
-    
-    output.seek(0)
+    rows = stream_rows(query)
+    
+    if export_format == "csv":
+        body = csv_lines(rows, CSV_HEADER, _csv_row)
+        media_type = "text/csv"
+    else:
+        body = ndjson_lines(rows)
+        media_type = "application/x-ndjson"
+    filename = f"cards_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    if gzip:
+        body = gzip_stream(body)
+        media_type = "application/gzip"
+        filename += ".gz"
+    
     return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=cards_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"}
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 @router.get("/{card_key}", response_model=CardResponse)
@@ -209,8 +271,21 @@ async def delete_card(
     
     await db.delete(card)
     await db.commit()
+    stats_counters.add(card.creator_id, total_cards=-1)
+    await invalidation_bus.publish("cards", card_key)
     return {"message": "卡密已删除"}
 
+def _expiry(dialect: str, now: datetime):
+    """到期时间 = 激活时间 + 卡密有效天数，在认领卡密的UPDATE中计算"""
+    if dialect == "postgresql":
+        return literal(now, DateTime) + func.make_interval(0, 0, 0, Card.duration_days)
+    # SQLite：输出与SQLAlchemy存储DateTime相同的格式（激活时间已取整到秒）
+    return func.strftime(
+        "%Y-%m-%d %H:%M:%S.000000",
+        literal(now, DateTime),
+        literal("+") + cast(Card.duration_days, String) + literal(" days")
+    )
+
 @router.post("/activate", response_model=CardActivateResponse)
 @limiter.limit("10/minute")
 async def activate_card(
@@ -223,69 +298,118 @@ async def activate_card(
     
     # 防重放检查（如果提供了nonce）
     nonce = request.headers.get("X-Nonce")
-    if nonce and not verify_nonce(nonce):
-        record_failed_attempt(client_ip)
+    if nonce and not await verify_nonce(nonce):
+        await record_failed_attempt(client_ip)
         return CardActivateResponse(success=False, message="请求已过期或重复")
     
     # 标准化卡密格式
-    card_key = data.card_key.upper().replace(" ", "").replace("-", "")
+    card_key = compact_card_key(data.card_key)
     card_key = '-'.join([card_key[i:i+4] for i in range(0, len(card_key), 4)])
     
-    # 查找卡密
-    result = await db.execute(select(Card).where(Card.card_key == card_key))
-    card = result.scalar_one_or_none()
-    
-    if not card:
-        record_failed_attempt(client_ip)
-        return CardActivateResponse(success=False, message="卡密不存在")
-    
-    if card.is_used:
-        return CardActivateResponse(success=False, message="卡密已被使用")
-    
-    # 获取应用信息
-    result = await db.execute(select(Application).where(Application.id == card.application_id))
-    app = result.scalar_one_or_none()
-    if not app or not app.is_active:
-        return CardActivateResponse(success=False, message="应用不可用")
+    now = datetime.utcnow()
+    # 到期时间从取整到秒的激活时间算起（SQLite按存储格式在SQL中计算）
+    activated_at = now.replace(microsecond=0)
+    
+    # 卡密可绑定的设备数（应用不可用时为NULL，条件不成立）
+    max_devices = (
+        select(func.coalesce(Application.max_devices, 1))
+        .where(Application.id == Card.application_id, Application.is_active == True)
+        .scalar_subquery()
+    )
+    # 该设备是否已绑定此卡密
+    bound = (
+        select(Device.id)
+        .where(Device.card_key == card_key, Device.device_id == data.device_id, Device.is_active == True)
+        .exists()
+    )
     
-    # 检查设备数量限制
+    # 条件更新认领一个设备名额：名额未满、设备未绑定且应用可用时才会更新，
+    # 并发激活同一卡密时行锁保证device_count不会超过上限。
+    # 首次激活记录使用者和到期时间，之后绑定的设备沿用同一到期时间
     result = await db.execute(
-        select(Device).where(
-            and_(
-                Device.application_id == app.id,
-                Device.user_token == data.device_id,
-                Device.is_active == True
-            )
+        update(Card.__table__)
+        .where(Card.card_key == card_key, Card.device_count < max_devices, ~bound)
+        .values(
+            device_count=Card.device_count + 1,
+            is_used=True,
+            used_by=func.coalesce(Card.used_by, data.device_id),
+            used_at=func.coalesce(Card.used_at, now),
+            expires_at=func.coalesce(Card.expires_at, _expiry(db.bind.dialect.name, activated_at))
+        )
+        .returning(
+            Card.application_id,
+            Card.expires_at,
+            Card.creator_id,
+            Card.used_at,
+            select(Application.owner_id).where(Application.id == Card.application_id).scalar_subquery()
         )
     )
-    existing_devices = result.scalars().all()
+    claimed = result.one_or_none()
+    
+    if claimed is None:
+        # 认领失败时再查询原因；SQLite的UPDATE即使没有匹配行也持有写锁，先结束事务
+        if db.bind.dialect.name == "sqlite":
+            await db.rollback()
+        result = await db.execute(
+            select(
+                Card.device_count,
+                func.coalesce(Application.max_devices, 1).label("max_devices"),
+                Application.is_active,
+                bound.label("bound")
+            )
+            .join(Application, Card.application_id == Application.id)
+            .where(Card.card_key == card_key)
+        )
+        row = result.one_or_none()
+        if row is None:
+            await record_failed_attempt(client_ip)
+            return CardActivateResponse(success=False, message="卡密不存在")
+        if row.bound:
+            return CardActivateResponse(success=False, message="该设备已激活此卡密")
+        if row.device_count >= row.max_devices:
+            if row.max_devices <= 1:
+                return CardActivateResponse(success=False, message="卡密已被使用")
+            return CardActivateResponse(success=False, message="卡密绑定的设备数已达上限")
+        return CardActivateResponse(success=False, message="应用不可用")
     
-    # 计算到期时间
-    now = datetime.utcnow()
-    expires_at = now + timedelta(days=card.duration_days)
-    
-    # 生成用户token
-    user_token = secrets.token_urlsafe(32)
-    
-    # 更新卡密状态
-    card.is_used = True
-    card.used_by = data.device_id
-    card.used_at = now
-    card.expires_at = expires_at
-    
-    # 创建设备记录
-    device = Device(
-        device_id=data.device_id,
-        user_token=user_token,
-        application_id=app.id,
-        card_key=card.card_key,
-        expires_at=expires_at,
-        extra_info=data.extra_info
+    application_id, expires_at, creator_id, used_at, owner_id = claimed
+
+    # PostgreSQL中UPDATE等待行锁后只按新行重新检查条件，子查询仍使用语句开始时的快照，
+    # 看不到先拿到行锁的请求刚提交的设备；持有行锁后重新检查（同一卡密的激活在此串行）
+    if await db.scalar(select(bound)):
+        await db.rollback()
+        return CardActivateResponse(success=False, message="该设备已激活此卡密")
+
+    # 生成用户token（签名令牌需要设备记录ID，插入后再签发）
+    signed = settings.DEVICE_TOKEN_FORMAT == "signed"
+    user_token = "" if signed else secrets.token_urlsafe(32)
+    
+    # 在同一事务中创建设备记录
+    device_pk = await db.scalar(
+        insert(Device)
+        .values(
+            device_id=data.device_id,
+            user_token=user_token,
+            application_id=application_id,
+            card_key=card_key,
+            expires_at=expires_at,
+            extra_info=data.extra_info
+        )
+        .returning(Device.id)
     )
-    db.add(device)
+    if signed:
+        app_secret = await db.scalar(select(Application.app_secret).where(Application.id == application_id))
+        user_token = issue_token(device_pk, application_id, data.device_id, expires_at, signing_key(app_secret))
+        await db.execute(update(Device).where(Device.id == device_pk).values(user_token=user_token))
     await db.commit()
     
-    remaining_days = (expires_at - now).days
+    # 本次认领写入了used_at说明是首次激活，卡密变为已使用；卡密已到期时后绑定的设备不计入在线设备
+    if used_at == now:
+        stats_counters.add(creator_id, used_cards=1)
+    if expires_at > now:
+        stats_counters.add(owner_id, active_devices=1)
+    
+    remaining_days = (expires_at - activated_at).days
     
     return CardActivateResponse(
         success=True,
@@ -1,121 +1,161 @@
 from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_
-from app.database import get_db
-from app.models import User, Application, Card, Device, HeartbeatLog, UserRole
+from sqlalchemy import select, update, func, and_
+from app.database import get_db, async_session
+from app.models import User, Application, Card, Device, HeartbeatLog, HeartbeatRollup, StatsCounter, UserRole
 from app.schemas import DashboardStats
-from app.auth import get_admin_user, get_agent_or_admin, get_current_user
+from app.auth import get_admin_user, get_agent_or_admin, get_current_user, principal_cache, password_hasher
+from app.config import settings
+from app.cache import app_registry, card_counts, dashboard_cache
+from app.log_sink import log_sink
+from app.retention import log_retention
+from app.device_updates import device_updates
+from app.device_tokens import EPOCH, revoked_devices
+from app.shared_cache import auth_cache, invalidation_bus
+from app.pacing import heartbeat_pacer
+from app.middleware import limiter
+from app.ip_reputation import ip_reputation
+from app.nonce_cache import nonce_cache
+from app.card_issuer import card_issuer
+from app.card_search import card_search
+from app.stats_counters import GLOBAL_SCOPE, stats_counters
+from app.presence import presence
 
 router = APIRouter(prefix="/dashboard", tags=["仪表盘"])
 
+def _scope(user: User) -> int:
+    """缓存范围：管理员为全局，代理为自己的用户ID"""
+    return GLOBAL_SCOPE if user.role == UserRole.ADMIN else user.id
+
+async def _scope_app_ids(db: AsyncSession, scope: int) -> list:
+    """范围内的应用ID（应用表很小，按owner_id查询）"""
+    query = select(Application.id)
+    if scope != GLOBAL_SCOPE:
+        query = query.where(Application.owner_id == scope)
+    return list(await db.scalars(query))
+
+async def _load_stats(scope: int) -> DashboardStats:
+    online_devices = None
+    async with async_session() as db:
+        counter = await db.get(StatsCounter, scope)
+        # 在线设备数不在计数行中：另外查询范围内的应用ID（应用表很小），再从在线状态中读取
+        # （redis后端一次Redis往返，sql后端按应用和心跳时间查询devices表）；结果由dashboard_cache缓存
+        if presence.enabled:
+            online_devices, _ = await presence.online(await _scope_app_ids(db, scope), 0)
+    if counter is None:
+        return DashboardStats(
+            total_users=0, total_apps=0, total_cards=0, used_cards=0, active_devices=0,
+            online_devices=online_devices
+        )
+    
+    # 增量与到期扣减之间的短暂偏差不显示为负数
+    return DashboardStats(
+        total_users=max(counter.total_users, 0),
+        total_apps=max(counter.total_apps, 0),
+        total_cards=max(counter.total_cards, 0),
+        used_cards=max(counter.used_cards, 0),
+        active_devices=max(counter.active_devices, 0),
+        online_devices=online_devices
+    )
+
 @router.get("/stats", response_model=DashboardStats)
-async def get_stats(
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_agent_or_admin)
-):
-    """获取统计数据"""
-    now = datetime.utcnow()
+async def get_stats(current_user: User = Depends(get_agent_or_admin)):
+    """
+    获取统计数据（管理员看全局，代理看自己的范围）
+    各项计数按主键读取增量维护的计数行；启用在线状态时online_devices另需查询范围内的应用和在线设备数
+    """
+    scope = _scope(current_user)
+    return await dashboard_cache.get_or_load(("stats", scope), lambda: _load_stats(scope))
+
+async def _load_recent_heartbeats(scope: int, limit: int) -> list:
+    query = select(HeartbeatLog).order_by(HeartbeatLog.created_at.desc()).limit(limit)
     
-    if current_user.role == UserRole.ADMIN:
-        # 管理员看全部数据
-        total_users = await db.scalar(select(func.count(User.id)))
-        total_apps = await db.scalar(select(func.count(Application.id)))
-        total_cards = await db.scalar(select(func.count(Card.id)))
-        used_cards = await db.scalar(select(func.count(Card.id)).where(Card.is_used == True))
-        active_devices = await db.scalar(
-            select(func.count(Device.id)).where(
-                and_(Device.is_active == True, Device.expires_at > now)
+    async with async_session() as db:
+        if scope != GLOBAL_SCOPE:
+            # 获取代理的应用ID列表
+            app_ids = await db.scalars(
+                select(Application.id).where(Application.owner_id == scope)
             )
-        )
-    else:
-        # 代理只看自己的数据
-        total_users = await db.scalar(
-            select(func.count(User.id)).where(User.parent_id == current_user.id)
-        )
-        total_apps = await db.scalar(
-            select(func.count(Application.id)).where(Application.owner_id == current_user.id)
-        )
-        total_cards = await db.scalar(
-            select(func.count(Card.id)).where(Card.creator_id == current_user.id)
-        )
-        used_cards = await db.scalar(
-            select(func.count(Card.id)).where(
-                and_(Card.creator_id == current_user.id, Card.is_used == True)
-            )
-        )
-        # 获取代理的应用ID列表
-        app_ids = await db.scalars(
-            select(Application.id).where(Application.owner_id == current_user.id)
-        )
-        app_id_list = list(app_ids)
+            app_id_list = list(app_ids)
+            if app_id_list:
+                query = query.where(HeartbeatLog.application_id.in_(app_id_list))
+            else:
+                return []
         
-        if app_id_list:
-            active_devices = await db.scalar(
-                select(func.count(Device.id)).where(
-                    and_(
-                        Device.application_id.in_(app_id_list),
-                        Device.is_active == True,
-                        Device.expires_at > now
-                    )
-                )
-            )
-        else:
-            active_devices = 0
+        result = await db.execute(query)
+        logs = result.scalars().all()
     
-    return DashboardStats(
-        total_users=total_users or 0,
-        total_apps=total_apps or 0,
-        total_cards=total_cards or 0,
-        used_cards=used_cards or 0,
-        active_devices=active_devices or 0
-    )
+    return [
+        {
+            "id": log.id,
+            "device_id": log.device_id,
+            "application_id": log.application_id,
+            "ip_address": log.ip_address,
+            "status": log.status,
+            "message": log.message,
+            "created_at": log.created_at
+        }
+        for log in logs
+    ]
 
 @router.get("/recent-heartbeats")
 async def get_recent_heartbeats(
     limit: int = 20,
-    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_agent_or_admin)
 ):
     """获取最近心跳记录"""
-    query = select(HeartbeatLog).order_by(HeartbeatLog.created_at.desc()).limit(limit)
+    scope = _scope(current_user)
+    return await dashboard_cache.get_or_load(
+        ("recent-heartbeats", scope, limit), lambda: _load_recent_heartbeats(scope, limit)
+    )
+
+@router.get("/heartbeat-stats")
+async def get_heartbeat_stats(
+    minutes: int = Query(60, ge=1, le=1440, description="统计最近多少分钟"),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_agent_or_admin)
+):
+    """获取按分钟汇总的心跳统计（device_count为各应用不同设备数之和，按HyperLogLog估计，误差约3%）"""
+    since = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(minutes=minutes)
+    query = select(
+        HeartbeatRollup.minute,
+        HeartbeatRollup.status,
+        func.sum(HeartbeatRollup.heartbeat_count).label("heartbeat_count"),
+        func.sum(HeartbeatRollup.device_count).label("device_count")
+    ).where(
+        HeartbeatRollup.minute >= since
+    ).group_by(
+        HeartbeatRollup.minute, HeartbeatRollup.status
+    ).order_by(HeartbeatRollup.minute)
     
     if current_user.role != UserRole.ADMIN:
-        # 获取代理的应用ID列表
         app_ids = await db.scalars(
             select(Application.id).where(Application.owner_id == current_user.id)
         )
         app_id_list = list(app_ids)
         if app_id_list:
-            query = query.where(HeartbeatLog.application_id.in_(app_id_list))
+            query = query.where(HeartbeatRollup.application_id.in_(app_id_list))
         else:
             return []
     
     result = await db.execute(query)
-    logs = result.scalars().all()
-    
     return [
         {
-            "id": log.id,
-            "device_id": log.device_id,
-            "application_id": log.application_id,
-            "ip_address": log.ip_address,
-            "status": log.status,
-            "message": log.message,
-            "created_at": log.created_at
+            "minute": row.minute,
+            "status": row.status,
+            "heartbeat_count": row.heartbeat_count,
+            "device_count": row.device_count
         }
-        for log in logs
+        for row in result
     ]
 
-@router.get("/active-devices")
-async def get_active_devices(
-    limit: int = 50,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_agent_or_admin)
-):
-    """获取活跃设备列表"""
+async def _query_active_devices(scope: int, limit: int) -> list:
+    """PRESENCE_BACKEND=sql时按last_heartbeat查询devices表"""
     now = datetime.utcnow()
-    timeout = now - timedelta(seconds=180)
+    # 心跳时间合并写入，数据库中的值最多延迟DEVICE_UPDATE_MAX_STALENESS秒，
+    # 只要该延迟小于HEARTBEAT_TIMEOUT与心跳间隔之差，在线设备就不会被漏判
+    timeout = now - timedelta(seconds=settings.HEARTBEAT_TIMEOUT)
     
     query = select(Device).where(
         and_(
@@ -125,18 +165,19 @@ async def get_active_devices(
         )
     ).order_by(Device.last_heartbeat.desc()).limit(limit)
     
-    if current_user.role != UserRole.ADMIN:
-        app_ids = await db.scalars(
-            select(Application.id).where(Application.owner_id == current_user.id)
-        )
-        app_id_list = list(app_ids)
-        if app_id_list:
-            query = query.where(Device.application_id.in_(app_id_list))
-        else:
-            return []
-    
-    result = await db.execute(query)
-    devices = result.scalars().all()
+    async with async_session() as db:
+        if scope != GLOBAL_SCOPE:
+            app_ids = await db.scalars(
+                select(Application.id).where(Application.owner_id == scope)
+            )
+            app_id_list = list(app_ids)
+            if app_id_list:
+                query = query.where(Device.application_id.in_(app_id_list))
+            else:
+                return []
+        
+        result = await db.execute(query)
+        devices = result.scalars().all()
     
     return [
         {
@@ -150,3 +191,121 @@ async def get_active_devices(
         }
         for d in devices
     ]
+
+async def _load_active_devices(scope: int, limit: int) -> list:
+    if not presence.enabled:
+        return await _query_active_devices(scope, limit)
+    
+    async with async_session() as db:
+        app_ids = await _scope_app_ids(db, scope)
+    _, entries = await presence.online(app_ids, limit)
+    now = datetime.utcnow()
+    return [
+        {
+            "id": e.device_pk,
+            "device_id": e.device_id,
+            "application_id": e.application_id,
+            "expires_at": e.expires_at,
+            "last_heartbeat": e.last_seen,
+            "ip_address": e.ip_address,
+            "remaining_days": (e.expires_at - now).days
+        }
+        for e in entries
+    ]
+
+@router.get("/active-devices")
+async def get_active_devices(
+    limit: int = 50,
+    current_user: User = Depends(get_agent_or_admin)
+):
+    """获取在线设备列表（按最后心跳时间倒序）"""
+    scope = _scope(current_user)
+    return await dashboard_cache.get_or_load(
+        ("active-devices", scope, limit), lambda: _load_active_devices(scope, limit)
+    )
+
+@router.put("/devices/{device_pk}/status")
+async def toggle_device_status(
+    device_pk: int,
+    is_active: bool,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_agent_or_admin)
+):
+    """启用/禁用设备授权"""
+    device = await db.get(Device, device_pk)
+    if not device:
+        raise HTTPException(status_code=404, detail="设备不存在")
+    
+    if current_user.role != UserRole.ADMIN:
+        owner_id = await db.scalar(
+            select(Application.owner_id).where(Application.id == device.application_id)
+        )
+        if owner_id != current_user.id:
+            raise HTTPException(status_code=403, detail="无权操作此设备")
+    
+    # 条件更新：并发的相同操作只有一个改到状态，只由它调整卡密设备数和统计
+    result = await db.execute(
+        update(Device)
+        .where(Device.id == device.id, Device.is_active != is_active)
+        .values(is_active=is_active)
+    )
+    changed = result.rowcount == 1
+    if changed:
+        # 禁用设备释放其占用的卡密设备名额，重新启用时再占用（管理员操作不受上限限制）
+        await db.execute(
+            update(Card)
+            .where(Card.card_key == device.card_key)
+            .values(device_count=Card.device_count + (1 if is_active else -1))
+        )
+    await db.commit()
+    dashboard_cache.clear()
+    
+    # 签名令牌和授权缓存不查数据库，需同步各worker的吊销表并清除授权缓存
+    if is_active:
+        await invalidation_bus.publish("restore", str(device.id))
+    else:
+        expires_ts = int((device.expires_at - EPOCH).total_seconds())
+        await invalidation_bus.publish("revoke", f"{device.id}|{expires_ts}")
+        await presence.discard(device.application_id, device.id)
+    app = (await db.execute(
+        select(Application.app_key, Application.owner_id).where(Application.id == device.application_id)
+    )).one_or_none()
+    if app:
+        await auth_cache.invalidate(app.app_key, device.user_token, device.device_id)
+        if changed and device.expires_at > datetime.utcnow():
+            stats_counters.add(app.owner_id, active_devices=1 if is_active else -1)
+    return {"message": "状态更新成功", "is_active": is_active}
+
+@router.put("/heartbeat-interval")
+async def set_heartbeat_interval(
+    min_interval: int = Query(..., ge=0, le=86400),
+    admin: User = Depends(get_admin_user)
+):
+    """设置所有客户端的最小心跳间隔（仅管理员），0为恢复按应用配置和负载计算，超过间隔上限时按上限生效"""
+    min_interval = await heartbeat_pacer.set_override(min_interval)
+    return {"message": "心跳间隔已更新", "min_interval": min_interval}
+
+@router.get("/runtime")
+async def get_runtime_stats(admin: User = Depends(get_admin_user)):
+    """获取运行时状态（仅管理员）"""
+    return {
+        "log_sink": log_sink.stats(),
+        "log_retention": log_retention.stats(),
+        "device_updates": device_updates.stats(),
+        "heartbeat_pacer": heartbeat_pacer.stats(),
+        "app_cache": app_registry.stats(),
+        "card_counts": card_counts.stats(),
+        "dashboard_cache": dashboard_cache.stats(),
+        "card_search": card_search.stats(),
+        "principal_cache": principal_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "card_issuer": card_issuer.stats(),
+        "stats_counters": stats_counters.stats(),
+        "presence": presence.stats(),
+        "revoked_devices": len(revoked_devices),
+        "auth_cache": auth_cache.stats(),
+        "invalidation_bus": invalidation_bus.stats(),
+        "rate_limiter": limiter.stats(),
+        "ip_reputation": ip_reputation.stats(),
+        "nonce_cache": nonce_cache.stats()
+    }
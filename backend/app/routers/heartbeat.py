@@ -1,124 +1,242 @@
 from datetime import datetime
-from fastapi import APIRouter, Depends, Request
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_
+from app.config import settings
 from app.database import get_db
-from app.models import Application, Device, HeartbeatLog
+from app.models import Device
 from app.schemas import HeartbeatRequest, HeartbeatResponse
 from app.middleware import limiter, get_client_ip, record_failed_attempt
+from app.cache import AppInfo, app_registry
+from app.log_sink import log_sink
+from app.device_updates import device_updates
+from app.presence import presence
+from app.pacing import heartbeat_pacer
+from app.metrics import heartbeat_results
+from app.device_tokens import is_signed_token, verify_token, signing_key, revoked_devices
+from app.shared_cache import CachedAuth, auth_cache
 
 router = APIRouter(prefix="/heartbeat", tags=["心跳验证"])
 
-@router.post("", response_model=HeartbeatResponse)
-@limiter.limit("60/minute")
-async def heartbeat(
-    data: HeartbeatRequest,
-    request: Request,
-    db: AsyncSession = Depends(get_db)
-):
-    """心跳验证接口 - 带速率限制"""
-    now = datetime.utcnow()
-    client_ip = get_client_ip(request)
-    
-    # 验证应用
-    result = await db.execute(select(Application).where(Application.app_key == data.app_key))
-    app = result.scalar_one_or_none()
-    
-    if not app:
-        return HeartbeatResponse(
-            success=False,
-            message="应用不存在",
-            server_time=now
-        )
-    
-    if not app.is_active:
-        return HeartbeatResponse(
-            success=False,
-            message="应用已禁用",
-            server_time=now
-        )
-    
-    # 验证设备
-    result = await db.execute(
-        select(Device).where(
-            and_(
-                Device.application_id == app.id,
-                Device.user_token == data.token,
-                Device.device_id == data.device_id
-            )
-        )
+class DeviceGrant(NamedTuple):
+    """设备授权状态（来自签名令牌或数据库）"""
+    device_pk: int
+    is_active: bool
+    expires_at: datetime
+
+def _signed_grant(app: AppInfo, data: HeartbeatRequest) -> Optional[DeviceGrant]:
+    """校验签名令牌，只用CPU，不读数据库"""
+    lease = verify_token(data.token, app.id, data.device_id, signing_key(app.app_secret))
+    if lease is None:
+        return None
+    return DeviceGrant(
+        device_pk=lease.device_pk,
+        is_active=not revoked_devices.is_revoked(lease.device_pk),
+        expires_at=lease.expires_at
     )
-    device = result.scalar_one_or_none()
+
+def _cached_grant(cached: Optional[CachedAuth]) -> Optional[DeviceGrant]:
+    """缓存或数据库中的授权状态，叠加吊销表（设备被禁用后立即生效）"""
+    if cached is None:
+        return None
+    return DeviceGrant(
+        device_pk=cached.device_pk,
+        is_active=cached.is_active and not revoked_devices.is_revoked(cached.device_pk),
+        expires_at=cached.expires_at
+    )
+
+def _check_grant(
+    app: AppInfo,
+    data: HeartbeatRequest,
+    grant: Optional[DeviceGrant],
+    client_ip: str,
+    now: datetime
+) -> HeartbeatResponse:
+    """根据设备授权状态生成心跳结果，日志和心跳时间交给写缓冲"""
+    # 按应用配置和服务器负载下发下次心跳间隔
+    next_interval, interval_jitter = heartbeat_pacer.next_interval(app.heartbeat_interval)
     
-    if not device:
-        # 记录失败日志
-        log = HeartbeatLog(
-            device_id=data.device_id,
-            application_id=app.id,
-            ip_address=client_ip,
-            status="invalid",
-            message="设备未授权"
-        )
-        db.add(log)
-        await db.commit()
+    if not grant:
+        # 记录失败日志（写缓冲，异步批量落库）
+        log_sink.submit(data.device_id, app.id, client_ip, "invalid", "设备未授权", now)
+        heartbeat_results.inc("invalid")
         
         return HeartbeatResponse(
             success=False,
             message="设备未授权",
-            server_time=now
+            server_time=now,
+            next_interval=next_interval,
+            interval_jitter=interval_jitter
         )
     
-    if not device.is_active:
+    if not grant.is_active:
+        heartbeat_results.inc("disabled")
         return HeartbeatResponse(
             success=False,
             message="设备已被禁用",
-            server_time=now
+            server_time=now,
+            next_interval=next_interval,
+            interval_jitter=interval_jitter
         )
     
     # 检查是否过期
-    if device.expires_at < now:
-        log = HeartbeatLog(
-            device_id=data.device_id,
-            application_id=app.id,
-            ip_address=client_ip,
-            status="expired",
-            message="授权已过期"
-        )
-        db.add(log)
-        await db.commit()
+    if grant.expires_at < now:
+        log_sink.submit(data.device_id, app.id, client_ip, "expired", "授权已过期", now)
+        heartbeat_results.inc("expired")
         
         return HeartbeatResponse(
             success=False,
             message="授权已过期",
-            expires_at=device.expires_at,
-            server_time=now
+            expires_at=grant.expires_at,
+            server_time=now,
+            next_interval=next_interval,
+            interval_jitter=interval_jitter
         )
     
-    # 更新心跳时间
-    device.last_heartbeat = now
-    device.ip_address = client_ip
+    # 更新心跳时间（合并后定期批量写入）
+    device_updates.touch(grant.device_pk, now, client_ip)
+    presence.touch(grant.device_pk, data.device_id, app.id, grant.expires_at, now, client_ip)
     
     # 记录成功日志
-    log = HeartbeatLog(
-        device_id=data.device_id,
-        application_id=app.id,
-        ip_address=client_ip,
-        status="success",
-        message="心跳成功"
-    )
-    db.add(log)
-    await db.commit()
+    log_sink.submit(data.device_id, app.id, client_ip, "success", "心跳成功", now)
+    heartbeat_results.inc("success")
     
-    remaining_seconds = int((device.expires_at - now).total_seconds())
+    remaining_seconds = int((grant.expires_at - now).total_seconds())
     
     return HeartbeatResponse(
         success=True,
         message="验证成功",
-        expires_at=device.expires_at,
+        expires_at=grant.expires_at,
         remaining_seconds=remaining_seconds,
-        server_time=now
+        server_time=now,
+        next_interval=next_interval,
+        interval_jitter=interval_jitter
     )
 
+def _check_app(app: Optional[AppInfo], now: datetime) -> Optional[HeartbeatResponse]:
+    """应用不存在或已禁用时返回失败结果"""
+    if not app:
+        heartbeat_results.inc("app_not_found")
+        return HeartbeatResponse(
+            success=False,
+            message="应用不存在",
+            server_time=now
+        )
+    
+    if not app.is_active:
+        heartbeat_results.inc("app_disabled")
+        return HeartbeatResponse(
+            success=False,
+            message="应用已禁用",
+            server_time=now
+        )
+    return None
+
+@router.post("", response_model=HeartbeatResponse)
+@limiter.limit("60/minute")
+async def heartbeat(
+    data: HeartbeatRequest,
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """心跳验证接口 - 带速率限制"""
+    now = datetime.utcnow()
+    client_ip = get_client_ip(request)
+    
+    # 验证应用（进程内缓存）
+    app = await app_registry.get(db, data.app_key)
+    failure = _check_app(app, now)
+    if failure:
+        return failure
+    
+    if is_signed_token(data.token):
+        return _check_grant(app, data, _signed_grant(app, data), client_ip, now)
+    
+    # 旧格式随机令牌：先查授权缓存，未命中再查询设备
+    cached = await auth_cache.get(data.app_key, data.token, data.device_id)
+    if cached is None:
+        result = await db.execute(
+            select(Device.id, Device.is_active, Device.expires_at).where(
+                and_(
+                    Device.application_id == app.id,
+                    Device.user_token == data.token,
+                    Device.device_id == data.device_id
+                )
+            )
+        )
+        row = result.one_or_none()
+        if row:
+            cached = CachedAuth(row.id, row.is_active, row.expires_at)
+            await auth_cache.set(data.app_key, data.token, data.device_id, cached)
+    return _check_grant(app, data, _cached_grant(cached), client_ip, now)
+
+@router.post("/batch", response_model=List[HeartbeatResponse])
+@limiter.limit("60/minute")
+async def heartbeat_batch(
+    items: List[HeartbeatRequest],
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """批量心跳接口 - 供代理多台终端的网关使用，按请求顺序返回结果"""
+    if len(items) > settings.HEARTBEAT_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"单次最多提交{settings.HEARTBEAT_BATCH_MAX_SIZE}条心跳"
+        )
+    
+    now = datetime.utcnow()
+    client_ip = get_client_ip(request)
+    
+    # 按应用分组，每个应用只查询一次
+    apps: Dict[str, Optional[AppInfo]] = {}
+    legacy_keys: Set[Tuple[str, str, str]] = set()
+    for item in items:
+        if item.app_key not in apps:
+            apps[item.app_key] = await app_registry.get(db, item.app_key)
+        app = apps[item.app_key]
+        if app and app.is_active and not is_signed_token(item.token):
+            legacy_keys.add((item.app_key, item.token, item.device_id))
+    
+    # 旧格式令牌：先批量查授权缓存，未命中的每个应用一次IN查询
+    cached = await auth_cache.get_many(legacy_keys)
+    missing_tokens: Dict[str, Set[str]] = {}
+    for app_key, token, device_id in legacy_keys:
+        if (app_key, token, device_id) not in cached:
+            missing_tokens.setdefault(app_key, set()).add(token)
+    
+    loaded: Dict[Tuple[str, str, str], CachedAuth] = {}
+    for app_key, tokens in missing_tokens.items():
+        result = await db.execute(
+            select(
+                Device.id, Device.user_token, Device.device_id, Device.is_active, Device.expires_at
+            ).where(
+                and_(
+                    Device.application_id == apps[app_key].id,
+                    Device.user_token.in_(tokens)
+                )
+            )
+        )
+        for row in result:
+            key = (app_key, row.user_token, row.device_id)
+            if key in legacy_keys:
+                loaded[key] = CachedAuth(row.id, row.is_active, row.expires_at)
+    await auth_cache.set_many(loaded)
+    cached.update(loaded)
+    
+    responses = []
+    for item in items:
+        app = apps[item.app_key]
+        failure = _check_app(app, now)
+        if failure:
+            responses.append(failure)
+        elif is_signed_token(item.token):
+            responses.append(_check_grant(app, item, _signed_grant(app, item), client_ip, now))
+        else:
+            grant = _cached_grant(cached.get((item.app_key, item.token, item.device_id)))
+            responses.append(_check_grant(app, item, grant, client_ip, now))
+    return responses
+
 @router.get("/status")
 async def get_status(
     app_key: str,
@@ -129,8 +247,7 @@ async def get_status(
     """查询授权状态"""
     now = datetime.utcnow()
     
-    result = await db.execute(select(Application).where(Application.app_key == app_key))
-    app = result.scalar_one_or_none()
+    app = await app_registry.get(db, app_key)
     
     if not app:
         return {"authorized": False, "message": "应用不存在"}
@@ -159,11 +276,15 @@ async def get_status(
     remaining_days = (device.expires_at - now).days
     remaining_seconds = int((device.expires_at - now).total_seconds())
     
+    # 优先返回尚未落库的最新心跳时间
+    pending = device_updates.pending(device.id)
+    last_heartbeat = pending[0] if pending else device.last_heartbeat
+    
     return {
         "authorized": True,
         "message": "授权有效",
         "expires_at": device.expires_at,
         "remaining_days": remaining_days,
         "remaining_seconds": remaining_seconds,
-        "last_heartbeat": device.last_heartbeat
+        "last_heartbeat": last_heartbeat
     }
@@ -80,6 +80,20 @@ class CardResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class CardBatchResponse(BaseModel):
+    id: str
+    application_id: int
+    card_type: CardType
+    count: int
+    issued: int
+    status: str  # pending, running, completed, failed
+    error: Optional[str]
+    created_at: datetime
+    finished_at: Optional[datetime]
+    
+    class Config:
+        from_attributes = True
+
 class CardActivate(BaseModel):
     card_key: str
     device_id: str
@@ -104,6 +118,8 @@ class HeartbeatResponse(BaseModel):
     expires_at: Optional[datetime] = None
     remaining_seconds: Optional[int] = None
     server_time: datetime
+    next_interval: Optional[int] = None  # 下次心跳间隔（秒）
+    interval_jitter: Optional[int] = None  # 客户端在间隔上加减的随机抖动范围（秒）
 
 # ==================== 代理相关 ====================
 class AgentCreate(BaseModel):
@@ -117,6 +133,7 @@ class DashboardStats(BaseModel):
     total_cards: int
     used_cards: int
     active_devices: int
+    online_devices: Optional[int] = None  # 超时时间内有心跳的设备数（PRESENCE_BACKEND=sql时不统计）
 
 # ==================== 设备相关 ====================
 class DeviceResponse(BaseModel):
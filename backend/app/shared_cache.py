@@ -0,0 +1,335 @@
+"""
+跨进程共享缓存模块
+配置REDIS_URL时，设备授权缓存存放在Redis中，并通过Redis发布/订阅在各worker间广播缓存失效；
+未配置时退化为进程内缓存和进程内广播；订阅连接断开后自动重连，重连后重新同步本地缓存
+"""
+
+import asyncio
+import hashlib
+import inspect
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from app.config import settings
+from app.cache import MISSING, TTLCache
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # 未安装redis时只能使用本地缓存
+    aioredis = None
+
+EPOCH = datetime(1970, 1, 1)
+
+# 当前进程的Redis连接（未配置时为None）
+_redis = None
+
+
+def get_redis():
+    """获取共享Redis连接，未启用时返回None"""
+    return _redis
+
+
+def redis_key(*parts: str) -> str:
+    """带统一前缀的Redis键"""
+    return settings.REDIS_PREFIX + ":".join(parts)
+
+
+class InvalidationBus:
+    """缓存失效广播：本进程立即执行，其他worker通过Redis频道收到后执行
+    订阅连接断开后按退避间隔重连，断开期间可能漏收消息，重连后执行重同步处理函数（重新加载或清空本地缓存）
+    """
+
+    def __init__(self, reconnect_delay: float = 0.5, max_reconnect_delay: float = 30):
+        self.origin = uuid.uuid4().hex
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._handlers: Dict[str, List[Callable[[str], None]]] = {}
+        self._resync_handlers: List[Callable[[], Optional[Awaitable[None]]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._redis = None
+        self._pubsub = None
+        self.connected = False
+        self.published = 0
+        self.received = 0
+        self.reconnects = 0
+        self.errors = 0
+
+    @property
+    def channel(self) -> str:
+        return redis_key("invalidate")
+
+    def subscribe(self, kind: str, handler: Callable[[str], None]):
+        """注册某类失效消息的处理函数"""
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def on_resync(self, handler: Callable[[], Optional[Awaitable[None]]]):
+        """注册重连后的重同步处理函数（可以是协程函数）"""
+        self._resync_handlers.append(handler)
+
+    def _dispatch(self, kind: str, payload: str):
+        for handler in self._handlers.get(kind, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"[缓存广播] 处理失败 {kind}: {e}")
+
+    async def _resync(self):
+        for handler in self._resync_handlers:
+            try:
+                result = handler()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"[缓存广播] 重同步失败: {e}")
+
+    async def publish(self, kind: str, payload: str):
+        """广播失效消息"""
+        self._dispatch(kind, payload)
+        self.published += 1
+        redis = get_redis()
+        if redis is not None:
+            try:
+                await redis.publish(self.channel, f"{self.origin}|{kind}|{payload}")
+            except Exception as e:
+                self.errors += 1
+                print(f"[缓存广播] 发布失败: {e}")
+
+    async def _connect(self):
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self.connected = True
+
+    async def _disconnect(self):
+        self.connected = False
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+
+    async def _listen(self):
+        """订阅Redis频道，执行其他worker发出的失效消息"""
+        async for message in self._pubsub.listen():
+            if message.get("type") != "message":
+                continue
+            data = message["data"]
+            if isinstance(data, bytes):
+                data = data.decode("utf-8")
+            try:
+                origin, kind, payload = data.split("|", 2)
+            except ValueError:
+                continue
+            if origin == self.origin:
+                continue
+            self.received += 1
+            self._dispatch(kind, payload)
+        raise ConnectionError("订阅连接已关闭")
+
+    async def _run(self):
+        """保持订阅：连接断开后按指数退避重连，重连成功后执行重同步"""
+        delay = self.reconnect_delay
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._connect()
+                    self.reconnects += 1
+                    print("[缓存广播] 订阅已重连")
+                    await self._resync()
+                delay = self.reconnect_delay
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                await self._disconnect()
+                print(f"[缓存广播] 订阅连接断开，{delay:.1f}秒后重连: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def start(self, redis):
+        if redis is None or self._task is not None:
+            return
+        self._redis = redis
+        await self._connect()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._disconnect()
+        self._redis = None
+
+    def stats(self) -> dict:
+        return {
+            "shared": get_redis() is not None,
+            "connected": self.connected,
+            "published": self.published,
+            "received": self.received,
+            "reconnects": self.reconnects,
+            "errors": self.errors,
+        }
+
+
+class CachedAuth(NamedTuple):
+    """缓存的设备授权状态"""
+    device_pk: int
+    is_active: bool
+    expires_at: datetime
+
+
+def _auth_key(app_key: str, token: str, device_id: str) -> str:
+    digest = hashlib.sha256(f"{app_key}\0{token}\0{device_id}".encode("utf-8")).hexdigest()
+    return redis_key("auth", digest)
+
+
+def _encode(auth: CachedAuth) -> str:
+    expires_ts = int((auth.expires_at - EPOCH).total_seconds() * 1000000)
+    return f"{auth.device_pk}|{int(auth.is_active)}|{expires_ts}"
+
+
+def _decode(value) -> CachedAuth:
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    device_pk, is_active, expires_ts = value.split("|")
+    return CachedAuth(
+        device_pk=int(device_pk),
+        is_active=is_active == "1",
+        expires_at=EPOCH + timedelta(microseconds=int(expires_ts))
+    )
+
+
+class AuthCache:
+    """设备授权缓存：(app_key, token, device_id) -> 设备ID、是否启用、到期时间
+    未配置Redis时只用本进程缓存；多worker时其他worker删除不到本进程的条目，禁用的设备在有效期内仍能通过，
+    因此多worker且没有Redis时不缓存，每次查询数据库
+    """
+
+    def __init__(self, maxsize: int, ttl: float, workers: int = 1):
+        self.ttl = ttl
+        self.workers = workers
+        self._local = TTLCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def local_enabled(self) -> bool:
+        return self.workers <= 1
+
+    async def get_many(self, keys: Iterable[Tuple[str, str, str]]) -> Dict[Tuple[str, str, str], CachedAuth]:
+        """批量读取，只返回命中的条目"""
+        keys = list(keys)
+        found: Dict[Tuple[str, str, str], CachedAuth] = {}
+        if not keys:
+            return found
+
+        redis = get_redis()
+        if redis is None:
+            if self.local_enabled:
+                for key in keys:
+                    value = self._local.get(_auth_key(*key))
+                    if value is not MISSING:
+                        found[key] = value
+        else:
+            try:
+                values = await redis.mget([_auth_key(*key) for key in keys])
+            except Exception as e:
+                # Redis不可用时按未命中处理，回退到数据库
+                self.errors += 1
+                print(f"[授权缓存] 读取失败: {e}")
+                values = [None] * len(keys)
+            for key, value in zip(keys, values):
+                if value is not None:
+                    found[key] = _decode(value)
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def get(self, app_key: str, token: str, device_id: str) -> Optional[CachedAuth]:
+        key = (app_key, token, device_id)
+        return (await self.get_many([key])).get(key)
+
+    async def set_many(self, entries: Dict[Tuple[str, str, str], CachedAuth]):
+        """批量写入"""
+        if not entries:
+            return
+        redis = get_redis()
+        if redis is None:
+            if self.local_enabled:
+                for key, auth in entries.items():
+                    self._local.set(_auth_key(*key), auth)
+            return
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key, auth in entries.items():
+                    pipe.set(_auth_key(*key), _encode(auth), ex=int(self.ttl))
+                await pipe.execute()
+        except Exception as e:
+            self.errors += 1
+            print(f"[授权缓存] 写入失败: {e}")
+
+    async def set(self, app_key: str, token: str, device_id: str, auth: CachedAuth):
+        await self.set_many({(app_key, token, device_id): auth})
+
+    async def invalidate(self, app_key: str, token: str, device_id: str):
+        """删除授权缓存（Redis中删除即对所有worker生效）"""
+        key = _auth_key(app_key, token, device_id)
+        self._local.pop(key)
+        redis = get_redis()
+        if redis is not None:
+            try:
+                await redis.delete(key)
+            except Exception as e:
+                self.errors += 1
+                print(f"[授权缓存] 删除失败: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis" if get_redis() is not None else ("memory" if self.local_enabled else "none"),
+            "local_size": len(self._local),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+invalidation_bus = InvalidationBus()
+auth_cache = AuthCache(
+    maxsize=settings.AUTH_CACHE_MAX_SIZE,
+    ttl=settings.AUTH_CACHE_TTL,
+    workers=settings.WORKERS
+)
+
+
+async def init_shared_cache(client=None):
+    """启动时连接Redis（可传入客户端，例如测试用的fakeredis）并订阅失效频道"""
+    global _redis
+    if client is None and settings.REDIS_URL:
+        if aioredis is None:
+            print("[共享缓存] 未安装redis，使用本地缓存")
+        else:
+            client = aioredis.from_url(settings.REDIS_URL)
+    if client is not None:
+        try:
+            await client.ping()
+        except Exception as e:
+            print(f"[共享缓存] Redis连接失败，使用本地缓存: {e}")
+            client = None
+    _redis = client
+    await invalidation_bus.start(_redis)
+    print(f"[共享缓存] {'Redis' if _redis is not None else '本地内存'}")
+
+
+async def close_shared_cache():
+    global _redis
+    await invalidation_bus.stop()
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
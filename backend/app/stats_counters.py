@@ -0,0 +1,302 @@
+"""
+仪表盘统计计数模块
+stats_counters表每个范围一行（0为全局，其余为用户ID），仪表盘的各项计数只需按主键读一行，
+不再对users/applications/cards/devices逐个count(*)：
+  - 创建/删除用户、应用、卡密，激活卡密，启用/禁用设备时记录增量，
+    在内存中按范围合并后由后台任务定期批量累加（各worker的增量互不覆盖）
+  - 设备到期没有对应的写操作，由后台任务按到期时间水位扣减：
+    以CAS方式推进全局行的expired_before，只有推进成功的worker执行扣减，每个时间段只扣一次
+  - 增量未写入时进程退出、删除应用后遗留的设备等会造成偏差，定期按实际数据重新计算全部计数；
+    全局行的reconciled_at同样以CAS方式更新，每个周期只有一个worker执行。
+    reconciled_at同时是增量的水位：每条增量记录产生时间，校正持有全局行锁期间其他worker的写入等待，
+    之后写入时丢弃早于reconciled_at的增量（这些变化已包含在重新计算的结果中），避免重复累加
+"""
+
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import case, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.database import async_session
+from app.models import Application, Card, Device, StatsCounter, User
+
+GLOBAL_SCOPE = 0
+
+FIELDS = ("total_users", "total_apps", "total_cards", "used_cards", "active_devices")
+
+
+def _empty() -> Dict[str, int]:
+    return dict.fromkeys(FIELDS, 0)
+
+
+async def _upsert(db: AsyncSession, counts: Dict[int, Dict[str, int]], now: datetime, replace: bool = False):
+    """写入各范围的计数：replace为True时覆盖，否则累加到已有值上"""
+    table = StatsCounter.__table__
+    insert = pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    stmt = insert(table)
+    if replace:
+        set_ = {field: stmt.excluded[field] for field in FIELDS}
+    else:
+        set_ = {field: table.c[field] + stmt.excluded[field] for field in FIELDS}
+    set_["updated_at"] = stmt.excluded.updated_at
+    rows = [{"scope_id": scope, **values, "updated_at": now} for scope, values in counts.items()]
+    await db.execute(stmt.on_conflict_do_update(index_elements=["scope_id"], set_=set_), rows)
+
+
+class StatsCounters:
+    """仪表盘统计计数的增量写入、到期扣减与定期校正"""
+
+    def __init__(self, flush_interval: float, expiry_interval: float, reconcile_interval: float):
+        self.flush_interval = flush_interval
+        self.expiry_interval = expiry_interval
+        self.reconcile_interval = reconcile_interval
+        # 未写入的增量：(产生时间, 范围, 各字段变化)
+        self._pending: List[Tuple[datetime, Optional[int], Dict[str, int]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        # 统计计数
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.superseded = 0
+        self.expired = 0
+        self.reconciles = 0
+        self.last_reconcile: Optional[datetime] = None
+
+    def add(self, owner_id: Optional[int], **deltas: int):
+        """记录计数变化（在变化提交之后调用），计入全局和owner_id对应的范围"""
+        self._pending.append((datetime.utcnow(), owner_id, deltas))
+
+    def _merge(self, batch: list, reconciled_at: Optional[datetime]) -> Dict[int, Dict[str, int]]:
+        """按范围合并增量，跳过最近一次校正之前产生的增量"""
+        counts: Dict[int, Dict[str, int]] = {}
+        for recorded_at, owner_id, deltas in batch:
+            if reconciled_at is not None and recorded_at < reconciled_at:
+                self.superseded += 1
+                continue
+            for scope in {GLOBAL_SCOPE, owner_id} - {None}:
+                values = counts.setdefault(scope, _empty())
+                for field, delta in deltas.items():
+                    values[field] += delta
+        return counts
+
+    async def flush(self) -> int:
+        """把合并后的增量一次性累加到数据库，返回写入的范围数"""
+        async with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, []
+            try:
+                async with async_session() as db:
+                    # 先更新全局行取得行锁（SQLite为写锁）：校正进行中时等待其提交，
+                    # 之后读到的reconciled_at即本次增量的水位
+                    now = datetime.utcnow()
+                    await db.execute(
+                        update(StatsCounter).where(StatsCounter.scope_id == GLOBAL_SCOPE).values(updated_at=now)
+                    )
+                    reconciled_at = await db.scalar(
+                        select(StatsCounter.reconciled_at).where(StatsCounter.scope_id == GLOBAL_SCOPE)
+                    )
+                    counts = self._merge(batch, reconciled_at)
+                    if counts:
+                        await _upsert(db, counts, now)
+                    await db.commit()
+            except Exception as e:
+                # 写入失败时把增量放回队列
+                self._pending[:0] = batch
+                self.failed += 1
+                print(f"[统计计数] 写入增量失败: {e}")
+                return 0
+            self.written += len(counts)
+            self.flushes += 1
+            return len(counts)
+
+    async def expire(self) -> int:
+        """扣减上次水位之后到期的设备，返回扣减的设备数（其他worker已处理时为0）"""
+        now = datetime.utcnow()
+        async with async_session() as db:
+            watermark = await db.scalar(
+                select(StatsCounter.expired_before).where(StatsCounter.scope_id == GLOBAL_SCOPE)
+            )
+            if watermark is None or watermark >= now:
+                return 0
+            result = await db.execute(
+                update(StatsCounter)
+                .where(StatsCounter.scope_id == GLOBAL_SCOPE, StatsCounter.expired_before == watermark)
+                .values(expired_before=now)
+            )
+            if result.rowcount != 1:
+                return 0
+            result = await db.execute(
+                select(Application.owner_id, func.count(Device.id))
+                .join(Application, Device.application_id == Application.id)
+                .where(
+                    Device.is_active == True,
+                    Device.expires_at > watermark,
+                    Device.expires_at <= now
+                )
+                .group_by(Application.owner_id)
+            )
+            counts: Dict[int, Dict[str, int]] = {}
+            total = 0
+            for owner_id, count in result:
+                counts.setdefault(owner_id, _empty())["active_devices"] -= count
+                total += count
+            if total:
+                counts.setdefault(GLOBAL_SCOPE, _empty())["active_devices"] -= total
+                await _upsert(db, counts, now)
+            await db.commit()
+        self.expired += total
+        return total
+
+    async def _recount(self, now: datetime) -> Dict[int, Dict[str, int]]:
+        """在一致的快照上统计各范围的实际计数（PostgreSQL使用REPEATABLE READ，几个查询看到同一时刻的数据）"""
+        counts: Dict[int, Dict[str, int]] = {GLOBAL_SCOPE: _empty()}
+
+        def count(scope: Optional[int], field: str, value: int):
+            counts[GLOBAL_SCOPE][field] += value
+            if scope is not None:
+                counts.setdefault(scope, _empty())[field] += value
+
+        async with async_session() as db:
+            if db.bind.dialect.name == "postgresql":
+                await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+            for parent_id, n in await db.execute(
+                select(User.parent_id, func.count(User.id)).group_by(User.parent_id)
+            ):
+                count(parent_id, "total_users", n)
+            for owner_id, n in await db.execute(
+                select(Application.owner_id, func.count(Application.id)).group_by(Application.owner_id)
+            ):
+                count(owner_id, "total_apps", n)
+            for creator_id, n, used in await db.execute(
+                select(
+                    Card.creator_id,
+                    func.count(Card.id),
+                    func.sum(case((Card.is_used == True, 1), else_=0))
+                ).group_by(Card.creator_id)
+            ):
+                count(creator_id, "total_cards", n)
+                count(creator_id, "used_cards", used or 0)
+            for owner_id, n in await db.execute(
+                select(Application.owner_id, func.count(Device.id))
+                .join(Application, Device.application_id == Application.id)
+                .where(Device.is_active == True, Device.expires_at > now)
+                .group_by(Application.owner_id)
+            ):
+                count(owner_id, "active_devices", n)
+        return counts
+
+    async def reconcile(self, force: bool = False) -> bool:
+        """按数据库中的实际数据重新计算全部计数；未到校正周期或其他worker正在执行时返回False"""
+        await self.flush()
+        now = datetime.utcnow()
+        async with async_session() as db:
+            # 首次校正时还没有全局行，先插入（已存在则跳过），之后同样以CAS方式取得全局行锁
+            insert = pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+            await db.execute(
+                insert(StatsCounter)
+                .values(scope_id=GLOBAL_SCOPE, **_empty(), updated_at=now)
+                .on_conflict_do_nothing(index_elements=["scope_id"])
+            )
+            last = await db.scalar(
+                select(StatsCounter.reconciled_at).where(StatsCounter.scope_id == GLOBAL_SCOPE)
+            )
+            if last is not None and not force and (now - last).total_seconds() < self.reconcile_interval:
+                return False
+            result = await db.execute(
+                update(StatsCounter)
+                .where(
+                    StatsCounter.scope_id == GLOBAL_SCOPE,
+                    StatsCounter.reconciled_at.is_(None) if last is None else StatsCounter.reconciled_at == last
+                )
+                .values(reconciled_at=now)
+            )
+            if result.rowcount != 1:
+                return False
+
+            # 已持有全局行锁，其他worker的增量写入和到期扣减都在等待；
+            # 从这里开始统计，之后产生的增量不在统计结果中，写入时保留，之前的丢弃
+            now = datetime.utcnow()
+            counts = await self._recount(now)
+
+            # 已不存在数据的范围清零，其余覆盖；到期水位和增量水位同步到本次统计的时间
+            await db.execute(update(StatsCounter).values(**_empty(), updated_at=now))
+            await _upsert(db, counts, now, replace=True)
+            await db.execute(
+                update(StatsCounter)
+                .where(StatsCounter.scope_id == GLOBAL_SCOPE)
+                .values(expired_before=now, reconciled_at=now)
+            )
+            await db.commit()
+        self.reconciles += 1
+        self.last_reconcile = now
+        print(f"[统计计数] 已校正{len(counts)}个范围的计数")
+        return True
+
+    async def _run(self):
+        """后台循环：合并写入增量，按间隔扣减到期设备、校正计数"""
+        last_expiry = last_reconcile = time.monotonic()
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            now = time.monotonic()
+            try:
+                if now - last_expiry >= self.expiry_interval:
+                    last_expiry = now
+                    await self.expire()
+                if now - last_reconcile >= self.reconcile_interval:
+                    last_reconcile = now
+                    await self.reconcile()
+            except Exception as e:
+                print(f"[统计计数] 后台任务失败: {e}")
+
+    async def start(self):
+        """启动后台任务；还没有校正过（首次部署）时先按实际数据计算一次，多个worker同时启动时只有一个执行"""
+        async with async_session() as db:
+            last = await db.scalar(
+                select(StatsCounter.reconciled_at).where(StatsCounter.scope_id == GLOBAL_SCOPE)
+            )
+        if last is None:
+            await self.reconcile()
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务并写入剩余增量"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "written": self.written,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "superseded": self.superseded,
+            "expired": self.expired,
+            "reconciles": self.reconciles,
+            "last_reconcile": self.last_reconcile,
+        }
+
+
+stats_counters = StatsCounters(
+    flush_interval=settings.STATS_FLUSH_INTERVAL,
+    expiry_interval=settings.STATS_EXPIRY_INTERVAL,
+    reconcile_interval=settings.STATS_RECONCILE_INTERVAL
+)
@@ -0,0 +1,86 @@
+"""
+并发激活测试
+用法（在backend目录下）: python bench/activation_bench.py [--requests 1000] [--keys 100] [--max-devices 1]
+
+在进程内启动应用，生成keys张卡密后并发发起requests个激活请求（第i个请求用设备dev{i}激活第i % keys张卡密），
+输出吞吐量、结果分布，并检查数据库中每张卡密绑定的设备数不超过max_devices、设备记录与卡密一致。
+默认使用临时SQLite数据库；设置DATABASE_URL时使用该数据库（会写入测试数据，请使用空库）
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='heartbeat-bench-')}/bench.db"
+os.environ["DEBUG"] = "false"
+os.environ["ADMIN_USERNAME"] = "admin"
+os.environ["ADMIN_PASSWORD"] = "adminpw"
+os.environ.setdefault("REDIS_URL", "")
+os.environ.setdefault("METRICS_DIR", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from sqlalchemy import func, select  # noqa: E402
+from app.database import async_session  # noqa: E402
+from app.main import app  # noqa: E402
+from app.middleware import limiter  # noqa: E402
+from app.models import Card, Device  # noqa: E402
+
+
+async def main(requests: int, keys: int, max_devices: int):
+    limiter.enabled = False
+    async with app.router.lifespan_context(app):
+        # 服务端异常计为HTTP 500（SQLite写锁等待超过busy timeout时会出现）
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as c:
+            token = (await c.post("/api/auth/login", json={"username": "admin", "password": "adminpw"})).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            application = (await c.post("/api/applications", json={
+                "name": "bench", "max_devices": max_devices
+            }, headers=headers)).json()
+            cards = (await c.post("/api/cards", json={
+                "card_type": "week", "application_id": application["id"], "count": keys
+            }, headers=headers)).json()
+            card_keys = [card["card_key"] for card in cards]
+
+            async def activate(i):
+                r = await c.post("/api/cards/activate", json={
+                    "card_key": card_keys[i % keys], "device_id": f"dev{i}"
+                })
+                return r.json()["message"] if r.status_code == 200 else f"HTTP {r.status_code}"
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(activate(i) for i in range(requests)))
+            elapsed = time.perf_counter() - start
+            print(f"{requests}个请求 {keys}张卡密: {elapsed:.2f}s, {requests / elapsed:.0f} req/s")
+            print("结果:", dict(Counter(results)))
+
+    async with async_session() as db:
+        devices = dict((await db.execute(
+            select(Device.card_key, func.count(Device.id))
+            .where(Device.application_id == application["id"])
+            .group_by(Device.card_key)
+        )).all())
+        counts = dict((await db.execute(
+            select(Card.card_key, Card.device_count).where(Card.application_id == application["id"])
+        )).all())
+    over = [key for key, count in counts.items() if count > max_devices]
+    mismatched = [key for key, count in counts.items() if devices.get(key, 0) != count]
+    print(f"设备记录 {sum(devices.values())}，超出上限的卡密 {len(over)}，设备数与device_count不一致的卡密 {len(mismatched)}")
+    if over or mismatched:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--keys", type=int, default=100)
+    parser.add_argument("--max-devices", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.keys, args.max_devices))
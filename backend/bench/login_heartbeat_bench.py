@@ -0,0 +1,89 @@
+"""
+并发登录期间的心跳延迟测试
+用法（在backend目录下）: python bench/login_heartbeat_bench.py [--logins 20] [--duration 3]
+
+使用临时SQLite数据库在进程内启动应用，单个客户端持续发送心跳，
+先测空闲时的延迟，再在同时发起N个登录（bcrypt）期间测量，输出p50/p99/最大值和登录状态码分布。
+bcrypt在专用线程池中执行时两组p99应接近；超出BCRYPT_WORKERS+BCRYPT_MAX_QUEUE的登录返回503
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+_tmp = tempfile.mkdtemp(prefix="heartbeat-bench-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_tmp}/bench.db"
+os.environ["DEBUG"] = "false"
+os.environ["ADMIN_USERNAME"] = "admin"
+os.environ["ADMIN_PASSWORD"] = "adminpw"
+os.environ.setdefault("REDIS_URL", "")
+os.environ.setdefault("METRICS_DIR", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from app.main import app  # noqa: E402
+from app.middleware import limiter  # noqa: E402
+
+
+def summary(label: str, latencies):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return (f"{label:<8} n={n} p50={latencies[n // 2]:.2f}ms "
+            f"p99={latencies[int(n * 0.99)]:.2f}ms max={latencies[-1]:.1f}ms")
+
+
+async def main(logins: int, duration: float):
+    limiter.enabled = False
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as c:
+            credentials = {"username": "admin", "password": "adminpw"}
+            token = (await c.post("/api/auth/login", json=credentials)).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            application = (await c.post("/api/applications", json={"name": "bench"}, headers=headers)).json()
+            cards = (await c.post("/api/cards", json={
+                "card_type": "day", "application_id": application["id"], "count": 1
+            }, headers=headers)).json()
+            activation = (await c.post("/api/cards/activate", json={
+                "card_key": cards[0]["card_key"], "device_id": "bench-device"
+            })).json()
+            body = {"app_key": application["app_key"], "token": activation["token"], "device_id": "bench-device"}
+
+            async def heartbeats(seconds: float):
+                latencies = []
+                end = time.perf_counter() + seconds
+                while time.perf_counter() < end:
+                    start = time.perf_counter()
+                    await c.post("/api/heartbeat", json=body)
+                    latencies.append((time.perf_counter() - start) * 1e3)
+                    await asyncio.sleep(0.002)
+                return latencies
+
+            print(summary("空闲", await heartbeats(duration)))
+
+            codes = []
+
+            async def login():
+                r = await c.post("/api/auth/login", json=credentials)
+                codes.append(r.status_code)
+
+            started = time.perf_counter()
+            burst = asyncio.gather(*(login() for _ in range(logins)))
+            latencies = await heartbeats(duration)
+            await burst
+            elapsed = time.perf_counter() - started
+            print(summary("登录期间", latencies))
+            distribution = {code: codes.count(code) for code in sorted(set(codes))}
+            print(f"{logins}个并发登录 状态码{distribution} 用时{elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, args.duration))
@@ -0,0 +1,127 @@
+"""
+速率限制开销与多worker正确性测试
+用法（在backend目录下）: python bench/ratelimit_bench.py
+
+- 4个进程共享同一个shm文件，按60/minute各请求100次，合计应恰好放行60次
+- memory / shm / redis（未配置REDIS_URL时使用fakeredis）各后端每次检查的耗时，
+  分别统计放行（访问共享后端）和拒绝（进程内预检查）两条路径
+- get_client_ip（限流键函数）在直连和经可信代理转发两种情况下的耗时
+- 安装了limits时，对比原slowapi使用的moving-window内存存储
+"""
+
+import asyncio
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.ratelimit import RateLimiter, RateLimitExceeded  # noqa: E402
+
+CHECKS = 100000
+KEYS = 5000
+
+
+def _shm_worker(path, queue):
+    limiter = RateLimiter(backend="shm", shm_path=path)
+
+    async def run():
+        allowed = 0
+        for _ in range(100):
+            try:
+                await limiter.hit("k", "60/minute", 60, 60.0)
+                allowed += 1
+            except RateLimitExceeded:
+                pass
+        return allowed
+
+    queue.put(asyncio.run(run()))
+
+
+def shm_processes(path: str, processes: int = 4):
+    queue = mp.Queue()
+    workers = [mp.Process(target=_shm_worker, args=(path, queue)) for _ in range(processes)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    total = sum(queue.get() for _ in workers)
+    print(f"shm {processes}个进程 60/minute 合计放行: {total}")
+
+
+async def per_check(limiter: RateLimiter, label: str, n: int = CHECKS):
+    keys = [f"ip{i % KEYS}" for i in range(n)]
+    start = time.perf_counter()
+    for key in keys:
+        try:
+            await limiter.hit(key, "1000000/minute", 1000000, 60.0)
+        except RateLimitExceeded:
+            pass
+    allowed = (time.perf_counter() - start) / n * 1e6
+
+    start = time.perf_counter()
+    for _ in range(n):
+        try:
+            await limiter.hit("hot", "1/minute", 1, 60.0)
+        except RateLimitExceeded:
+            pass
+    rejected = (time.perf_counter() - start) / n * 1e6
+    print(f"{label:<10} 放行 {allowed:6.2f}us/次  拒绝 {rejected:6.2f}us/次")
+
+
+def key_func():
+    from app.middleware import get_scope_client_ip
+    direct = {"client": ("203.0.113.7", 1), "headers": [(b"x-forwarded-for", b"1.2.3.4")]}
+    proxied = {"client": ("172.18.0.3", 1), "headers": [(b"x-forwarded-for", b"1.2.3.4, 198.51.100.9")]}
+    for label, scope in (("直连", direct), ("经代理", proxied)):
+        start = time.perf_counter()
+        for _ in range(CHECKS):
+            get_scope_client_ip(scope)
+        print(f"get_client_ip {label}: {(time.perf_counter() - start) / CHECKS * 1e6:.2f}us/次")
+
+
+def moving_window():
+    try:
+        from limits import parse, storage, strategies
+    except ImportError:
+        print("未安装limits，跳过moving-window对比")
+        return
+    limiter = strategies.MovingWindowRateLimiter(storage.MemoryStorage())
+    item = parse("1000000/minute")
+    keys = [f"ip{i % KEYS}" for i in range(CHECKS)]
+    start = time.perf_counter()
+    for key in keys:
+        limiter.hit(item, key)
+    print(f"{'limits':<10} 放行 {(time.perf_counter() - start) / CHECKS * 1e6:6.2f}us/次（moving-window）")
+
+
+async def main(tmp: str):
+    await per_check(RateLimiter(backend="memory"), "memory")
+    await per_check(RateLimiter(backend="shm", shm_path=os.path.join(tmp, "bench.shm")), "shm")
+
+    import app.shared_cache as shared_cache
+    if shared_cache.get_redis() is None:
+        import fakeredis.aioredis
+        shared_cache._redis = fakeredis.aioredis.FakeRedis()
+    first, second = RateLimiter(backend="redis"), RateLimiter(backend="redis")
+    allowed = 0
+    for limiter in (first, second):
+        for _ in range(50):
+            try:
+                await limiter.hit("shared", "60/minute", 60, 60.0)
+                allowed += 1
+            except RateLimitExceeded:
+                pass
+    print(f"redis 两个worker 60/minute 合计放行: {allowed}")
+    await per_check(first, "redis", 5000)
+
+    key_func()
+    moving_window()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        shm_processes(os.path.join(tmp, "processes.shm"))
+        asyncio.run(main(tmp))
@@ -0,0 +1,57 @@
+"""
+测试公共配置
+使用临时SQLite数据库，整个测试会话共用一个事件循环（anyio插件）和一个已启动的应用
+"""
+
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="heartbeat-test-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_tmp}/test.db"
+os.environ["DEBUG"] = "false"
+os.environ["ADMIN_USERNAME"] = "admin"
+os.environ["ADMIN_PASSWORD"] = "adminpw"
+os.environ["REDIS_URL"] = ""
+os.environ["METRICS_DIR"] = ""
+
+import httpx
+import pytest
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+async def client():
+    """启动应用（执行lifespan）后的HTTP客户端"""
+    from app.main import app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as c:
+            yield c
+
+
+@pytest.fixture(scope="session")
+async def admin_headers(client):
+    r = await client.post("/api/auth/login", json={"username": "admin", "password": "adminpw"})
+    r.raise_for_status()
+    return {"Authorization": "Bearer " + r.json()["access_token"]}
+
+
+@pytest.fixture
+async def application(client, admin_headers):
+    """新建一个应用"""
+    r = await client.post("/api/applications", json={"name": "test", "max_devices": 1}, headers=admin_headers)
+    r.raise_for_status()
+    return r.json()
+
+
+@pytest.fixture
+def no_rate_limit():
+    """并发测试从同一IP发出大量请求，关闭速率限制"""
+    from app.middleware import limiter
+    limiter.enabled = False
+    yield
+    limiter.enabled = True
@@ -0,0 +1,91 @@
+import asyncio
+from collections import Counter
+
+import pytest
+from sqlalchemy import func, select
+
+from app.database import async_session
+from app.models import Card, Device
+
+pytestmark = pytest.mark.anyio
+
+
+async def create_cards(client, admin_headers, max_devices, count):
+    r = await client.post("/api/applications", json={"name": "race", "max_devices": max_devices}, headers=admin_headers)
+    r.raise_for_status()
+    application = r.json()
+    body = {"card_type": "week", "application_id": application["id"], "count": count}
+    r = await client.post("/api/cards", json=body, headers=admin_headers)
+    r.raise_for_status()
+    return [card["card_key"] for card in r.json()]
+
+
+async def race(client, keys, requests):
+    """并发激活，第i个请求用设备dev{i}激活keys[i % len(keys)]，返回每个卡密的成功次数"""
+    async def activate(i):
+        r = await client.post("/api/cards/activate", json={"card_key": keys[i % len(keys)], "device_id": f"dev{i}"})
+        assert r.status_code == 200
+        return keys[i % len(keys)], r.json()["success"]
+
+    results = await asyncio.gather(*(activate(i) for i in range(requests)))
+    return Counter(key for key, success in results if success)
+
+
+async def stored(keys):
+    async with async_session() as db:
+        devices = dict((await db.execute(
+            select(Device.card_key, func.count(Device.id)).where(Device.card_key.in_(keys)).group_by(Device.card_key)
+        )).all())
+        counts = dict((await db.execute(select(Card.card_key, Card.device_count).where(Card.card_key.in_(keys)))).all())
+    return devices, counts
+
+
+async def test_concurrent_activations_claim_each_key_once(client, admin_headers, no_rate_limit):
+    keys = await create_cards(client, admin_headers, max_devices=1, count=5)
+    successes = await race(client, keys, 100)
+    devices, counts = await stored(keys)
+    assert successes == {key: 1 for key in keys}
+    assert devices == {key: 1 for key in keys}
+    assert counts == {key: 1 for key in keys}
+
+
+async def test_concurrent_activations_respect_max_devices(client, admin_headers, no_rate_limit):
+    keys = await create_cards(client, admin_headers, max_devices=3, count=4)
+    successes = await race(client, keys, 80)
+    devices, counts = await stored(keys)
+    assert successes == {key: 3 for key in keys}
+    assert devices == {key: 3 for key in keys}
+    assert all(count <= 3 for count in counts.values())
+
+
+async def test_same_device_activates_once(client, admin_headers, no_rate_limit):
+    keys = await create_cards(client, admin_headers, max_devices=3, count=1)
+    body = {"card_key": keys[0], "device_id": "same-device"}
+    responses = await asyncio.gather(*(client.post("/api/cards/activate", json=body) for _ in range(10)))
+    assert sum(r.json()["success"] for r in responses) == 1
+    devices, counts = await stored(keys)
+    assert devices == {keys[0]: 1}
+    assert counts == {keys[0]: 1}
+
+
+async def test_concurrent_status_toggles_adjust_device_count_once(client, admin_headers, no_rate_limit):
+    keys = await create_cards(client, admin_headers, max_devices=1, count=1)
+    r = await client.post("/api/cards/activate", json={"card_key": keys[0], "device_id": "toggled"})
+    assert r.json()["success"]
+    async with async_session() as db:
+        device_pk = await db.scalar(select(Device.id).where(Device.card_key == keys[0]))
+
+    async def toggle(is_active):
+        r = await client.put(f"/api/dashboard/devices/{device_pk}/status", params={"is_active": is_active}, headers=admin_headers)
+        assert r.status_code == 200
+
+    # 同时多次禁用，只应释放一次名额
+    await asyncio.gather(*(toggle(False) for _ in range(20)))
+    devices, counts = await stored(keys)
+    assert counts == {keys[0]: 0}
+
+    await asyncio.gather(*(toggle(i % 2 == 0) for i in range(40)))
+    async with async_session() as db:
+        is_active = await db.scalar(select(Device.is_active).where(Device.id == device_pk))
+    devices, counts = await stored(keys)
+    assert counts == {keys[0]: 1 if is_active else 0}
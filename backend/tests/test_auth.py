@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.auth import PasswordHasher, password_hasher
+from app.exceptions import ServiceUnavailableError
+
+pytestmark = pytest.mark.anyio
+
+
+async def wait_pending(hasher, count):
+    for _ in range(200):
+        if hasher.stats()["pending"] >= count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("排队数量未达到预期")
+
+
+async def test_queue_limit_rejects():
+    hasher = PasswordHasher(workers=1, max_queue=1)
+    gate = threading.Event()
+    running = [asyncio.create_task(hasher._run(gate.wait)) for _ in range(2)]
+    try:
+        await wait_pending(hasher, 2)
+        with pytest.raises(ServiceUnavailableError):
+            await hasher.verify("pw", "hash")
+        assert hasher.stats()["rejected"] == 1
+    finally:
+        gate.set()
+        await asyncio.gather(*running)
+        hasher.shutdown()
+    assert hasher.stats()["pending"] == 0
+
+
+async def test_login_returns_503_when_queue_full(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(password_hasher, "workers", 1)
+    monkeypatch.setattr(password_hasher, "max_queue", 0)
+    gate = threading.Event()
+    busy = asyncio.create_task(password_hasher._run(gate.wait))
+    try:
+        await wait_pending(password_hasher, 1)
+        r = await client.post("/api/auth/login", json={"username": "admin", "password": "adminpw"})
+        assert r.status_code == 503
+        # 密码计算占满时事件循环仍在处理其他请求
+        r = await client.get("/health")
+        assert r.status_code == 200
+    finally:
+        gate.set()
+        await busy
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from app.cache import SingleFlightCache
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_concurrent_misses_load_once():
+    cache = SingleFlightCache(maxsize=10, ttl=60)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    results = await asyncio.gather(*(cache.get_or_load("k", loader) for _ in range(10)))
+    assert results == [1] * 10
+    assert cache.stats()["loads"] == 1
+    assert cache.stats()["coalesced"] == 9
+
+
+async def test_clear_discards_inflight_load():
+    cache = SingleFlightCache(maxsize=10, ttl=60)
+    started, release = asyncio.Event(), asyncio.Event()
+    version = ["old"]
+
+    async def loader():
+        value = version[0]
+        if value == "old":
+            started.set()
+            await release.wait()
+        return value
+
+    stale = asyncio.create_task(cache.get_or_load("k", loader))
+    await started.wait()
+    # 加载期间数据变化并失效缓存：之后的请求不等待旧的加载
+    version[0] = "new"
+    cache.clear()
+    assert await cache.get_or_load("k", loader) == "new"
+
+    release.set()
+    assert await stale == "old"
+    assert await cache.get_or_load("k", loader) == "new"
+    assert cache.stats()["discarded"] == 1
+    assert cache.stats()["inflight"] == 0
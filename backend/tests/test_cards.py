@@ -0,0 +1,100 @@
+import pytest
+from sqlalchemy import func, select
+
+from app.card_issuer import card_issuer
+from app.database import async_session
+from app.models import Card, CardType
+
+pytestmark = pytest.mark.anyio
+
+
+async def count_cards(application_id):
+    async with async_session() as db:
+        return await db.scalar(select(func.count(Card.id)).where(Card.application_id == application_id))
+
+
+async def test_created_cards_are_committed_before_response(client, admin_headers, application, monkeypatch):
+    monkeypatch.setattr(card_issuer, "batch_size", 7)
+    body = {"card_type": "day", "application_id": application["id"], "count": 30}
+    r = await client.post("/api/cards", json=body, headers=admin_headers)
+    assert r.status_code == 200
+    cards = r.json()
+    assert len(cards) == 30
+    assert await count_cards(application["id"]) == 30
+
+
+async def test_failed_issue_sends_no_keys(client, application, monkeypatch):
+    monkeypatch.setattr(card_issuer, "batch_size", 5)
+    original = card_issuer._insert
+    calls = []
+
+    async def failing_insert(*args):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("写入中断")
+        return await original(*args)
+
+    monkeypatch.setattr(card_issuer, "_insert", failing_insert)
+    with pytest.raises(RuntimeError):
+        await card_issuer.issue(application["id"], 1, CardType.DAY, 20)
+    assert await count_cards(application["id"]) == 0
+
+
+async def walk(client, headers, params, cursor=None, key="next_cursor"):
+    """沿游标读取到最后一页，返回每页的卡密ID"""
+    pages = []
+    while True:
+        query = {**params, "page_size": 10, "with_total": False}
+        if cursor:
+            query["cursor"] = cursor
+        r = await client.get("/api/cards", params=query, headers=headers)
+        assert r.status_code == 200
+        body = r.json()
+        pages.append([item["id"] for item in body["items"]])
+        cursor = body[key]
+        if not cursor:
+            return pages, body
+
+
+async def test_cursor_pagination_is_stable(client, admin_headers, application):
+    # 同一批生成的卡密created_at可能相同，按id区分先后
+    for count in (25, 20):
+        r = await client.post("/api/cards", json={
+            "card_type": "day", "application_id": application["id"], "count": count
+        }, headers=admin_headers)
+        assert r.status_code == 200
+    async with async_session() as db:
+        await db.execute(
+            Card.__table__.update().where(Card.application_id == application["id"], Card.id % 3 == 0).values(is_used=True)
+        )
+        await db.commit()
+        expected = list(await db.scalars(
+            select(Card.id).where(Card.application_id == application["id"]).order_by(Card.created_at.desc(), Card.id.desc())
+        ))
+        used = list(await db.scalars(
+            select(Card.id).where(Card.application_id == application["id"], Card.is_used == True)
+            .order_by(Card.created_at.desc(), Card.id.desc())
+        ))
+
+    params = {"application_id": application["id"]}
+    pages, last = await walk(client, admin_headers, params)
+    assert [len(page) for page in pages] == [10, 10, 10, 10, 5]
+    # 无重复、无遗漏，顺序与(created_at, id)倒序一致
+    assert sum(pages, []) == expected
+
+    # 从最后一页向前翻回第一页
+    back, first = await walk(client, admin_headers, params, last["prev_cursor"], "prev_cursor")
+    assert back == pages[-2::-1]
+    assert not first["has_prev"]
+
+    # 翻页期间新生成的卡密排在最前面，不影响后续页
+    r = await client.get("/api/cards", params={**params, "page_size": 10}, headers=admin_headers)
+    cursor = r.json()["next_cursor"]
+    await client.post("/api/cards", json={
+        "card_type": "day", "application_id": application["id"], "count": 3
+    }, headers=admin_headers)
+    rest, _ = await walk(client, admin_headers, params, cursor)
+    assert sum(rest, []) == expected[10:]
+
+    pages, _ = await walk(client, admin_headers, {**params, "is_used": True})
+    assert sum(pages, []) == used
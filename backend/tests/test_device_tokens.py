@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+from sqlalchemy import select, update
+
+from app.database import async_session
+from app.device_tokens import RevocationList
+from app.models import Device
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_reload_picks_up_devices_disabled_by_other_workers(client, admin_headers, application):
+    r = await client.post("/api/cards", json={
+        "card_type": "week", "application_id": application["id"], "count": 1
+    }, headers=admin_headers)
+    card_key = r.json()[0]["card_key"]
+    r = await client.post("/api/cards/activate", json={"card_key": card_key, "device_id": "revoked-elsewhere"})
+    assert r.json()["success"]
+
+    revoked = RevocationList()
+    revoked.start(0.05)
+    try:
+        # 其他worker禁用设备：只写数据库，本进程收不到广播
+        async with async_session() as db:
+            device_pk = await db.scalar(select(Device.id).where(Device.card_key == card_key))
+            await db.execute(update(Device).where(Device.id == device_pk).values(is_active=False))
+            await db.commit()
+        for _ in range(100):
+            if revoked.is_revoked(device_pk):
+                break
+            await asyncio.sleep(0.02)
+        assert revoked.is_revoked(device_pk)
+        assert revoked.reloads >= 1
+    finally:
+        await revoked.stop()
+
+
+async def test_reload_not_started_without_interval():
+    revoked = RevocationList()
+    revoked.start(0)
+    assert revoked._task is None
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app import device_updates as device_updates_module
+from app.database import async_session
+from app.device_updates import DeviceUpdateCoalescer
+from app.models import Device
+
+pytestmark = pytest.mark.anyio
+
+
+async def activate(client, admin_headers, application, device_id):
+    r = await client.post("/api/cards", json={
+        "card_type": "week", "application_id": application["id"], "count": 1
+    }, headers=admin_headers)
+    card_key = r.json()[0]["card_key"]
+    r = await client.post("/api/cards/activate", json={"card_key": card_key, "device_id": device_id})
+    assert r.json()["success"]
+    async with async_session() as db:
+        return await db.scalar(select(Device.id).where(Device.card_key == card_key))
+
+
+async def stored(device_pk):
+    async with async_session() as db:
+        row = (await db.execute(
+            select(Device.last_heartbeat, Device.ip_address).where(Device.id == device_pk)
+        )).one()
+    return row.last_heartbeat, row.ip_address
+
+
+async def test_touches_are_coalesced_into_one_update(client, admin_headers, application):
+    device_pk = await activate(client, admin_headers, application, "coalesced")
+    updates = DeviceUpdateCoalescer(flush_interval=60, max_staleness=60, max_pending=100)
+    now = datetime.utcnow().replace(microsecond=0)
+    for i in range(3):
+        updates.touch(device_pk, now + timedelta(seconds=i), f"10.0.0.{i}")
+    assert updates.pending(device_pk) == (now + timedelta(seconds=2), "10.0.0.2")
+    assert updates.stats()["coalesced"] == 2
+
+    assert await updates.flush() == 1
+    assert updates.pending(device_pk) is None
+    assert await stored(device_pk) == (now + timedelta(seconds=2), "10.0.0.2")
+    assert await updates.flush() == 0
+
+
+async def test_failed_flush_keeps_newer_values(client, admin_headers, application, monkeypatch):
+    device_pk = await activate(client, admin_headers, application, "retried")
+    updates = DeviceUpdateCoalescer(flush_interval=60, max_staleness=60, max_pending=100)
+    now = datetime.utcnow().replace(microsecond=0)
+    updates.touch(device_pk, now, "10.0.0.1")
+
+    def unavailable():
+        raise RuntimeError("数据库不可用")
+
+    monkeypatch.setattr(device_updates_module, "async_session", unavailable)
+    assert await updates.flush() == 0
+    assert updates.stats()["failed"] == 1
+    # 失败后放回队列，期间的新心跳优先
+    updates.touch(device_pk, now + timedelta(seconds=5), "10.0.0.5")
+    monkeypatch.setattr(device_updates_module, "async_session", async_session)
+    assert await updates.flush() == 1
+    assert await stored(device_pk) == (now + timedelta(seconds=5), "10.0.0.5")
+
+
+async def test_full_queue_wakes_flush_and_staleness_caps_interval():
+    updates = DeviceUpdateCoalescer(flush_interval=60, max_staleness=5, max_pending=3)
+    assert updates.flush_interval == 5
+    now = datetime.utcnow()
+    for device_pk in range(1, 3):
+        updates.touch(device_pk, now, None)
+    assert not updates._wakeup.is_set()
+    updates.touch(3, now, None)
+    assert updates._wakeup.is_set()
+
+
+async def test_heartbeat_is_written_behind(client, admin_headers, application):
+    from app.device_updates import device_updates
+
+    device_pk = await activate(client, admin_headers, application, "written-behind")
+    async with async_session() as db:
+        device = await db.get(Device, device_pk)
+    r = await client.post("/api/heartbeat", json={
+        "app_key": application["app_key"], "token": device.user_token, "device_id": "written-behind"
+    })
+    assert r.json()["success"]
+    # 后台任务或这里的flush写入后，数据库中的心跳时间前进
+    await device_updates.flush()
+    assert device_updates.pending(device_pk) is None
+    assert (await stored(device_pk))[0] > device.last_heartbeat
@@ -0,0 +1,82 @@
+import csv
+import gzip
+import io
+import json
+
+import pytest
+from sqlalchemy import select
+
+from app.card_issuer import RESULT_COLUMNS
+from app.export import iterate_chunks, json_array, stream_rows
+from app.models import Card
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def cards(client, admin_headers, application):
+    """新应用中的12张卡密，其中一张已激活"""
+    r = await client.post("/api/cards", json={
+        "card_type": "week", "application_id": application["id"], "count": 12
+    }, headers=admin_headers)
+    keys = [card["card_key"] for card in r.json()]
+    r = await client.post("/api/cards/activate", json={"card_key": keys[0], "device_id": "export-device"})
+    assert r.json()["success"]
+    return keys
+
+
+async def export(client, admin_headers, application, export_format, **params):
+    r = await client.get(f"/api/cards/export/{export_format}", params={
+        "application_id": application["id"], **params
+    }, headers=admin_headers)
+    assert r.status_code == 200
+    return r
+
+
+async def test_csv_export(client, admin_headers, application, cards):
+    r = await export(client, admin_headers, application, "csv")
+    assert r.headers["content-type"].startswith("text/csv")
+    assert r.headers["content-disposition"].endswith(".csv")
+    rows = list(csv.reader(io.StringIO(r.text)))
+    assert rows[0] == ["卡密", "类型", "时长(天)", "状态", "创建时间", "激活时间", "到期时间"]
+    by_key = {row[0]: row for row in rows[1:]}
+    assert sorted(by_key) == sorted(cards)
+    used = by_key[cards[0]]
+    assert used[1:4] == ["周卡", "7", "已使用"] and used[5] and used[6]
+    unused = by_key[cards[1]]
+    assert unused[3] == "未使用" and unused[4] and unused[5:] == ["", ""]
+
+    r = await export(client, admin_headers, application, "csv", is_used=True)
+    assert [row[0] for row in csv.reader(io.StringIO(r.text))][1:] == [cards[0]]
+
+
+async def test_ndjson_export(client, admin_headers, application, cards):
+    r = await export(client, admin_headers, application, "ndjson")
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    records = [json.loads(line) for line in r.text.splitlines()]
+    assert sorted(record["card_key"] for record in records) == sorted(cards)
+    used = next(record for record in records if record["card_key"] == cards[0])
+    assert used["is_used"] and used["card_type"] == "week" and used["used_at"]
+
+
+async def test_gzip_export_matches_plain(client, admin_headers, application, cards):
+    for export_format in ("csv", "ndjson"):
+        plain = await export(client, admin_headers, application, export_format)
+        packed = await export(client, admin_headers, application, export_format, gzip=True)
+        assert packed.headers["content-type"] == "application/gzip"
+        assert packed.headers["content-disposition"].endswith(f".{export_format}.gz")
+        assert gzip.decompress(packed.content) == plain.content
+
+
+async def test_rows_are_read_in_chunks(application, cards):
+    query = select(*RESULT_COLUMNS).where(Card.application_id == application["id"]).order_by(Card.id)
+    chunks = [rows async for rows in stream_rows(query, chunk_size=5)]
+    assert [len(rows) for rows in chunks] == [5, 5, 2]
+    assert [row["card_key"] for rows in chunks for row in rows] == cards
+
+
+async def test_json_array_joins_chunks():
+    chunks = [[{"a": 1}, {"a": 2}], [], [{"a": 3}]]
+    body = "".join([part async for part in json_array(iterate_chunks(chunks))])
+    assert json.loads(body) == [{"a": 1}, {"a": 2}, {"a": 3}]
+    assert json.loads("".join([part async for part in json_array(iterate_chunks([]))])) == []
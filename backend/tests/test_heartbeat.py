@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import select, update
+
+from app.config import settings
+from app.database import async_session
+from app.models import Device
+
+pytestmark = pytest.mark.anyio
+
+
+async def activate(client, admin_headers, application, device_id):
+    r = await client.post("/api/cards", json={
+        "card_type": "week", "application_id": application["id"], "count": 1
+    }, headers=admin_headers)
+    r = await client.post("/api/cards/activate", json={"card_key": r.json()[0]["card_key"], "device_id": device_id})
+    body = r.json()
+    assert body["success"]
+    return body["token"]
+
+
+async def test_batch_answers_each_item_in_order(client, admin_headers, no_rate_limit):
+    r = await client.post("/api/applications", json={"name": "gateway", "max_devices": 1}, headers=admin_headers)
+    application = r.json()
+    app_key = application["app_key"]
+    signed = await activate(client, admin_headers, application, "gw-signed")
+    await activate(client, admin_headers, application, "gw-legacy")
+    disabled = await activate(client, admin_headers, application, "gw-disabled")
+    # 升级前签发的随机令牌走授权缓存和数据库
+    async with async_session() as db:
+        await db.execute(update(Device).where(Device.device_id == "gw-legacy").values(user_token="legacy-token"))
+        await db.commit()
+        disabled_pk = await db.scalar(select(Device.id).where(Device.device_id == "gw-disabled"))
+    r = await client.put(f"/api/dashboard/devices/{disabled_pk}/status", params={"is_active": False}, headers=admin_headers)
+    assert r.status_code == 200
+
+    items = [
+        {"app_key": app_key, "token": signed, "device_id": "gw-signed"},
+        {"app_key": app_key, "token": "legacy-token", "device_id": "gw-legacy"},
+        {"app_key": app_key, "token": signed, "device_id": "gw-other"},
+        {"app_key": app_key, "token": disabled, "device_id": "gw-disabled"},
+        {"app_key": "no-such-app", "token": signed, "device_id": "gw-signed"},
+        {"app_key": app_key, "token": "legacy-token", "device_id": "gw-legacy"},
+    ]
+    r = await client.post("/api/heartbeat/batch", json=items)
+    assert r.status_code == 200
+    results = r.json()
+    assert [(item["success"], item["message"]) for item in results] == [
+        (True, "验证成功"),
+        (True, "验证成功"),
+        (False, "设备未授权"),
+        (False, "设备已被禁用"),
+        (False, "应用不存在"),
+        (True, "验证成功"),
+    ]
+    assert results[0]["next_interval"] and results[0]["remaining_seconds"] > 0
+
+    # 与单条接口结果一致
+    for item, expected in zip(items, results):
+        single = (await client.post("/api/heartbeat", json=item)).json()
+        assert (single["success"], single["message"]) == (expected["success"], expected["message"])
+
+
+async def test_batch_over_limit_is_rejected(client, application, monkeypatch, no_rate_limit):
+    monkeypatch.setattr(settings, "HEARTBEAT_BATCH_MAX_SIZE", 3)
+    item = {"app_key": application["app_key"], "token": "t", "device_id": "d"}
+    r = await client.post("/api/heartbeat/batch", json=[item] * 4)
+    assert r.status_code == 413
+    r = await client.post("/api/heartbeat/batch", json=[item] * 3)
+    assert r.status_code == 200
+    assert [result["message"] for result in r.json()] == ["设备未授权"] * 3
+
+
+async def test_empty_batch(client, no_rate_limit):
+    r = await client.post("/api/heartbeat/batch", json=[])
+    assert r.status_code == 200 and r.json() == []
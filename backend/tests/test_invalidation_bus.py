@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import fakeredis
+import pytest
+
+from app import shared_cache
+from app.shared_cache import AuthCache, CachedAuth, InvalidationBus
+
+pytestmark = pytest.mark.anyio
+
+
+async def wait_until(predicate, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis(server, monkeypatch):
+    """当前进程的共享Redis连接（publish等通过get_redis()取得）"""
+    client = fakeredis.FakeAsyncRedis(server=server)
+    monkeypatch.setattr(shared_cache, "_redis", client)
+    return client
+
+
+async def start_worker(server, received: list) -> InvalidationBus:
+    """模拟另一个worker：独立的连接和广播实例"""
+    bus = InvalidationBus(reconnect_delay=0.05, max_reconnect_delay=0.2)
+    bus.subscribe("revoke", received.append)
+    await bus.start(fakeredis.FakeAsyncRedis(server=server))
+    return bus
+
+
+async def test_publish_reaches_other_workers(server, redis):
+    local, remote = [], []
+    bus = InvalidationBus()
+    bus.subscribe("revoke", local.append)
+    await bus.start(redis)
+    other = await start_worker(server, remote)
+    try:
+        await bus.publish("revoke", "42|1700000000")
+        await wait_until(lambda: remote)
+        assert remote == ["42|1700000000"]
+        # 本进程直接执行，不会再从频道收到自己发出的消息
+        await asyncio.sleep(0.05)
+        assert local == ["42|1700000000"]
+        assert bus.stats()["connected"] and other.stats()["received"] == 1
+    finally:
+        await other.stop()
+        await bus.stop()
+
+
+async def test_auth_cache_invalidate_is_shared(server, redis):
+    worker_a = AuthCache(maxsize=100, ttl=60)
+    worker_b = AuthCache(maxsize=100, ttl=60)
+    auth = CachedAuth(7, True, datetime(2030, 1, 1))
+    await worker_a.set("app", "token", "dev", auth)
+    assert await worker_b.get("app", "token", "dev") == auth
+
+    await worker_b.invalidate("app", "token", "dev")
+    assert await worker_a.get("app", "token", "dev") is None
+
+
+async def test_auth_cache_skips_local_cache_with_multiple_workers():
+    assert shared_cache.get_redis() is None
+    auth = CachedAuth(7, True, datetime(2030, 1, 1))
+    single = AuthCache(maxsize=100, ttl=60, workers=1)
+    await single.set("app", "token", "dev", auth)
+    assert await single.get("app", "token", "dev") == auth
+
+    # 多worker且没有Redis：本进程缓存的条目其他worker无法删除，不缓存
+    multi = AuthCache(maxsize=100, ttl=60, workers=4)
+    await multi.set("app", "token", "dev", auth)
+    assert await multi.get("app", "token", "dev") is None
+    assert multi.stats()["backend"] == "none" and multi.stats()["local_size"] == 0
+
+
+async def test_reconnect_resyncs_after_connection_loss(server, redis):
+    received, resyncs = [], []
+    other = await start_worker(server, received)
+
+    async def resync():
+        resyncs.append(True)
+
+    other.on_resync(resync)
+    try:
+        # 服务端关闭订阅连接，且暂时无法重连
+        server.connected = False
+        other._pubsub.connection._sock.responses.put_nowait(b"")
+        await wait_until(lambda: not other.connected)
+        await wait_until(lambda: other.errors >= 2)
+        assert resyncs == []
+
+        server.connected = True
+        await wait_until(lambda: other.connected)
+        assert other.reconnects == 1
+        assert resyncs == [True]
+
+        bus = InvalidationBus()
+        await bus.publish("revoke", "9|1700000000")
+        await wait_until(lambda: received)
+        assert received == ["9|1700000000"]
+    finally:
+        await other.stop()
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from app.leases import Lease
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_only_one_worker_holds_the_lease(client):
+    workers = [Lease("test-concurrent", ttl=60, holder=f"worker-{i}") for i in range(4)]
+    results = await asyncio.gather(*(lease.acquire() for lease in workers))
+    assert sum(results) == 1
+
+    holder = workers[results.index(True)]
+    # 持有者可以续期，其他worker仍然取不到
+    assert await holder.acquire()
+    assert not any([await lease.acquire() for lease in workers if lease is not holder])
+
+
+async def test_expired_lease_moves_to_another_worker(client):
+    first = Lease("test-expiry", ttl=0.2, holder="worker-a")
+    second = Lease("test-expiry", ttl=0.2, holder="worker-b")
+    assert await first.acquire()
+    assert not await second.acquire()
+
+    await asyncio.sleep(0.3)
+    assert await second.acquire()
+    assert not await first.acquire()
+    assert first.stats() == {"acquired": 1, "skipped": 1}
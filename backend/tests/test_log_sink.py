@@ -0,0 +1,128 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+from app.database import async_session
+from app.hll import HyperLogLog
+from app.log_sink import HeartbeatLogSink
+from app.models import HeartbeatLog, HeartbeatRollup
+
+pytestmark = pytest.mark.anyio
+
+
+def test_sketch_estimates_and_merges():
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(5000):
+        a.add(f"dev-{i}")
+    for i in range(2500, 7500):
+        b.add(f"dev-{i}")
+    assert abs(a.count() - 5000) < 5000 * 0.1
+    a.merge(b)
+    assert abs(a.count() - 7500) < 7500 * 0.1
+    # 重复元素不改变估计值，合并后也一样
+    assert HyperLogLog(a.to_bytes()).count() == a.count()
+
+    small = HyperLogLog()
+    for i in range(20):
+        small.add(f"dev-{i}")
+        small.add(f"dev-{i}")
+    assert small.count() == 20
+
+
+async def test_rollup_memory_is_bounded_and_workers_dedupe(application):
+    app_id = application["id"]
+    minute = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(minutes=5)
+    workers = [HeartbeatLogSink(max_size=10, batch_size=10, flush_interval=1, sample_rate=0) for _ in range(2)]
+    for i in range(20000):
+        # 无效的device_id同样计入，但每个分钟汇总只占固定大小的草图
+        workers[0].submit(f"junk-{i}", app_id, None, "invalid", None, minute)
+    for worker in workers:
+        for i in range(300):
+            worker.submit(f"dev-{i}", app_id, None, "success", None, minute)
+    assert all(len(rollup[1].registers) == 1024 for w in workers for rollup in w._rollups.values())
+
+    for worker in workers:
+        await worker.flush(final=True)
+
+    async with async_session() as db:
+        rows = {
+            row.status: row
+            for row in await db.scalars(
+                select(HeartbeatRollup).where(
+                    HeartbeatRollup.application_id == app_id, HeartbeatRollup.minute == minute
+                )
+            )
+        }
+    assert rows["success"].heartbeat_count == 600
+    # 同一批设备在两个worker上各心跳一次，设备数不重复计算
+    assert abs(rows["success"].device_count - 300) <= 15
+    assert abs(rows["invalid"].device_count - 20000) <= 20000 * 0.1
+
+
+async def logged(app_id):
+    async with async_session() as db:
+        return await db.scalar(select(func.count(HeartbeatLog.id)).where(HeartbeatLog.application_id == app_id))
+
+
+async def test_submit_queues_failures_and_samples_successes(application):
+    sink = HeartbeatLogSink(max_size=100, batch_size=100, flush_interval=1, sample_rate=0)
+    for i in range(5):
+        assert sink.submit(f"dev-{i}", application["id"], "127.0.0.1", "success")
+    assert sink.submit("dev-x", application["id"], "127.0.0.1", "invalid", "无效令牌")
+    # 抽样比例为0时成功心跳只计入汇总，失败心跳全部保留明细
+    assert sink.stats()["queue_depth"] == 1
+    assert sink.stats()["sampled_out"] == 5
+    assert await logged(application["id"]) == 0
+
+
+async def test_flush_writes_in_batches(application):
+    sink = HeartbeatLogSink(max_size=100, batch_size=3, flush_interval=1, sample_rate=1)
+    for i in range(7):
+        sink.submit(f"dev-{i}", application["id"], None, "success")
+    # 满一个批次即唤醒后台任务
+    assert sink._wakeup.is_set()
+    assert await sink.flush() == 7
+    assert sink.stats()["flushes"] == 3 and sink.stats()["queue_depth"] == 0
+    assert await logged(application["id"]) == 7
+
+
+async def test_overflow_drops_and_counts(application):
+    sink = HeartbeatLogSink(max_size=5, batch_size=100, flush_interval=1, sample_rate=1)
+    accepted = [sink.submit(f"dev-{i}", application["id"], None, "invalid") for i in range(8)]
+    assert accepted == [True] * 5 + [False] * 3
+    assert sink.stats()["dropped"] == 3
+    await sink.flush(final=True)
+    assert await logged(application["id"]) == 5
+    # 丢弃的明细仍计入分钟汇总
+    async with async_session() as db:
+        total = await db.scalar(
+            select(func.sum(HeartbeatRollup.heartbeat_count)).where(HeartbeatRollup.application_id == application["id"])
+        )
+    assert total == 8
+
+
+async def test_background_loop_survives_flush_errors(application, monkeypatch):
+    sink = HeartbeatLogSink(max_size=100, batch_size=1, flush_interval=0.05, sample_rate=1)
+    flush = sink.flush
+    calls = []
+
+    async def failing_once(final=False):
+        calls.append(final)
+        if len(calls) == 1:
+            raise RuntimeError("数据库不可用")
+        return await flush(final)
+
+    monkeypatch.setattr(sink, "flush", failing_once)
+    sink.start()
+    try:
+        sink.submit("dev-1", application["id"], None, "invalid")
+        for _ in range(100):
+            if sink.stats()["written"]:
+                break
+            await asyncio.sleep(0.02)
+        assert len(calls) >= 2 and sink.stats()["written"] == 1
+    finally:
+        await sink.stop()
+    assert await logged(application["id"]) == 1
@@ -0,0 +1,57 @@
+import json
+import os
+
+import pytest
+
+from app.metrics import MetricsExporter
+
+pytestmark = pytest.mark.anyio
+
+DEAD_PID = 2 ** 22 + 7  # 超出pid_max，不会对应存活进程
+
+
+def write_snapshot(directory, pid, value, time=1.0):
+    snapshot = {
+        "pid": pid,
+        "time": time,
+        "metrics": {
+            "test_events_total": {
+                "type": "counter", "help": "测试", "labelnames": [], "buckets": [],
+                "samples": [[[], value]],
+            },
+            "test_gauge": {
+                "type": "gauge", "help": "测试", "labelnames": [], "buckets": [],
+                "samples": [[[], 100]],
+            },
+        },
+    }
+    with open(os.path.join(directory, f"metrics_{pid}.json"), "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+
+
+async def test_dead_worker_snapshots_are_folded(tmp_path):
+    exporter = MetricsExporter(str(tmp_path), interval=60)
+    write_snapshot(tmp_path, DEAD_PID, 5)
+    write_snapshot(tmp_path, DEAD_PID + 1, 2)
+
+    output = exporter.render()
+    assert "test_events_total 7" in output
+    assert "test_gauge" not in output
+    assert sorted(os.listdir(tmp_path)) == ["retired.json", "retired.lock"]
+
+    # 再次输出不会重复累加；之后退出的worker继续累加
+    assert "test_events_total 7" in exporter.render()
+    write_snapshot(tmp_path, DEAD_PID, 1, time=2.0)
+    assert "test_events_total 8" in exporter.render()
+
+
+async def test_reused_pid_does_not_reset_counters(tmp_path):
+    exporter = MetricsExporter(str(tmp_path), interval=60)
+    # 之前使用相同pid的进程留下的快照
+    write_snapshot(tmp_path, os.getpid(), 3)
+    exporter.start()
+    try:
+        assert "test_events_total 3" in exporter.render()
+    finally:
+        await exporter.stop()
+    assert "test_events_total 3" in exporter.render()
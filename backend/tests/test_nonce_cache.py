@@ -0,0 +1,72 @@
+import fakeredis
+import pytest
+
+from app import shared_cache
+from app.nonce_cache import NonceCache
+
+pytestmark = pytest.mark.anyio
+
+
+def cache(max_entries=1000, max_length=128):
+    # 有效期300秒，分为30个10秒的桶
+    return NonceCache(expiry=300, buckets=30, max_entries=max_entries, max_length=max_length)
+
+
+def test_replay_is_rejected_within_expiry():
+    nonces = cache()
+    assert nonces.check_local("a", 1000.0)
+    assert nonces.check_local("b", 1000.0)
+    assert not nonces.check_local("a", 1000.0)
+    # 桶末尾到达的Nonce同样至少保留完整的有效期
+    assert nonces.check_local("c", 1009.9)
+    assert not nonces.check_local("c", 1009.9 + 299.9)
+    assert not nonces.check_local("a", 1000.0 + 299.9)
+
+
+def test_expired_nonces_are_dropped():
+    nonces = cache()
+    for i in range(100):
+        assert nonces.check_local(f"n{i}", 1000.0)
+    assert len(nonces) == 100
+    # 超过有效期加一个桶后从队首整体淘汰
+    assert nonces.check_local("n0", 1000.0 + 320)
+    assert len(nonces) == 1
+
+
+def test_cap_evicts_oldest():
+    nonces = cache(max_entries=3)
+    for i, nonce in enumerate("abcd"):
+        assert nonces.check_local(nonce, 1000.0 + i)
+    assert len(nonces) == 3 and nonces.stats()["evicted"] == 1
+    # 被淘汰的是最早的a，其余仍被拒绝
+    assert not nonces.check_local("d", 1004.0)
+    assert nonces.check_local("a", 1004.0)
+
+
+async def test_verify_rejects_replays_and_long_nonces():
+    nonces = cache(max_length=8)
+    assert await nonces.verify("abcdefgh")
+    assert not await nonces.verify("abcdefgh")
+    assert not await nonces.verify("abcdefghi")
+    assert nonces.stats()["accepted"] == 1 and nonces.stats()["replayed"] == 2
+
+
+async def test_replay_to_another_worker_is_rejected(monkeypatch):
+    monkeypatch.setattr(shared_cache, "_redis", fakeredis.FakeAsyncRedis())
+    worker_a, worker_b = cache(), cache()
+    assert await worker_a.verify("shared-nonce")
+    assert not await worker_b.verify("shared-nonce")
+    assert await worker_b.verify("other-nonce")
+
+
+async def test_activation_replay_is_rejected(client, admin_headers, application, no_rate_limit):
+    r = await client.post("/api/cards", json={
+        "card_type": "day", "application_id": application["id"], "count": 1
+    }, headers=admin_headers)
+    body = {"card_key": r.json()[0]["card_key"], "device_id": "nonce-device"}
+    headers = {"X-Nonce": "activation-nonce-1"}
+    r = await client.post("/api/cards/activate", json=body, headers=headers)
+    assert r.json()["success"]
+    r = await client.post("/api/cards/activate", json=body, headers=headers)
+    result = r.json()
+    assert not result["success"] and result["message"] == "请求已过期或重复"
@@ -0,0 +1,39 @@
+from app.pacing import HeartbeatPacer
+
+
+def make_pacer(timeout=180, jitter_ratio=0.1) -> HeartbeatPacer:
+    return HeartbeatPacer(
+        timeout=timeout,
+        max_interval=600,
+        max_stretch=5,
+        jitter_ratio=jitter_ratio,
+        lag_threshold=0.05,
+        pool_threshold=0.8,
+        probe_interval=0.5
+    )
+
+
+def test_interval_plus_jitter_stays_below_timeout():
+    for timeout in (30, 180, 600):
+        for jitter_ratio in (0, 0.1, 0.5):
+            pacer = make_pacer(timeout, jitter_ratio)
+            for factor in (1, 2.5, 5):
+                pacer.factor = factor
+                for override in (0, 100, 3600, 86400):
+                    pacer.on_override(str(override))
+                    for base in (1, 10, 60, 170, 300, 1000):
+                        interval, jitter = pacer.next_interval(base)
+                        assert 1 <= interval and interval + jitter < timeout, (timeout, jitter_ratio, factor, override, base)
+
+
+def test_override_is_clamped_to_ceiling():
+    pacer = make_pacer()
+    pacer.on_override("86400")
+    assert pacer.override == pacer.ceiling
+    assert pacer.next_interval(60) == (pacer.ceiling, int(pacer.ceiling * 0.1))
+    # 上限以内的设置和负载拉长照常生效
+    pacer.on_override("100")
+    assert pacer.next_interval(60)[0] == 100
+    pacer.on_override("0")
+    pacer.factor = 2
+    assert pacer.next_interval(60)[0] == 120
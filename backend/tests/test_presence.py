@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import fakeredis
+import pytest
+
+from app import shared_cache
+from app.presence import PresenceTracker
+
+pytestmark = pytest.mark.anyio
+
+
+def tracker(backend, workers=1):
+    return PresenceTracker(backend=backend, timeout=180, flush_interval=2, workers=workers)
+
+
+def test_auto_uses_memory_for_single_worker():
+    presence = tracker("auto", workers=1)
+    assert presence.stats()["backend"] == "memory"
+    assert presence.enabled
+
+
+def test_auto_falls_back_to_sql_for_multiple_workers():
+    # 未配置Redis时各worker的进程内集合只有部分设备
+    presence = tracker("auto", workers=4)
+    assert presence.stats()["backend"] == "sql"
+    assert not presence.enabled
+
+
+def test_explicit_memory_is_kept():
+    presence = tracker("memory", workers=4)
+    assert presence.stats()["backend"] == "memory"
+
+
+def test_explicit_redis_without_redis_follows_worker_count():
+    assert tracker("redis", workers=1).stats()["backend"] == "memory"
+    assert tracker("redis", workers=4).stats()["backend"] == "sql"
+
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request, monkeypatch):
+    if request.param == "redis":
+        monkeypatch.setattr(shared_cache, "_redis", fakeredis.FakeAsyncRedis())
+    return request.param
+
+
+class Cluster:
+    """memory: 同一个进程内集合；redis: 一个worker收到心跳并写入，另一个worker读取"""
+
+    def __init__(self, backend):
+        self.writer = tracker(backend)
+        self.reader = tracker(backend) if backend == "redis" else self.writer
+
+    def touch(self, device_pk, last_seen, expires_at=None, application_id=1):
+        expires_at = expires_at or datetime.utcnow() + timedelta(days=30)
+        self.writer.touch(device_pk, f"dev{device_pk}", application_id, expires_at, last_seen, "127.0.0.1")
+
+    async def online(self, limit=10, application_ids=(1,)):
+        await self.writer.flush()
+        count, entries = await self.reader.online(application_ids, limit)
+        return count, [entry.device_pk for entry in entries]
+
+
+async def test_online_is_ordered_by_last_heartbeat(backend):
+    cluster = Cluster(backend)
+    now = datetime.utcnow()
+    for device_pk in (1, 2, 3):
+        cluster.touch(device_pk, now - timedelta(seconds=10 - device_pk))
+    cluster.touch(1, now)
+    assert await cluster.online() == (3, [1, 3, 2])
+    assert await cluster.online(limit=2) == (3, [1, 3])
+    # 多个应用按最后在线时间合并
+    cluster.touch(4, now - timedelta(seconds=9), application_id=2)
+    assert await cluster.online(application_ids=(1, 2)) == (4, [1, 3, 2, 4])
+
+
+async def test_timed_out_devices_are_evicted(backend):
+    cluster = Cluster(backend)
+    now = datetime.utcnow()
+    cluster.touch(1, now - timedelta(seconds=200))
+    cluster.touch(2, now)
+    assert await cluster.online() == (1, [2])
+
+
+async def test_discard_removes_device(backend):
+    cluster = Cluster(backend)
+    now = datetime.utcnow()
+    cluster.touch(1, now)
+    cluster.touch(2, now)
+    await cluster.writer.discard(1, 1)
+    assert await cluster.online() == (1, [2])
+
+
+async def test_expired_devices_are_not_counted(backend):
+    cluster = Cluster(backend)
+    now = datetime.utcnow()
+    cluster.touch(3, now - timedelta(seconds=1))
+    cluster.touch(1, now, expires_at=now - timedelta(seconds=1))
+    cluster.touch(2, now, expires_at=now + timedelta(seconds=60))
+    # redis: 读取的worker没有收到这些心跳，在线数和列表都要排除已到期的设备
+    assert await cluster.online() == (2, [2, 3])
+    assert await cluster.online(limit=0) == (2, [])
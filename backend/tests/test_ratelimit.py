@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from app.middleware import get_scope_client_ip, limiter
+from app.ratelimit import LocalStore
+
+pytestmark = pytest.mark.anyio
+
+
+def scope(peer, **headers):
+    return {
+        "type": "http",
+        "client": (peer, 12345),
+        "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()],
+    }
+
+
+def test_direct_client_cannot_spoof_forwarded_headers():
+    assert get_scope_client_ip(scope("203.0.113.7", x_forwarded_for="1.2.3.4")) == "203.0.113.7"
+    assert get_scope_client_ip(scope("203.0.113.7", x_real_ip="1.2.3.4")) == "203.0.113.7"
+
+
+def test_trusted_proxy_uses_rightmost_untrusted_address():
+    # 客户端自带的X-Forwarded-For在左侧，代理追加的真实地址在右侧
+    forwarded = "1.2.3.4, 198.51.100.9, 10.0.0.5"
+    assert get_scope_client_ip(scope("172.18.0.3", x_forwarded_for=forwarded)) == "198.51.100.9"
+    assert get_scope_client_ip(scope("127.0.0.1", x_real_ip="198.51.100.9")) == "198.51.100.9"
+    assert get_scope_client_ip(scope("127.0.0.1")) == "127.0.0.1"
+
+
+async def test_limiter_keys_on_client_behind_proxy(client, application):
+    # 同一代理转发的不同客户端分别计数
+    limiter.reset()
+    body = {"app_key": application["app_key"], "device_id": "d", "token": "t"}
+    for _ in range(60):
+        r = await client.post("/api/heartbeat", json=body, headers={"X-Forwarded-For": "198.51.100.1"})
+        assert r.status_code != 429
+    r = await client.post("/api/heartbeat", json=body, headers={"X-Forwarded-For": "198.51.100.1"})
+    assert r.status_code == 429
+    r = await client.post("/api/heartbeat", json=body, headers={"X-Forwarded-For": "198.51.100.2"})
+    assert r.status_code != 429
+    limiter.reset()
+
+
+def test_local_store_evicts_least_recently_used():
+    store = LocalStore(max_keys=10)
+    for i in range(10):
+        store.set(f"k{i}", 100.0 + i, 0.0)
+    # k0最早写入但刚被使用，不应被淘汰
+    assert store.get("k0") == 100.0
+    store.set("new", 200.0, 0.0)
+    assert len(store) == 9
+    assert store.get("k0") == 100.0
+    assert store.get("k1") == 0.0
+    assert store.get("new") == 200.0
+
+
+def test_local_store_insert_cost_at_capacity():
+    store = LocalStore(max_keys=100000)
+    for i in range(100000):
+        store.set(f"fill{i}", 1.0, 0.0)
+    start = time.perf_counter()
+    for i in range(20000):
+        store.set(f"flood{i}", 1.0, 0.0)
+    per_key = (time.perf_counter() - start) / 20000
+    assert len(store) <= 100000
+    # 容量已满时每个新键仍是常数时间（整表重建约为几十毫秒）
+    assert per_key < 50e-6
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete, func, insert, select
+
+from app.database import async_session
+from app.models import Card, CardType, StatsCounter
+from app.stats_counters import GLOBAL_SCOPE, StatsCounters, stats_counters
+
+pytestmark = pytest.mark.anyio
+
+
+async def add_card(application, key):
+    async with async_session() as db:
+        await db.execute(insert(Card).values(
+            card_key=key, card_type=CardType.DAY, duration_days=1,
+            application_id=application["id"], creator_id=1
+        ))
+        await db.commit()
+
+
+async def counted_and_actual():
+    await stats_counters.flush()
+    async with async_session() as db:
+        counter = await db.get(StatsCounter, GLOBAL_SCOPE)
+        actual = await db.scalar(select(func.count(Card.id)))
+    return counter.total_cards, actual
+
+
+async def test_reconcile_supersedes_other_workers_pending_deltas(client, application):
+    # 另一个worker已提交变化、增量还没写入时发生校正
+    other = StatsCounters(flush_interval=60, expiry_interval=60, reconcile_interval=3600)
+    await add_card(application, "RECONCILE-0001")
+    other.add(1, total_cards=1)
+    assert await stats_counters.reconcile(force=True)
+
+    assert await other.flush() == 0
+    assert other.stats()["superseded"] == 1
+    counted, actual = await counted_and_actual()
+    assert counted == actual
+
+    # 校正之后的变化照常累加
+    await add_card(application, "RECONCILE-0002")
+    other.add(1, total_cards=1)
+    assert await other.flush() == 2
+    counted, actual = await counted_and_actual()
+    assert counted == actual
+
+
+async def test_first_reconcile_runs_once_across_workers(client, application):
+    await add_card(application, "RECONCILE-0003")
+    await stats_counters.flush()
+    async with async_session() as db:
+        await db.execute(delete(StatsCounter))
+        await db.commit()
+
+    # 首次部署时多个worker同时启动，都看到还没有计数
+    workers = [StatsCounters(flush_interval=60, expiry_interval=60, reconcile_interval=3600) for _ in range(5)]
+    results = await asyncio.gather(*(worker.reconcile() for worker in workers))
+    assert sorted(results) == [False] * 4 + [True]
+    counted, actual = await counted_and_actual()
+    assert counted == actual
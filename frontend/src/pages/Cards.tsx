@@ -21,7 +21,8 @@ export default function Cards() {
   
   // 分页状态
   const [pagination, setPagination] = useState({
-    page: 1, page_size: 20, total: 0, total_pages: 0, has_next: false, has_prev: false
+    page: 1, page_size: 20, total: 0, total_pages: 0, has_next: false, has_prev: false,
+    cursor: null as string | null, next_cursor: null as string | null, prev_cursor: null as string | null
   });
 
   useEffect(() => {
@@ -36,6 +37,7 @@ export default function Cards() {
     setLoading(true);
     try {
       const params: any = { page: pagination.page, page_size: pagination.page_size };
+      if (pagination.cursor) params.cursor = pagination.cursor;
       if (filter.application_id) params.application_id = filter.application_id;
       if (filter.is_used !== '') params.is_used = filter.is_used === 'true';
       if (filter.keyword) params.keyword = filter.keyword;
@@ -64,7 +66,7 @@ export default function Cards() {
     try {
       await cardAPI.create(form);
       setShowModal(false);
-      setPagination(p => ({ ...p, page: 1 }));
+      setPagination(p => ({ ...p, page: 1, cursor: null }));
       loadCards();
     } catch (err) {
       console.error(err);
@@ -74,7 +76,7 @@ export default function Cards() {
   };
   
   const handleSearch = () => {
-    setPagination(p => ({ ...p, page: 1 }));
+    setPagination(p => ({ ...p, page: 1, cursor: null }));
     loadCards();
   };
   
@@ -212,14 +214,14 @@ export default function Cards() {
               </div>
               <div className="flex gap-2">
                 <button 
-                  onClick={() => setPagination(p => ({ ...p, page: p.page - 1 }))}
+                  onClick={() => setPagination(p => ({ ...p, page: p.page - 1, cursor: p.prev_cursor }))}
                   disabled={!pagination.has_prev}
                   className="px-3 py-1 border rounded disabled:opacity-50 disabled:cursor-not-allowed hover:bg-gray-50"
                 >
                   <ChevronLeft className="w-5 h-5" />
                 </button>
                 <button 
-                  onClick={() => setPagination(p => ({ ...p, page: p.page + 1 }))}
+                  onClick={() => setPagination(p => ({ ...p, page: p.page + 1, cursor: p.next_cursor }))}
                   disabled={!pagination.has_next}
                   className="px-3 py-1 border rounded disabled:opacity-50 disabled:cursor-not-allowed hover:bg-gray-50"
                 >
@@ -1,5 +1,5 @@
 import { useEffect, useState } from 'react';
-import { AppWindow, CreditCard, Users, Laptop, Activity } from 'lucide-react';
+import { AppWindow, CreditCard, Users, Laptop, Activity, Wifi } from 'lucide-react';
 import { dashboardAPI } from '../api';
 
 interface Stats {
@@ -8,6 +8,7 @@ interface Stats {
   total_cards: number;
   used_cards: number;
   active_devices: number;
+  online_devices?: number | null;
 }
 
 export default function Dashboard() {
@@ -38,6 +39,10 @@ export default function Dashboard() {
     { label: '活跃设备', value: stats?.active_devices || 0, icon: Laptop, color: 'bg-purple-500' },
     { label: '用户数量', value: stats?.total_users || 0, icon: Users, color: 'bg-pink-500' },
   ];
+  // 服务端未开启在线状态统计时不显示
+  if (stats?.online_devices != null) {
+    statCards.splice(4, 0, { label: '在线设备', value: stats.online_devices, icon: Wifi, color: 'bg-teal-500' });
+  }
 
   return (
     <div>
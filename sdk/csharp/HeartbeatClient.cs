@@ -23,6 +23,7 @@ namespace HeartbeatSDK
         private string _deviceId;
         private CancellationTokenSource _heartbeatCts;
         private Task _heartbeatTask;
+        private readonly Random _random = new Random();
 
         public event Action<HeartbeatResult> OnExpired;
         public event Action<HeartbeatResult> OnError;
@@ -92,7 +93,9 @@ namespace HeartbeatSDK
                 {
                     Success = response.GetProperty("success").GetBoolean(),
                     Message = response.GetProperty("message").GetString(),
-                    RemainingSeconds = response.TryGetProperty("remaining_seconds", out var rs) ? rs.GetInt32() : 0
+                    RemainingSeconds = response.TryGetProperty("remaining_seconds", out var rs) ? rs.GetInt32() : 0,
+                    NextInterval = response.TryGetProperty("next_interval", out var ni) && ni.ValueKind == JsonValueKind.Number ? ni.GetInt32() : (int?)null,
+                    IntervalJitter = response.TryGetProperty("interval_jitter", out var ij) && ij.ValueKind == JsonValueKind.Number ? ij.GetInt32() : 0
                 };
             }
             catch (Exception ex)
@@ -116,7 +119,14 @@ namespace HeartbeatSDK
                         if (result.Message.Contains("过期")) OnExpired?.Invoke(result);
                         else OnError?.Invoke(result);
                     }
-                    await Task.Delay(intervalSeconds * 1000, _heartbeatCts.Token);
+                    // 优先使用服务器下发的间隔，加随机抖动避免客户端同时请求
+                    var waitSeconds = (double)intervalSeconds;
+                    if (result.NextInterval.HasValue)
+                    {
+                        var jitter = result.IntervalJitter ?? 0;
+                        waitSeconds = Math.Max(result.NextInterval.Value + (_random.NextDouble() * 2 - 1) * jitter, 1);
+                    }
+                    await Task.Delay(TimeSpan.FromSeconds(waitSeconds), _heartbeatCts.Token);
                 }
             }, _heartbeatCts.Token);
         }
@@ -172,6 +182,8 @@ namespace HeartbeatSDK
         public bool Success { get; set; }
         public string Message { get; set; }
         public int? RemainingSeconds { get; set; }
+        public int? NextInterval { get; set; }
+        public int? IntervalJitter { get; set; }
     }
 }
 
@@ -103,7 +103,9 @@ class HeartbeatClient {
         message: response.message,
         expiresAt: response.expires_at ? new Date(response.expires_at) : null,
         remainingSeconds: response.remaining_seconds,
-        serverTime: new Date(response.server_time)
+        serverTime: new Date(response.server_time),
+        nextInterval: response.next_interval,
+        intervalJitter: response.interval_jitter
       };
     } catch (error) {
       return { success: false, message: `网络错误: ${error.message}` };
@@ -132,7 +134,7 @@ class HeartbeatClient {
   }
 
   /**
-   * 启动自动心跳
+   * 启动自动心跳（服务器返回nextInterval时以服务器为准）
    */
   startHeartbeat(intervalSeconds = 60, onExpired = null, onError = null) {
     if (this.heartbeatTimer) return;
@@ -149,10 +151,19 @@ class HeartbeatClient {
           this.onError(result);
         }
       }
+      // 已调用stopHeartbeat时不再继续
+      if (!this.heartbeatTimer) return;
+
+      // 服务器下发的间隔加随机抖动，避免客户端同时请求
+      let waitSeconds = intervalSeconds;
+      if (result.nextInterval) {
+        const jitter = result.intervalJitter || 0;
+        waitSeconds = Math.max(result.nextInterval + (Math.random() * 2 - 1) * jitter, 1);
+      }
+      this.heartbeatTimer = setTimeout(doHeartbeat, waitSeconds * 1000);
     };
 
-    doHeartbeat();
-    this.heartbeatTimer = setInterval(doHeartbeat, intervalSeconds * 1000);
+    this.heartbeatTimer = setTimeout(doHeartbeat, 0);
   }
 
   /**
@@ -160,7 +171,7 @@ class HeartbeatClient {
    */
   stopHeartbeat() {
     if (this.heartbeatTimer) {
-      clearInterval(this.heartbeatTimer);
+      clearTimeout(this.heartbeatTimer);
       this.heartbeatTimer = null;
     }
   }
@@ -4,6 +4,7 @@
 """
 
 import time
+import random
 import hashlib
 import platform
 import threading
@@ -21,6 +22,8 @@ class HeartbeatResult:
     expires_at: Optional[datetime] = None
     remaining_seconds: Optional[int] = None
     server_time: Optional[datetime] = None
+    next_interval: Optional[int] = None
+    interval_jitter: Optional[int] = None
 
 
 @dataclass
@@ -50,6 +53,7 @@ class HeartbeatClient:
         self.device_id: Optional[str] = None
         self._heartbeat_thread: Optional[threading.Thread] = None
         self._running = False
+        self._stop_event = threading.Event()
         self._interval = 60
         self._on_expired: Optional[Callable] = None
         self._on_error: Optional[Callable] = None
@@ -135,7 +139,9 @@ class HeartbeatClient:
                 message=data.get("message", ""),
                 expires_at=datetime.fromisoformat(data["expires_at"].replace("Z", "+00:00")) if data.get("expires_at") else None,
                 remaining_seconds=data.get("remaining_seconds"),
-                server_time=datetime.fromisoformat(data["server_time"].replace("Z", "+00:00")) if data.get("server_time") else None
+                server_time=datetime.fromisoformat(data["server_time"].replace("Z", "+00:00")) if data.get("server_time") else None,
+                next_interval=data.get("next_interval"),
+                interval_jitter=data.get("interval_jitter")
             )
         except Exception as e:
             return HeartbeatResult(success=False, message=f"网络错误: {str(e)}")
@@ -169,7 +175,7 @@ class HeartbeatClient:
         启动自动心跳
         
         Args:
-            interval: 心跳间隔(秒)
+            interval: 心跳间隔(秒),服务器返回next_interval时以服务器为准
             on_expired: 授权过期回调
             on_error: 错误回调
         """
@@ -180,6 +186,7 @@ class HeartbeatClient:
         self._on_expired = on_expired
         self._on_error = on_error
         self._running = True
+        self._stop_event.clear()
         
         self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
         self._heartbeat_thread.start()
@@ -187,6 +194,7 @@ class HeartbeatClient:
     def stop_heartbeat(self):
         """停止自动心跳"""
         self._running = False
+        self._stop_event.set()
         if self._heartbeat_thread:
             self._heartbeat_thread.join(timeout=5)
     
@@ -201,7 +209,14 @@ class HeartbeatClient:
                 elif self._on_error:
                     self._on_error(result)
             
-            time.sleep(self._interval)
+            self._stop_event.wait(self._next_wait(result))
+    
+    def _next_wait(self, result: HeartbeatResult) -> float:
+        """下次心跳等待时间:优先使用服务器下发的间隔,加上随机抖动避免客户端同时请求"""
+        if not result.next_interval:
+            return self._interval
+        jitter = result.interval_jitter or 0
+        return max(result.next_interval + random.uniform(-jitter, jitter), 1)
     
     def set_token(self, token: str):
         """设置已有的token"""